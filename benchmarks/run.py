@@ -0,0 +1,262 @@
+"""
+Benchmark the export and transform stages against synthetic exports in moto s3.
+
+Run from the repository root, e.g.:
+
+    python -m benchmarks.run --rows 100000 --output bench.json
+    python -m benchmarks.run --rows 100000 --compare bench.json
+
+Each stage reports wall time, rows/sec, bytes/sec (compressed bytes of the export read)
+and the peak RSS of the process once it has run. The best of `--repeat` runs is kept,
+so results are comparable across commits on the same machine. With `--compare`, any
+stage slower than the baseline by more than `--threshold` fails the run.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, List
+
+os.environ.setdefault("AWS_STAGE_ENV", "dev")
+for _name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "AWS_SESSION_TOKEN"):
+    os.environ.setdefault(_name, "benchmark")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+import boto3
+from moto import mock_s3
+from src.runtime.chalicelib import dynamodb_export_handler, redshift_manifest_handler
+from src.runtime.chalicelib.config import Config
+from benchmarks.synthetic_exports import generate_export
+
+S3_BUCKET = "benchmark-bucket"
+INCREMENTAL_TABLE = "AnotherDynamoDbTable"
+FULL_TABLE = "SomeDynamoDbTable"
+
+
+class _FakeDynamoDbClient:
+    """Accepts exports without running them, to time everything around the submission."""
+
+    def __init__(self):
+        self.exports = 0
+
+    def export_table_to_point_in_time(self, **kwargs):
+        self.exports += 1
+        return {
+            "ExportDescription": {
+                "ExportArn": f"{kwargs['TableArn']}/export/benchmark-{self.exports}"
+            }
+        }
+
+
+def run(
+    rows: int = 100_000,
+    files: int = 8,
+    item_width: int = 512,
+    mix: tuple = (0.5, 0.4, 0.1),
+    tables: int = 20,
+    repeat: int = 3,
+) -> dict:
+    """
+    Run every stage `repeat` times against the same synthetic exports.
+
+    Returns:
+        dict: the parameters and environment of the run, and the best result of each stage
+    """
+    configure()
+    results = {}
+    with mock_s3():
+        s3_client = boto3.client("s3", region_name="us-east-1")
+        s3_client.create_bucket(Bucket=S3_BUCKET)
+        exports = {
+            "incremental": generate_export(
+                s3_client,
+                S3_BUCKET,
+                f"benchmark/dynamodb-export/incremental-export/{INCREMENTAL_TABLE}",
+                "benchmark-incremental",
+                is_incremental=True,
+                rows=rows,
+                files=files,
+                item_width=item_width,
+                mix=mix,
+            ),
+            "full": generate_export(
+                s3_client,
+                S3_BUCKET,
+                f"benchmark/dynamodb-export/full-export/{FULL_TABLE}",
+                "benchmark-full",
+                is_incremental=False,
+                rows=rows,
+                files=files,
+                item_width=item_width,
+            ),
+        }
+
+        stages = {
+            # the transform hot path: read, compact, project and write every row
+            "manifest_incremental": (
+                lambda: redshift_manifest_handler.handle(
+                    s3_client, exports["incremental"]["manifest_summary_file"]
+                ),
+                exports["incremental"],
+            ),
+            # with json output, only writes the manifest, with parquet it converts every row
+            "manifest_full": (
+                lambda: redshift_manifest_handler.handle(
+                    s3_client, exports["full"]["manifest_summary_file"]
+                ),
+                exports["full"],
+            ),
+            # planning and submitting a 3 day backlog of incremental exports for `tables` tables
+            "export_incremental": (
+                lambda: _export_backlog(s3_client, tables),
+                {"rows": tables * 3, "bytes": 0},
+            ),
+        }
+        for stage, (func, export) in stages.items():
+            results[stage] = _time_stage(func, export, repeat)
+
+    return {
+        "commit": _get_commit(),
+        "timestamp": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {
+            "rows": rows,
+            "files": files,
+            "item_width": item_width,
+            "mix": list(mix),
+            "tables": tables,
+            "repeat": repeat,
+            "output_format": Config.OUTPUT_FORMAT,
+        },
+        "stages": results,
+    }
+
+
+def configure():
+    """Point the config at the benchmark bucket, and don't wait between export submissions."""
+    Config.S3_BUCKET = S3_BUCKET
+    Config.S3_BUCKET_PREFIX = "benchmark/"
+    Config.REDSHIFT_TARGET_SCHEMA = Config.REDSHIFT_TARGET_SCHEMA or "benchmark"
+    Config.TABLE_ARN_PREFIX = "arn:aws:dynamodb:us-east-1:123456789012:table/"
+    Config.EXPORT_SUBMISSION_INTERVAL_SECONDS = 0
+    Config.logger.setLevel("WARNING")
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> List[str]:
+    """
+    Compare the stage times of two runs.
+
+    Returns:
+        List[str]: the stages slower than the baseline by more than `threshold`, e.g. 0.2 for 20%
+    """
+    regressions = []
+    for stage, result in results["stages"].items():
+        baseline_result = baseline["stages"].get(stage)
+        if baseline_result is None:
+            continue
+        change = result["seconds"] / baseline_result["seconds"] - 1
+        print(
+            f"{stage:<22} {baseline_result['seconds']:>9.3f}s -> {result['seconds']:>9.3f}s "
+            f"({change:+.1%})"
+        )
+        if change > threshold:
+            regressions.append(stage)
+    return regressions
+
+
+def _time_stage(func: Callable[[], Any], export: dict, repeat: int) -> dict:
+    timings = []
+    for _ in range(repeat):
+        dynamodb_export_handler._WATERMARK_CACHE.invalidate()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    seconds = min(timings)
+    return {
+        "seconds": round(seconds, 4),
+        "rows": export["rows"],
+        "rows_per_second": round(export["rows"] / seconds, 1),
+        "bytes_per_second": round(export["bytes"] / seconds, 1),
+        "peak_rss_mb": round(_get_peak_rss_mb(), 1),
+        "timings": [round(t, 4) for t in timings],
+    }
+
+
+def _export_backlog(s3_client: Any, tables: int):
+    now = datetime(2024, 1, 4)
+    dynamodb_export_handler.handle(
+        dynamodb_client=_FakeDynamoDbClient(),
+        s3_client=s3_client,
+        tables=[f"BenchmarkTable{i}" for i in range(tables)],
+        is_incremental=True,
+        export_time=now,
+        export_from_datetime=now - timedelta(days=2, hours=12),
+    )
+
+
+def _get_peak_rss_mb() -> float:
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak_rss / (1024 * 1024) if sys.platform == "darwin" else peak_rss / 1024
+
+
+def _get_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            text=True,
+            stderr=subprocess.DEVNULL,
+        ).strip()
+    except Exception:
+        return None
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--files", type=int, default=8)
+    parser.add_argument("--item-width", type=int, default=512)
+    parser.add_argument(
+        "--mix",
+        type=float,
+        nargs=3,
+        default=(0.5, 0.4, 0.1),
+        metavar=("INSERTS", "UPDATES", "DELETES"),
+    )
+    parser.add_argument("--tables", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument("--compare", help="compare with the results in this json file")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    results = run(
+        rows=args.rows,
+        files=args.files,
+        item_width=args.item_width,
+        mix=tuple(args.mix),
+        tables=args.tables,
+        repeat=args.repeat,
+    )
+    print(json.dumps(results, indent=4))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"Slower than {args.compare}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
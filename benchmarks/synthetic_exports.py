@@ -0,0 +1,172 @@
+"""
+Generate synthetic DynamoDB exports in s3, laid out like the real thing, for benchmarking.
+
+A full export has one `Item` per row. An incremental export has a `NewImage` (insert),
+`NewImage` and `OldImage` (update) or `OldImage` (delete) per row, with some keys changed
+more than once, so compaction has work to do.
+"""
+import gzip
+import hashlib
+import json
+import random
+from datetime import datetime, timedelta
+from typing import Any, List
+
+ACCOUNT_ARN = "arn:aws:dynamodb:us-east-1:123456789012"
+
+
+def generate_export(
+    s3_client: Any,
+    s3_bucket: str,
+    table_s3_prefix: str,
+    export_id: str,
+    is_incremental: bool,
+    rows: int,
+    files: int = 4,
+    item_width: int = 512,
+    mix: tuple = (0.5, 0.4, 0.1),
+    seed: int = 0,
+) -> dict:
+    """
+    Write a synthetic export to s3: gzipped data files, manifest-files.json and manifest-summary.json.
+
+    Args:
+        rows: number of rows, across all data files
+        files: number of data files
+        item_width: approximate size of an item in bytes, padded with attributes not in the jsonpaths
+        mix: fraction of inserts, updates and deletes in an incremental export
+        seed: for the random generator, the same seed writes the same export
+
+    Returns:
+        dict: "manifest_summary_file", the s3 path to manifest-summary.json,
+            and the "rows", "keys" and compressed "bytes" of the data files
+    """
+    rng = random.Random(seed)
+    table = table_s3_prefix.split("/")[-1]
+    export_dir = f"{table_s3_prefix}/AWSDynamoDB/{export_id}"
+    export_time = datetime(2024, 1, 1) + timedelta(minutes=15 * seed)
+    keys = _get_keys(rng, rows, is_incremental)
+
+    manifest_files = []
+    total_bytes = 0
+    for file_index in range(files):
+        file_rows = [
+            _get_row(rng, key, is_incremental, item_width, mix, export_time)
+            for key in keys[file_index::files]
+        ]
+        body = gzip.compress(
+            "\n".join(json.dumps(r) for r in file_rows).encode("utf-8"), compresslevel=6
+        )
+        data_file = f"{export_dir}/data/{hashlib.md5(f'{export_id}-{file_index}'.encode()).hexdigest()}.json.gz"
+        s3_client.put_object(Bucket=s3_bucket, Key=data_file, Body=body)
+        total_bytes += len(body)
+        manifest_files.append(
+            {
+                "itemCount": len(file_rows),
+                "md5Checksum": hashlib.md5(body).hexdigest(),
+                "dataFileS3Key": data_file,
+            }
+        )
+
+    manifest_files_file = f"{export_dir}/manifest-files.json"
+    s3_client.put_object(
+        Bucket=s3_bucket,
+        Key=manifest_files_file,
+        Body="\n".join(json.dumps(m) for m in manifest_files),
+    )
+    manifest_summary_file = f"{export_dir}/manifest-summary.json"
+    s3_client.put_object(
+        Bucket=s3_bucket,
+        Key=manifest_summary_file,
+        Body=json.dumps(
+            {
+                "version": "2023-08-01",
+                "exportArn": f"{ACCOUNT_ARN}:table/{table}/export/{export_id}",
+                "startTime": export_time.isoformat(),
+                "endTime": (export_time + timedelta(minutes=5)).isoformat(),
+                "tableArn": f"{ACCOUNT_ARN}:table/{table}",
+                "exportTime": export_time.isoformat(),
+                "s3Bucket": s3_bucket,
+                "s3Prefix": table_s3_prefix,
+                "s3SseAlgorithm": "AES256",
+                "manifestFilesS3Key": manifest_files_file,
+                "billedSizeBytes": total_bytes,
+                "itemCount": len(keys),
+                "outputFormat": "DYNAMODB_JSON",
+                "exportType": "INCREMENTAL_EXPORT" if is_incremental else "FULL_EXPORT",
+            }
+        ),
+    )
+    return {
+        "manifest_summary_file": manifest_summary_file,
+        "rows": len(keys),
+        "keys": len(set(keys)),
+        "bytes": total_bytes,
+    }
+
+
+def _get_keys(rng: random.Random, rows: int, is_incremental: bool) -> List[str]:
+    """Get the partition key of each row. In an incremental export ~10% of rows repeat an earlier key."""
+    keys = [f"pk-{i:09d}" for i in range(rows)]
+    if is_incremental:
+        for i in range(1, rows):
+            if rng.random() < 0.1:
+                keys[i] = keys[rng.randrange(i)]
+    return keys
+
+
+def _get_row(
+    rng: random.Random,
+    partition_key: str,
+    is_incremental: bool,
+    item_width: int,
+    mix: tuple,
+    export_time: datetime,
+) -> dict:
+    keys = {"PK": {"S": partition_key}, "SK": {"S": "sk-1"}}
+    if not is_incremental:
+        return {"Item": _get_item(rng, keys, item_width)}
+
+    row = {
+        "Metadata": {
+            "WriteTimestampMicros": {
+                "N": str(int(export_time.timestamp() * 1e6) + rng.randrange(10**8))
+            }
+        },
+        "Keys": keys,
+    }
+    change = rng.choices(("insert", "update", "delete"), weights=mix)[0]
+    if change in ("insert", "update"):
+        row["NewImage"] = _get_item(rng, keys, item_width)
+    if change in ("update", "delete"):
+        row["OldImage"] = _get_item(rng, keys, item_width)
+    return row
+
+
+def _get_item(rng: random.Random, keys: dict, item_width: int) -> dict:
+    """An item with the attributes of the tables in table_mapping.json, padded to `item_width`."""
+    item = dict(keys)
+    item.update(
+        {
+            "some_text": {"S": _get_text(rng, 24)},
+            "some_more_text": {"S": _get_text(rng, 24)},
+            "some_id": {"S": _get_text(rng, 12)},
+            "another_id": {"S": _get_text(rng, 12)},
+            "order_confirmed": {"BOOL": rng.random() < 0.5},
+            "some_nested_info": {
+                "M": {
+                    "some_decimal": {"N": f"{rng.uniform(0, 1000):.2f}"},
+                    "another_decimal": {"N": f"{rng.uniform(0, 1000):.2f}"},
+                    "not_loaded": {"S": _get_text(rng, 16)},
+                }
+            },
+        }
+    )
+    padding = item_width - len(json.dumps(item))
+    if padding > 0:
+        item["not_loaded"] = {"S": _get_text(rng, padding)}
+    return item
+
+
+def _get_text(rng: random.Random, length: int) -> str:
+    return f"{rng.getrandbits(4 * length):0{length}x}"
@@ -1,7 +1,9 @@
 from datetime import datetime
 import json
+import time
 from contextlib import contextmanager
 import boto3
+from botocore.config import Config as BotoConfig
 from chalice import Chalice, Rate
 import psycopg2
 from chalice.app import ConvertToMiddleware
@@ -10,20 +12,28 @@ from urllib.parse import unquote
 
 try:
     from chalicelib.config import Config
+    from chalicelib.ttl_cache import TTLCache
     from chalicelib.exceptions import RedshiftQueryException
     from chalicelib import (
         dynamodb_export_handler,
+        manifest_shards,
+        metrics,
         redshift_manifest_handler,
         redshift_upsert_handler,
+        upsert_accumulator,
     )
 except:
     # Not ideal but required for pytest
     from .chalicelib.config import Config
+    from .chalicelib.ttl_cache import TTLCache
     from .chalicelib.exceptions import RedshiftQueryException
     from .chalicelib import (
         dynamodb_export_handler,
+        manifest_shards,
+        metrics,
         redshift_manifest_handler,
         redshift_upsert_handler,
+        upsert_accumulator,
     )
 
 app = Chalice(app_name="dynamo-redshift")
@@ -34,6 +44,11 @@ app.register_middleware(ConvertToMiddleware(Config.tracer.capture_lambda_handler
 _SECRETSMANAGER_CLIENT = None
 _S3_CLIENT = None
 _DYNAMODB_CLIENT = None
+_REDSHIFT_DATA_CLIENT = None
+# reused across warm invocations, see get_redshift_connection
+_REDSHIFT_CONNECTION = None
+_CREDENTIALS_CACHE = TTLCache(ttl_seconds=Config.SECRETS_CACHE_TTL_SECONDS)
+metrics.register_cache("redshift_upsert", "Credentials", _CREDENTIALS_CACHE)
 
 
 def get_secretsmanager_client():
@@ -57,11 +72,38 @@ def get_dynamodb_client():
 def get_s3_client():
     global _S3_CLIENT
     if _S3_CLIENT is None:
-        _S3_CLIENT = boto3.client("s3")
+        # enough connections for every ranged GET of every data file in flight
+        _S3_CLIENT = boto3.client(
+            "s3",
+            config=BotoConfig(
+                max_pool_connections=max(
+                    10, Config.MANIFEST_MAX_WORKERS * Config.S3_DOWNLOAD_CONCURRENCY
+                )
+            ),
+        )
     return _S3_CLIENT
 
 
+def get_redshift_data_client():
+    """For `Config.REDSHIFT_EXECUTION_BACKEND` "data_api", see redshift_upsert_handler.handle_async"""
+    global _REDSHIFT_DATA_CLIENT
+    if _REDSHIFT_DATA_CLIENT is None:
+        _REDSHIFT_DATA_CLIENT = boto3.client(
+            service_name="redshift-data",
+            region_name=Config.DEFAULT_REGION,
+        )
+    return _REDSHIFT_DATA_CLIENT
+
+
 def get_credentials():
+    """Get the redshift credentials, cached for `Config.SECRETS_CACHE_TTL_SECONDS`."""
+    credentials = _CREDENTIALS_CACHE.get_or_load(
+        Config.REDSHIFT_SECRET_ID, _load_credentials
+    )
+    return credentials
+
+
+def _load_credentials():
     secretsmanager_client = get_secretsmanager_client()
     credentials_response = secretsmanager_client.get_secret_value(
         SecretId=Config.REDSHIFT_SECRET_ID
@@ -70,9 +112,14 @@ def get_credentials():
     return credentials
 
 
-@contextmanager  # this is to ensure each connection is 'use once'
+@contextmanager
 def get_redshift_connection(credentials=None):
-    """Get a single use psycopg2.connect object for redshift queries.
+    """Get a psycopg2.connect object for redshift queries.
+
+    The connection is single use, unless `Config.REDSHIFT_REUSE_CONNECTION` is set, in which
+    case it is kept for the next (warm) invocation. A kept connection is checked before reuse,
+    and replaced if it is broken, older than `Config.REDSHIFT_CONNECTION_MAX_AGE_SECONDS`,
+    or was opened with other credentials.
 
     Example
     -------
@@ -81,24 +128,95 @@ def get_redshift_connection(credentials=None):
         cur.execute("SELECT * FROM SOME_TABLE LIMIT 1")
         results = cur.fetchall()
     """
-    try:
-        credentials = credentials or get_credentials()
-        conn = psycopg2.connect(
-            database=Config.REDSHIFT_DATABASE,
-            user=credentials.get("username"),
-            password=credentials.get("password"),
-            host=credentials.get("host"),
-            port=credentials.get("port"),
-        )
-    except Exception as ex:
-        raise Exception("Unable to establish a new redshift connection: {ex}") from ex
+    credentials = credentials or get_credentials()
+    if Config.REDSHIFT_REUSE_CONNECTION:
+        conn = _get_cached_redshift_connection(credentials)
+    else:
+        conn = _connect_to_redshift(credentials)
 
     try:
         yield conn
+        if Config.REDSHIFT_REUSE_CONNECTION:
+            conn.rollback()  # don't leave a transaction open for the next invocation
     except Exception as ex:
+        if Config.REDSHIFT_REUSE_CONNECTION:
+            _discard_cached_redshift_connection()
         raise RedshiftQueryException(str(ex)) from ex
     finally:
-        conn.close()
+        if not Config.REDSHIFT_REUSE_CONNECTION:
+            conn.close()
+
+
+def _connect_to_redshift(credentials):
+    try:
+        try:
+            return _connect(credentials)
+        except psycopg2.OperationalError:
+            # the secret may have been rotated since it was cached, retry with the latest
+            _CREDENTIALS_CACHE.invalidate(Config.REDSHIFT_SECRET_ID)
+            latest_credentials = get_credentials()
+            if latest_credentials == credentials:
+                raise
+            return _connect(latest_credentials)
+    except Exception as ex:
+        raise Exception(f"Unable to establish a new redshift connection: {ex}") from ex
+
+
+def _connect(credentials):
+    return psycopg2.connect(
+        database=Config.REDSHIFT_DATABASE,
+        user=credentials.get("username"),
+        password=credentials.get("password"),
+        host=credentials.get("host"),
+        port=credentials.get("port"),
+    )
+
+
+def _get_cached_redshift_connection(credentials):
+    """Get the cached redshift connection if it is still usable, otherwise open a new one."""
+    global _REDSHIFT_CONNECTION
+    if _REDSHIFT_CONNECTION is not None:
+        conn, opened_at, opened_with = _REDSHIFT_CONNECTION
+        age = time.monotonic() - opened_at
+        if (
+            age < Config.REDSHIFT_CONNECTION_MAX_AGE_SECONDS
+            and opened_with == credentials
+            and _is_redshift_connection_alive(conn)
+        ):
+            return conn
+        Config.logger.info(f"Replacing redshift connection opened {age:.0f}s ago")
+        _discard_cached_redshift_connection()
+
+    conn = _connect_to_redshift(credentials)
+    _REDSHIFT_CONNECTION = (conn, time.monotonic(), dict(credentials))
+    return conn
+
+
+def _is_redshift_connection_alive(conn):
+    """Reset any open transaction and check the connection still answers a query."""
+    if conn.closed:
+        return False
+    try:
+        conn.rollback()
+        cur = conn.cursor()
+        cur.execute("SELECT 1;")
+        cur.fetchall()
+        conn.rollback()
+        return True
+    except Exception as ex:
+        Config.logger.info(f"Redshift connection is no longer usable: {ex}")
+        return False
+
+
+def _discard_cached_redshift_connection():
+    global _REDSHIFT_CONNECTION
+    if _REDSHIFT_CONNECTION is not None:
+        conn = _REDSHIFT_CONNECTION[0]
+        _REDSHIFT_CONNECTION = None
+        try:
+            conn.close()
+        except Exception:
+            pass
 
 
 @app.route("/health")
@@ -122,11 +240,12 @@ def dynamodb_full_export(event=None):
     return json.dumps(response, default=str)
 
 
-@app.schedule(Rate(15, Rate.MINUTES))
+@app.schedule(Rate(Config.INCREMENTAL_EXPORT_INTERVAL_MINUTES, Rate.MINUTES))
 # @app.route("/incremental-export")  # should not check in this line uncommented, use for manual testing only!
 def dynamodb_incremental_export(event=None):
     """
-    Do incremental export from dynamodb tables to s3.
+    Do incremental export from dynamodb tables to s3. With `Config.ADAPTIVE_EXPORT_SCHEDULE`,
+    only the tables that are due, so run this more often than the minimum interval.
     """
     response = dynamodb_export_handler.handle(
         dynamodb_client=get_dynamodb_client(),
@@ -155,6 +274,37 @@ def redshift_manifest_creation(event=None):
     return response
 
 
+@app.on_s3_event(
+    bucket=Config.S3_BUCKET,
+    events=["s3:ObjectCreated:*"],
+    prefix=Config.S3_BUCKET_PREFIX + "dynamodb-export/",
+    suffix=manifest_shards.SHARD_SUFFIX,
+)
+def redshift_manifest_shard(event=None):
+    """
+    Process one shard of an export's data files, written by `redshift_manifest_creation`
+    when the export has more than `Config.MANIFEST_SHARD_FILES` data files.
+    """
+    response = redshift_manifest_handler.handle_shard(get_s3_client(), event.key)
+    return response
+
+
+@app.on_s3_event(
+    bucket=Config.S3_BUCKET,
+    events=["s3:ObjectCreated:*"],
+    prefix=Config.S3_BUCKET_PREFIX + "dynamodb-export/",
+    suffix=manifest_shards.SHARD_DONE_SUFFIX,
+)
+def redshift_manifest_fan_in(event=None):
+    """
+    Write the redshift manifest of a sharded export, once every shard is done.
+    Runs one at a time (reserved concurrency 1, see .chalice/config.json), so the
+    manifest is only written once.
+    """
+    response = redshift_manifest_handler.handle_fan_in(get_s3_client(), event.key)
+    return response
+
+
 @app.on_s3_event(
     bucket=Config.S3_BUCKET,
     events=["s3:ObjectCreated:*"],
@@ -166,10 +316,103 @@ def redshift_upsert(event=None):
 
     Config.logger.info("file received " + manifest_summary_file)
 
+    if Config.UPSERT_BATCH_MODE:
+        # applied with the other pending manifests by redshift_upsert_batch
+        return redshift_upsert_handler.enqueue(get_s3_client(), manifest_summary_file)
+
+    if Config.UPSERT_ACCUMULATE:
+        manifest_summary_file = upsert_accumulator.accumulate(
+            get_s3_client(), manifest_summary_file
+        )
+        if manifest_summary_file is None:
+            return None  # held, until enough has accumulated
+
+    response = _apply_redshift_manifest(manifest_summary_file)
+    return response
+
+
+def redshift_upsert_batch(event=None):
+    """
+    Apply the manifests queued by `redshift_upsert` in batch mode, or by `redshift_upsert_status`
+    when a Data API upsert failed, in one redshift session, and, in accumulation mode, the
+    manifests held longer than `Config.ACCUMULATE_MAX_AGE_SECONDS`.
+    Only scheduled if one of them is on, see `_is_upsert_batch_enabled`.
+    """
+    if not _is_upsert_batch_enabled():
+        return []
+
+    response = []
+    if Config.UPSERT_ACCUMULATE:
+        for redshift_manifest_file in upsert_accumulator.flush_due(get_s3_client()):
+            response.append(_apply_redshift_manifest(redshift_manifest_file))
+
+    if Config.UPSERT_BATCH_MODE or _is_data_api():
+        response += redshift_upsert_handler.handle_batch(
+            get_s3_client(),
+            get_credentials(),
+            get_redshift_connection,  # intentionally not calling this function
+        )
+    return response
+
+
+def redshift_upsert_status(event=None):
+    """
+    Check the upserts submitted to the Redshift Data API by `redshift_upsert`.
+    Only scheduled with the Data API backend.
+    """
+    if not _is_data_api():
+        return []
+
+    response = redshift_upsert_handler.check_statements(
+        get_s3_client(),
+        get_redshift_data_client(),
+    )
+    return response
+
+
+def _is_data_api():
+    return Config.REDSHIFT_EXECUTION_BACKEND == redshift_upsert_handler.DATA_API
+
+
+def _is_upsert_batch_enabled():
+    return Config.UPSERT_BATCH_MODE or Config.UPSERT_ACCUMULATE or _is_data_api()
+
+
+# the schedules are only deployed when their features are on, so they don't run for nothing
+if _is_upsert_batch_enabled():
+    redshift_upsert_batch = app.schedule(
+        Rate(Config.UPSERT_BATCH_INTERVAL_MINUTES, Rate.MINUTES)
+    )(redshift_upsert_batch)
+if _is_data_api():
+    redshift_upsert_status = app.schedule(
+        Rate(Config.UPSERT_BATCH_INTERVAL_MINUTES, Rate.MINUTES)
+    )(redshift_upsert_status)
+
+
+def _apply_redshift_manifest(redshift_manifest_file):
+    """Apply a redshift manifest with `Config.REDSHIFT_EXECUTION_BACKEND`."""
+    backend = Config.REDSHIFT_EXECUTION_BACKEND
+    if backend not in redshift_upsert_handler.EXECUTION_BACKENDS:
+        raise ValueError(
+            f"Invalid execution backend '{backend}', must be one of {redshift_upsert_handler.EXECUTION_BACKENDS}"
+        )
+
+    if backend == redshift_upsert_handler.DATA_API:
+        # returns once submitted, see redshift_upsert_status
+        return redshift_upsert_handler.handle_async(
+            get_s3_client(),
+            get_redshift_data_client(),
+            get_credentials(),
+            get_redshift_connection,  # intentionally not calling this function
+            redshift_manifest_file,
+        )
+
     response = redshift_upsert_handler.handle(
         get_s3_client(),
         get_credentials(),
         get_redshift_connection,  # intentionally not calling this function
-        manifest_summary_file,
+        redshift_manifest_file,
     )
+    if Config.UPSERT_ACCUMULATE:
+        upsert_accumulator.complete(get_s3_client(), redshift_manifest_file)
     return response
@@ -0,0 +1,91 @@
+import json
+import os
+from typing import Any, List, Union
+from botocore.exceptions import ClientError
+from . import s3_utils
+
+# sub directory of a processed directory that holds the checkpoint of each data file
+CHECKPOINTS_DIR = "checkpoints"
+
+
+def get_checkpoint_path(processed_dir: str, data_file: str) -> str:
+    return f"{processed_dir}/{CHECKPOINTS_DIR}/{os.path.basename(data_file)}.json"
+
+
+def get_etag(s3_client: Any, s3_bucket: str, s3_file_path: str) -> Union[str, None]:
+    """Get the ETag of a file in s3, or None if it doesn't exist."""
+    try:
+        return s3_client.head_object(Bucket=s3_bucket, Key=s3_file_path)["ETag"]
+    except ClientError as ex:
+        if ex.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+
+
+def read_checkpoint(
+    s3_client: Any,
+    s3_bucket: str,
+    processed_dir: str,
+    data_file: str,
+    data_file_etag: str,
+    settings: dict,
+) -> Union[List[str], None]:
+    """
+    Get the processed files of a data file, if it was already processed into `processed_dir`.
+
+    The checkpoint is only valid if it was written for the same data file, with the same
+    ETag and processing settings, and every processed file is still in s3 as written.
+
+    Args:
+        - s3_client: boto3 s3 client
+        - s3_bucket: s3 bucket of the data file and processed files
+        - processed_dir: s3 directory the processed files are written to
+        - data_file: s3 path to the data file
+        - data_file_etag: current ETag of the data file
+        - settings: what the processed files depend on, other than the data file
+
+    Returns:
+        - s3 paths to the processed files, or None if the data file must be processed
+    """
+    checkpoint_path = get_checkpoint_path(processed_dir, data_file)
+    if not s3_utils.exists(s3_client, s3_bucket, checkpoint_path):
+        return None
+    checkpoint = s3_utils.read_json_from_s3(s3_client, s3_bucket, checkpoint_path)
+    if (
+        checkpoint["data_file"] != data_file
+        or checkpoint["etag"] != data_file_etag
+        or checkpoint["settings"] != settings
+    ):
+        return None
+    for processed_file, etag in checkpoint["processed_files"]:
+        if get_etag(s3_client, s3_bucket, processed_file) != etag:
+            return None
+    return [processed_file for processed_file, _ in checkpoint["processed_files"]]
+
+
+def write_checkpoint(
+    s3_client: Any,
+    s3_bucket: str,
+    processed_dir: str,
+    data_file: str,
+    data_file_etag: str,
+    settings: dict,
+    processed_files: List[str],
+) -> str:
+    """Record that a data file has been processed, see `read_checkpoint`. Returns the s3 path to the checkpoint."""
+    checkpoint_path = get_checkpoint_path(processed_dir, data_file)
+    s3_client.put_object(
+        Bucket=s3_bucket,
+        Key=checkpoint_path,
+        Body=json.dumps(
+            {
+                "data_file": data_file,
+                "etag": data_file_etag,
+                "settings": settings,
+                "processed_files": [
+                    [f, get_etag(s3_client, s3_bucket, f)] for f in processed_files
+                ],
+            }
+        ),
+    )
+    return checkpoint_path
@@ -1,6 +1,8 @@
 import os
 import json
 from aws_lambda_powertools import Logger, Tracer
+from .jsonpaths import compile_projection
+from .output_formats import compile_columns
 
 
 class Config:
@@ -17,6 +19,59 @@ class Config:
     # S3 config
     S3_BUCKET = os.environ.get("S3_BUCKET", "dev-ecocart-data-lake")
     S3_BUCKET_PREFIX = os.environ.get("S3_BUCKET_PREFIX", "dev/")
+    MULTIPART_PART_SIZE_BYTES = int(
+        os.environ.get("MULTIPART_PART_SIZE_BYTES", 8 * 1024 * 1024)
+    )
+    # download objects larger than a part with this many concurrent ranged GETs (1 disables)
+    S3_DOWNLOAD_CONCURRENCY = int(os.environ.get("S3_DOWNLOAD_CONCURRENCY", 1))
+    S3_DOWNLOAD_PART_SIZE_BYTES = int(
+        os.environ.get("S3_DOWNLOAD_PART_SIZE_BYTES", 8 * 1024 * 1024)
+    )
+
+    # Manifest creation config
+    MANIFEST_MAX_WORKERS = int(os.environ.get("MANIFEST_MAX_WORKERS", 8))
+    # keep only the latest change per key of incremental exports, see
+    # redshift_manifest_handler._get_latest_changes. Reads every data file twice, and holds
+    # every changed key (and its position) of the export in memory, or of a shard
+    COMPACT_INCREMENTAL_CHANGES = (
+        os.environ.get("COMPACT_INCREMENTAL_CHANGES", "false").lower() == "true"
+    )
+    # drop updates that don't change any column loaded, see redshift_manifest_handler._is_noop_update
+    DROP_NOOP_UPDATES = os.environ.get("DROP_NOOP_UPDATES", "false").lower() == "true"
+    # write deletes to key-only files, and upserts shaped like the target, loaded separately
+    SPLIT_INCREMENTAL_DELETES = (
+        os.environ.get("SPLIT_INCREMENTAL_DELETES", "false").lower() == "true"
+    )
+    # if > 0, re-chunk processed rows into sets of this many files, e.g. the number of redshift slices
+    REDSHIFT_SLICE_COUNT = int(os.environ.get("REDSHIFT_SLICE_COUNT", 0))
+    PROCESSED_FILE_TARGET_BYTES = int(
+        os.environ.get("PROCESSED_FILE_TARGET_BYTES", 256 * 1024 * 1024)
+    )
+    # if > 0, exports with more data files than this are processed in shards of this many files,
+    # each by its own lambda invocation, see redshift_manifest_handler.handle_shard. With
+    # COMPACT_INCREMENTAL_CHANGES, the shards index the latest change per key first, see
+    # redshift_manifest_handler._write_index_shards
+    MANIFEST_SHARD_FILES = int(os.environ.get("MANIFEST_SHARD_FILES", 0))
+    # load only the items of a full export that changed since the last one, see chalicelib/digest_index.py
+    DIFF_FULL_EXPORTS = os.environ.get("DIFF_FULL_EXPORTS", "false").lower() == "true"
+    # fail full exports too large to diff, the last index is held at 16 bytes per item
+    DIFF_FULL_EXPORTS_MAX_ITEMS = int(
+        os.environ.get("DIFF_FULL_EXPORTS_MAX_ITEMS", 200_000_000)
+    )
+    # skip data files already processed by an earlier attempt, see chalicelib/checkpoints.py
+    CHECKPOINT_PROCESSED_FILES = (
+        os.environ.get("CHECKPOINT_PROCESSED_FILES", "false").lower() == "true"
+    )
+    # json (gzipped dynamodb json) or parquet (requires pyarrow)
+    OUTPUT_FORMAT = os.environ.get("OUTPUT_FORMAT", "json").lower()
+    # apply a backlog of incremental exports (>24 hours behind) to redshift as one
+    COALESCE_BACKLOG_EXPORTS = (
+        os.environ.get("COALESCE_BACKLOG_EXPORTS", "false").lower() == "true"
+    )
+    # fail a backlog still waiting for one of its exports this long after it was submitted
+    COALESCE_GROUP_TIMEOUT_MINUTES = int(
+        os.environ.get("COALESCE_GROUP_TIMEOUT_MINUTES", 360)
+    )
 
     # Reshift config
     REDSHIFT_CLUSTER = os.environ.get("REDSHIFT_CLUSTER")
@@ -26,19 +81,106 @@ class Config:
     REDSHIFT_PASSWORD = os.environ.get("REDSHIFT_PASSWORD")
     REDSHIFT_HOSTNAME = os.environ.get("REDSHIFT_HOSTNAME")
     REDSHIFT_PORT = os.environ.get("REDSHIFT_PORT")
-    # REDSHIFT_SECRET_ID = os.environ.get("REDSHIFT_SECRET_ID", "secret_name_in_secret_manager")
-    # REDSHIFT_IAM_ROLE = os.environ.get("REDSHIFT_IAM_ROLE", "better to use IAM role vs username/password")
+    REDSHIFT_SECRET_ID = os.environ.get(
+        "REDSHIFT_SECRET_ID", "secret_name_in_secret_manager"
+    )
+    # run upserts on a psycopg2 connection ("psycopg2"), or submit them to the Redshift Data API ("data_api")
+    REDSHIFT_EXECUTION_BACKEND = os.environ.get(
+        "REDSHIFT_EXECUTION_BACKEND", "psycopg2"
+    ).lower()
+    # how full exports replace the table: insert, swap or append, see redshift_upsert_handler.py.
+    # Only swap never shows readers an empty table: append empties it until the new rows are in
+    FULL_REFRESH_STRATEGY = os.environ.get("FULL_REFRESH_STRATEGY", "insert").lower()
+    # queue manifests and apply them in batches, in one session, on a schedule
+    UPSERT_BATCH_MODE = os.environ.get("UPSERT_BATCH_MODE", "false").lower() == "true"
+    UPSERT_BATCH_INTERVAL_MINUTES = int(
+        os.environ.get("UPSERT_BATCH_INTERVAL_MINUTES", 5)
+    )
+    # hold incremental manifests per table, and apply them as one once any threshold is reached
+    UPSERT_ACCUMULATE = os.environ.get("UPSERT_ACCUMULATE", "false").lower() == "true"
+    ACCUMULATE_MIN_ITEMS = int(os.environ.get("ACCUMULATE_MIN_ITEMS", 10_000))
+    ACCUMULATE_MIN_BYTES = int(os.environ.get("ACCUMULATE_MIN_BYTES", 64 * 1024 * 1024))
+    ACCUMULATE_MAX_AGE_SECONDS = float(
+        os.environ.get("ACCUMULATE_MAX_AGE_SECONDS", 900)
+    )
+    # commit each manifest of a batch on its own ("table"), or all together ("group")
+    UPSERT_BATCH_COMMIT = os.environ.get("UPSERT_BATCH_COMMIT", "table").lower()
+    # keep the redshift connection open between warm lambda invocations
+    REDSHIFT_REUSE_CONNECTION = (
+        os.environ.get("REDSHIFT_REUSE_CONNECTION", "false").lower() == "true"
+    )
+    REDSHIFT_CONNECTION_MAX_AGE_SECONDS = float(
+        os.environ.get("REDSHIFT_CONNECTION_MAX_AGE_SECONDS", 900)
+    )
+    # apply incremental exports in export window order, tracked in a ledger, see export_ledger.py
+    ORDERED_APPLY = os.environ.get("ORDERED_APPLY", "false").lower() == "true"
+    # prefix of the tables recording the exports applied to each target, suffixed with the target table name,
+    # defaults to <REDSHIFT_TARGET_SCHEMA>.dynamodb_export_ledger
+    REDSHIFT_LEDGER_TABLE = os.environ.get("REDSHIFT_LEDGER_TABLE")
+    # IAM role the COPY reads s3 with, rather than the access keys of the credentials.
+    # Required with the data_api backend, which keeps the sql where the keys would be readable
+    REDSHIFT_IAM_ROLE = os.environ.get("REDSHIFT_IAM_ROLE")
+
+    # Metrics config, published as CloudWatch embedded metrics, see metrics.py
+    METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "false").lower() == "true"
+    METRICS_NAMESPACE = os.environ.get(
+        "POWERTOOLS_METRICS_NAMESPACE", "DynamoDbRedshift"
+    )
+
+    # Cache config, for values kept between warm lambda invocations (0 disables)
+    SECRETS_CACHE_TTL_SECONDS = float(os.environ.get("SECRETS_CACHE_TTL_SECONDS", 300))
+    # opt-in, as the watermark is the source of truth: a cached one is only used while the
+    # s3 object's ETag is unchanged, which still costs a HEAD request per table
+    WATERMARK_CACHE_TTL_SECONDS = float(
+        os.environ.get("WATERMARK_CACHE_TTL_SECONDS", 0)
+    )
+    # only whether the ORDERED_APPLY ledger table exists in Redshift
+    TABLE_METADATA_CACHE_TTL_SECONDS = float(
+        os.environ.get("TABLE_METADATA_CACHE_TTL_SECONDS", 3600)
+    )
 
     # Dynamo DB config
     with open(os.path.join(os.path.dirname(__file__), "dynamodb_exports.json")) as f:
         dynamodb_exports = json.load(f)
 
     TABLE_ARN_PREFIX = os.environ.get("TABLE_ARN_PREFIX")
+    EXPORT_MAX_WORKERS = int(os.environ.get("EXPORT_MAX_WORKERS", 8))
+    EXPORT_SUBMISSION_INTERVAL_SECONDS = float(
+        os.environ.get("EXPORT_SUBMISSION_INTERVAL_SECONDS", 10)
+    )
     FULL_EXPORT_TABLES = dynamodb_exports["full_export"][AWS_STAGE_ENV]
     INCREMENTAL_EXPORT_TABLES = dynamodb_exports["incremental_export"][AWS_STAGE_ENV]
+    # minutes between runs of dynamodb_incremental_export
+    INCREMENTAL_EXPORT_INTERVAL_MINUTES = int(
+        os.environ.get("INCREMENTAL_EXPORT_INTERVAL_MINUTES", 15)
+    )
+    # export each table once due, from its change rate, see export_schedule.py
+    ADAPTIVE_EXPORT_SCHEDULE = (
+        os.environ.get("ADAPTIVE_EXPORT_SCHEDULE", "false").lower() == "true"
+    )
+    # dynamodb incremental exports must cover at least 15 minutes
+    EXPORT_MIN_INTERVAL_MINUTES = max(
+        int(os.environ.get("EXPORT_MIN_INTERVAL_MINUTES", 15)), 15
+    )
+    EXPORT_MAX_INTERVAL_MINUTES = int(
+        os.environ.get("EXPORT_MAX_INTERVAL_MINUTES", 240)
+    )
+    EXPORT_TARGET_ITEMS = int(os.environ.get("EXPORT_TARGET_ITEMS", 100000))
+    EXPORT_TARGET_BYTES = int(os.environ.get("EXPORT_TARGET_BYTES", 256 * 1024 * 1024))
 
     # Mapping config
     with open(os.path.join(os.path.dirname(__file__), "table_mapping.json")) as f:
         table_mapping = json.load(f)
 
     TABLE_DETAILS = table_mapping
+
+    # jsonpaths compiled once, so processing only keeps the attributes Redshift loads
+    TABLE_PROJECTIONS = {
+        table: compile_projection(details["jsonpaths"])
+        for table, details in TABLE_DETAILS.items()
+    }
+    # typed columns, for flattened output formats (parquet)
+    TABLE_COLUMNS = {
+        table: compile_columns(details["jsonpaths"], details.get("parquet_types"))
+        for table, details in TABLE_DETAILS.items()
+    }
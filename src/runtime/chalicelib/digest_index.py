@@ -0,0 +1,219 @@
+import hashlib
+import heapq
+import json
+from array import array
+from bisect import bisect_left
+from typing import Any, Callable, Iterator, List, Tuple, Union
+from . import s3_utils
+
+# most sorted runs read at once when merging them, see `write_index`
+MERGE_FAN_IN = 64
+
+
+def get_current_path(table_s3_prefix: str) -> str:
+    """s3 path to the pointer to the digest index of the last full export applied to Redshift."""
+    return f"{table_s3_prefix}/digest-index/current.json"
+
+
+def get_key_hash(key: str) -> int:
+    """The hash of an item's key that the index is sorted by."""
+    return int.from_bytes(
+        hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big"
+    )
+
+
+def format_line(key: str, digest: str) -> str:
+    """
+    A line of a digest index or run, `<key hash>\\t<key>\\t<digest>`. Keys are compact json,
+    so have no tabs, and the key hash is fixed width hex, so lines sort by key hash then key.
+    """
+    return f"{get_key_hash(key):016x}\t{key}\t{digest}"
+
+
+def read_current(
+    s3_client: Any,
+    s3_bucket: str,
+    table_s3_prefix: str,
+) -> Union[str, None]:
+    """
+    Get the s3 path to the digest index of the last full export applied to Redshift,
+    or None if there isn't one yet.
+    """
+    current_path = get_current_path(table_s3_prefix)
+    if not s3_utils.exists(s3_client, s3_bucket, current_path):
+        return None
+    return s3_utils.read_json_from_s3(s3_client, s3_bucket, current_path)["index"]
+
+
+def iter_index(
+    s3_client: Any,
+    s3_bucket: str,
+    index_path: str,
+) -> Iterator[Tuple[str, str]]:
+    """Stream the (key, digest) of each item of a digest index, in index order."""
+    for line in _iter_index_lines(s3_client, s3_bucket, index_path):
+        _, key, digest = line.split("\t")
+        yield key, digest
+
+
+class DigestLookup:
+    """
+    The digests of a digest index by key hash, in two sorted arrays of 8 byte integers,
+    so at 16 bytes per item rather than as a dict of strings.
+    """
+
+    def __init__(self, s3_client: Any, s3_bucket: str, index_path: str):
+        self.key_hashes = array("Q")
+        self.digests = array("Q")
+        for line in _iter_index_lines(s3_client, s3_bucket, index_path):
+            key_hash, _, digest = line.split("\t")
+            self.key_hashes.append(int(key_hash, 16))
+            self.digests.append(int(digest, 16))
+
+    def __len__(self) -> int:
+        return len(self.key_hashes)
+
+    def contains(self, key: str, digest: str) -> bool:
+        """Whether the index has an item with this key and digest."""
+        key_hash = get_key_hash(key)
+        digest = int(digest, 16)
+        index = bisect_left(self.key_hashes, key_hash)
+        while index < len(self.key_hashes) and self.key_hashes[index] == key_hash:
+            if self.digests[index] == digest:
+                return True
+            index += 1
+        return False
+
+
+def write_run(
+    s3_client: Any,
+    s3_bucket: str,
+    run_path: str,
+    lines: List[str],
+) -> bool:
+    """
+    Sort the index lines of part of an export, see `format_line`, into a run for `write_index`.
+    Returns False, and writes nothing, if there are no lines.
+    """
+    lines.sort()
+    with s3_utils.S3GzipWriter(s3_client, s3_bucket, run_path) as writer:
+        for line in lines:
+            writer.write_line(line)
+    return writer.rows > 0
+
+
+def write_index(
+    s3_client: Any,
+    s3_bucket: str,
+    table_s3_prefix: str,
+    export_s3_directory: str,
+    run_paths: List[str],
+    previous_index_path: str = None,
+    on_deleted: Callable[[str], None] = None,
+) -> dict:
+    """
+    Merge the sorted runs of a full export, see `write_run`, into its digest index, as gzipped
+    sorted lines, nothing if it is empty. It is only diffed against once promoted, see
+    `promote`, after the export has been applied.
+
+    Runs and indexes are streamed, at most `MERGE_FAN_IN` at a time, so merging holds a few
+    lines in memory whatever the size of the export.
+
+    Args:
+        - s3_client: boto3 s3 client
+        - s3_bucket: s3 bucket the export is in
+        - table_s3_prefix: s3 prefix of the exported table
+        - export_s3_directory: s3 directory of the export
+        - run_paths: s3 paths to the sorted runs of the export
+        - previous_index_path: digest index of the last full export applied, to find deletes
+        - on_deleted: called with the key of each item of the previous index not in the export
+
+    Returns:
+        - the digest index, to add to the redshift manifest for `promote`
+    """
+    index_path = f"{export_s3_directory}/digest-index.gz"
+    run_paths = _merge_runs(s3_client, s3_bucket, run_paths, index_path)
+    lines = heapq.merge(
+        *(s3_utils.iter_lines_from_s3(s3_client, s3_bucket, p) for p in run_paths)
+    )
+    previous = None
+    if previous_index_path is not None and on_deleted is not None:
+        previous = _iter_index_lines(s3_client, s3_bucket, previous_index_path)
+    with s3_utils.S3GzipWriter(s3_client, s3_bucket, index_path) as writer:
+        for line in _diff_keys(lines, previous, on_deleted):
+            writer.write_line(line)
+    return {"index": index_path, "current": get_current_path(table_s3_prefix)}
+
+
+def promote(s3_client: Any, s3_bucket: str, digest_index: dict):
+    """Make a digest index, see `write_index`, the one the next full export is diffed against."""
+    s3_client.put_object(
+        Bucket=s3_bucket,
+        Key=digest_index["current"],
+        Body=json.dumps({"index": digest_index["index"]}),
+    )
+
+
+def complete(s3_client: Any, s3_bucket: str, redshift_manifest_file: str):
+    """Promote the digest index of a redshift manifest, if any, once it has been applied."""
+    redshift_manifest = s3_utils.read_json_from_s3(
+        s3_client, s3_bucket, redshift_manifest_file
+    )
+    if redshift_manifest.get("digest_index"):
+        promote(s3_client, s3_bucket, redshift_manifest["digest_index"])
+
+
+def _iter_index_lines(s3_client: Any, s3_bucket: str, index_path: str) -> Iterator[str]:
+    if not s3_utils.exists(s3_client, s3_bucket, index_path):
+        return  # the export was empty, see `write_index`
+    yield from s3_utils.iter_lines_from_s3(s3_client, s3_bucket, index_path)
+
+
+def _merge_runs(
+    s3_client: Any,
+    s3_bucket: str,
+    run_paths: List[str],
+    index_path: str,
+) -> List[str]:
+    """Merge runs into fewer, longer ones until there are at most `MERGE_FAN_IN`."""
+    level = 0
+    while len(run_paths) > MERGE_FAN_IN:
+        merged_paths = []
+        for start in range(0, len(run_paths), MERGE_FAN_IN):
+            merged_path = f"{index_path}.runs/{level}-{start}.gz"
+            lines = heapq.merge(
+                *(
+                    s3_utils.iter_lines_from_s3(s3_client, s3_bucket, p)
+                    for p in run_paths[start : start + MERGE_FAN_IN]
+                )
+            )
+            with s3_utils.S3GzipWriter(s3_client, s3_bucket, merged_path) as writer:
+                for line in lines:
+                    writer.write_line(line)
+            merged_paths.append(merged_path)
+        run_paths = merged_paths
+        level += 1
+    return run_paths
+
+
+def _diff_keys(
+    lines: Iterator[str],
+    previous: Union[Iterator[str], None],
+    on_deleted: Union[Callable[[str], None], None],
+) -> Iterator[str]:
+    """Pass through the sorted lines of an export, calling `on_deleted` for the keys of `previous` not in it."""
+    if previous is None:
+        yield from lines
+        return
+    previous_line = next(previous, None)
+    for line in lines:
+        key = line.rsplit("\t", 1)[0]
+        while previous_line is not None and previous_line.rsplit("\t", 1)[0] < key:
+            on_deleted(previous_line.split("\t")[1])
+            previous_line = next(previous, None)
+        if previous_line is not None and previous_line.rsplit("\t", 1)[0] == key:
+            previous_line = next(previous, None)
+        yield line
+    while previous_line is not None:
+        on_deleted(previous_line.split("\t")[1])
+        previous_line = next(previous, None)
@@ -1,42 +1,67 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import time
 from aws_lambda_powertools import Logger
-from typing import List, Union, Any
-from . import s3_utils
+from typing import Dict, List, Union, Any
+from . import (
+    checkpoints,
+    export_groups,
+    export_ledger,
+    export_schedule,
+    metrics,
+    s3_utils,
+)
 from .config import Config
+from .ttl_cache import TTLCache
 
 logger = Logger()
 
+# (ETag, last export time) by (bucket, path), kept up to date as exports are submitted
+_WATERMARK_CACHE = TTLCache(ttl_seconds=Config.WATERMARK_CACHE_TTL_SECONDS)
+
 
 def handle(
     dynamodb_client: Any,
     s3_client: Any,
     tables: Union[str, List[str]],
     is_incremental: bool = False,
-    s3_bucket: str = Config.s3_bucket,
+    s3_bucket: str = None,
     export_time: datetime = None,
     export_from_datetime: datetime = None,
 ) -> Union[Any, List[Any]]:
     """
     Handle backup, or incremental export, of tables from dynamodb to s3.
 
+    Tables are exported concurrently, with at most `Config.EXPORT_MAX_WORKERS` in flight.
+    If a table has a backlog of more than 24 hours, its exports are submitted in rounds,
+    one per 24 hour period, `Config.EXPORT_SUBMISSION_INTERVAL_SECONDS` apart, so tables
+    without a backlog are submitted in the first round and never wait for it.
+    With `Config.ORDERED_APPLY` the rounds are submitted back to back, and each incremental
+    export is recorded in the table's ledger so they are applied to Redshift in order. Exports
+    in the ledger that failed in DynamoDB are submitted again first, see `_resubmit_failed_exports`,
+    as are those of a backlog waiting to be coalesced, see `_check_pending_groups`.
+    With `Config.ADAPTIVE_EXPORT_SCHEDULE`, tables are only exported incrementally once due,
+    see `export_schedule.is_due`.
+
     Args:
         - dynamodb_client: boto3 dynamodb client
         - s3_client: boto3 s3 client
         - tables: list of tables to export, or single table
         - is_incremental: whether to export incrementally
-        - s3_bucket: s3 bucket to export to
+        - s3_bucket: s3 bucket to export to, defaults to `Config.S3_BUCKET`
         - export_time: datetime to export to, defaults to now
         - export_from_datetime: datetime to export from (incremental mode only), if None looks it up from s3
 
     Returns:
         - list of responses from dynamodb export, or single reponse if single table
+          (None if it wasn't due an export)
 
     Raises:
         - ValueError: if no tables to export
         - Exception: if any error found backing up tables
     """
     export_time = export_time or datetime.now()
+    s3_bucket = s3_bucket or Config.S3_BUCKET
 
     if not tables:
         raise ValueError("No tables to export")
@@ -45,79 +70,423 @@ def handle(
     if is_single_table:
         tables = [tables]
 
-    errors = []
-    responses = []
+    errors = {}
+    table_exports = {}
+    responses = {table: [] for table in tables}
+    table_metrics = {
+        table: metrics.StageMetrics("dynamodb_export", table) for table in tables
+    }
 
-    for table in tables:
+    def plan(table):
         try:
-            if not is_incremental:
-                logger.info(f"backing up table {table}")
-                table_s3_prefix = (
-                    f"{Config.s3_bucket_prefix}/dynamodb-export/full-export/{table}"
+            resubmitted = {}
+            if is_incremental and Config.ORDERED_APPLY:
+                resubmitted = _resubmit_failed_exports(
+                    dynamodb_client=dynamodb_client,
+                    s3_client=s3_client,
+                    s3_bucket=s3_bucket,
+                    table=table,
+                    export_time=export_time,
                 )
-                response = dynamodb_client.export_table_to_point_in_time(
+            if is_incremental and Config.COALESCE_BACKLOG_EXPORTS:
+                resubmitted.update(
+                    _check_pending_groups(
+                        dynamodb_client=dynamodb_client,
+                        s3_client=s3_client,
+                        s3_bucket=s3_bucket,
+                        table=table,
+                        export_time=export_time,
+                        resubmitted=resubmitted,
+                    )
+                )
+            table_metrics[table].add("ExportsResubmitted", len(resubmitted))
+            table_exports[table] = _get_table_exports(
+                s3_client=s3_client,
+                table=table,
+                is_incremental=is_incremental,
+                s3_bucket=s3_bucket,
+                export_time=export_time,
+                export_from_datetime=export_from_datetime,
+            )
+            table_metrics[table].add(
+                "ExportPeriods", len(table_exports[table]["specs"])
+            )
+        except Exception as ex:
+            # don't throw here, attempt other tables first
+            logger.error(f"Error when backing up or exporting table {table}: {ex}")
+            errors[table] = ex
+            table_metrics[table].add("ExportErrors", 1)
+
+    def submit(table, round_index):
+        start = time.perf_counter()
+        try:
+            response = _submit_export(
+                dynamodb_client=dynamodb_client,
+                s3_client=s3_client,
+                s3_bucket=s3_bucket,
+                table_export=table_exports[table],
+                spec=table_exports[table]["specs"][round_index],
+            )
+            responses[table].append(response)
+            table_metrics[table].add("ExportsSubmitted", 1)
+        except Exception as ex:
+            # don't throw here, attempt other tables first, but stop exporting this
+            # table so its exports stay in order
+            logger.error(f"Error when backing up or exporting table {table}: {ex}")
+            errors[table] = ex
+            table_metrics[table].add("ExportErrors", 1)
+        finally:
+            table_metrics[table].add_seconds(
+                "SubmitExport", time.perf_counter() - start
+            )
+
+    with ThreadPoolExecutor(max_workers=Config.EXPORT_MAX_WORKERS) as executor:
+        list(executor.map(plan, tables))
+
+        rounds = max((len(e["specs"]) for e in table_exports.values()), default=0)
+        for round_index in range(rounds):
+            if round_index > 0:
+                # pause between periods of a backlog to keep them in order, unless the
+                # backlog is coalesced, or applied in order by the ledger, which order
+                # changes themselves
+                if not (Config.COALESCE_BACKLOG_EXPORTS or Config.ORDERED_APPLY):
+                    time.sleep(Config.EXPORT_SUBMISSION_INTERVAL_SECONDS)
+            round_tables = [
+                table
+                for table in tables
+                if table not in errors
+                and table in table_exports
+                and len(table_exports[table]["specs"]) > round_index
+            ]
+            list(executor.map(lambda t: submit(t, round_index), round_tables))
+
+    for table, table_export in table_exports.items():
+        if (
+            len(table_export["specs"]) > 1
+            and Config.COALESCE_BACKLOG_EXPORTS
+            and table not in errors
+        ):
+            # apply the backlog to redshift as one, once every export has completed
+            export_groups.write_group(
+                s3_client=s3_client,
+                s3_bucket=s3_bucket,
+                table_s3_prefix=table_export["table_s3_prefix"],
+                export_ids=[
+                    export_groups.get_export_id(r["ExportDescription"]["ExportArn"])
+                    for r in responses[table]
+                ],
+                export_windows=[
+                    (
+                        spec["IncrementalExportSpecification"]["ExportFromTime"],
+                        spec["IncrementalExportSpecification"]["ExportToTime"],
+                    )
+                    for spec in table_export["specs"]
+                ],
+                submitted_at=export_time,
+            )
+
+    for stage_metrics in table_metrics.values():
+        stage_metrics.flush()
+    with metrics.StageMetrics("dynamodb_export") as stage_metrics:
+        stage_metrics.add_cache("Watermark", _WATERMARK_CACHE)
+
+    if errors:
+        first_error = next(errors[table] for table in tables if table in errors)
+        raise Exception(
+            f"{len(errors)} of {len(tables)} tables failed backing up from DynamoDB to s3 (incremental={is_incremental}). See logs for more details."
+        ) from first_error
+
+    responses = [r for table in tables for r in responses[table]]
+    if is_single_table:
+        return (
+            responses[0] if responses else None
+        )  # None if not due, see `_get_table_exports`
+    return responses
+
+
+def _get_table_exports(
+    s3_client: Any,
+    table: str,
+    is_incremental: bool,
+    s3_bucket: str,
+    export_time: datetime,
+    export_from_datetime: datetime = None,
+) -> dict:
+    """
+    Get the exports to submit for a table: its s3 prefix, and the arguments of each
+    `export_table_to_point_in_time` call in the order they must be submitted.
+    """
+    if not is_incremental:
+        logger.info(f"backing up table {table}")
+        table_s3_prefix = (
+            f"{Config.S3_BUCKET_PREFIX}dynamodb-export/full-export/{table}"
+        )
+        return {
+            "table_s3_prefix": table_s3_prefix,
+            "last_export_s3_path": None,
+            "specs": [
+                dict(
                     S3Bucket=s3_bucket,
                     S3Prefix=table_s3_prefix,
-                    TableArn=Config.table_arn_prefix + table,
+                    TableArn=Config.TABLE_ARN_PREFIX + table,
                     ExportTime=export_time,
                     S3SseAlgorithm="AES256",
                     ExportFormat="DYNAMODB_JSON",
                     ExportType="FULL_EXPORT",
                 )
-                responses.append(response)
+            ],
+        }
+
+    logger.info(f"incrementally exporting table {table}")
+    table_s3_prefix = (
+        f"{Config.S3_BUCKET_PREFIX}dynamodb-export/incremental-export/{table}"
+    )
+    last_export_s3_path = f"{table_s3_prefix}/last-export-time.txt"
+    is_scheduled = export_from_datetime is None and Config.ADAPTIVE_EXPORT_SCHEDULE
+    export_from_datetime = export_from_datetime or _get_last_export_to_datetime(
+        s3_client=s3_client,
+        s3_bucket=s3_bucket,
+        last_export_s3_path=last_export_s3_path,
+    )
+    if is_scheduled and not export_schedule.is_due(
+        s3_client=s3_client,
+        s3_bucket=s3_bucket,
+        table_s3_prefix=table_s3_prefix,
+        last_export_to_time=export_from_datetime,
+        export_time=export_time,
+    ):
+        logger.info(f"table {table} is not due an export yet")
+        specs = []
+    else:
+        specs = _get_incremental_export_specifications(
+            from_time=export_from_datetime,
+            to_time=export_time,
+        )
+    return {
+        "table_s3_prefix": table_s3_prefix,
+        "last_export_s3_path": last_export_s3_path,
+        "specs": [
+            dict(
+                S3Bucket=s3_bucket,
+                S3Prefix=table_s3_prefix,
+                TableArn=Config.TABLE_ARN_PREFIX + table,
+                ExportTime=export_time,
+                S3SseAlgorithm="AES256",
+                ExportFormat="DYNAMODB_JSON",
+                ExportType="INCREMENTAL_EXPORT",
+                IncrementalExportSpecification=spec,
+            )
+            for spec in specs
+        ],
+    }
+
+
+def _resubmit_failed_exports(
+    dynamodb_client: Any,
+    s3_client: Any,
+    s3_bucket: str,
+    table: str,
+    export_time: datetime,
+) -> Dict[str, str]:
+    """
+    Submit the window of each export in the table's ledger that failed in DynamoDB again, and
+    replace it in the ledger, so it doesn't hold every later window of the table forever.
+
+    Returns:
+        - the arn of each export submitted again, by the arn of the export that failed
+    """
+    table_s3_prefix = (
+        f"{Config.S3_BUCKET_PREFIX}dynamodb-export/incremental-export/{table}"
+    )
+    resubmitted = {}
+    for entry in export_ledger.list_entries(s3_client, s3_bucket, table_s3_prefix):
+        if entry["Status"] != export_ledger.SUBMITTED:
+            continue
+        if not _is_export_failed(dynamodb_client, table, entry["ExportArn"]):
+            continue
+        export_from_time = export_ledger.parse_datetime(entry["ExportFromTime"])
+        export_to_time = export_ledger.parse_datetime(entry["ExportToTime"])
+        response = dynamodb_client.export_table_to_point_in_time(
+            **_get_incremental_export_spec(
+                s3_bucket, table, export_time, export_from_time, export_to_time
+            )
+        )
+        export_ledger.record_submitted(
+            s3_client=s3_client,
+            s3_bucket=s3_bucket,
+            table_s3_prefix=table_s3_prefix,
+            export_arn=response["ExportDescription"]["ExportArn"],
+            export_from_time=export_from_time,
+            export_to_time=export_to_time,
+        )
+        export_ledger.remove_entries(s3_client, s3_bucket, table_s3_prefix, [entry])
+        resubmitted[entry["ExportArn"]] = response["ExportDescription"]["ExportArn"]
+    return resubmitted
+
+
+def _check_pending_groups(
+    dynamodb_client: Any,
+    s3_client: Any,
+    s3_bucket: str,
+    table: str,
+    export_time: datetime,
+    resubmitted: Dict[str, str],
+) -> Dict[str, str]:
+    """
+    Check the backlogs of the table waiting to be coalesced, see `export_groups.write_group`,
+    as a backlog is only applied once every one of its exports has completed.
 
+    An export of a backlog that failed in DynamoDB is submitted again, and replaced in its group.
+    A backlog still incomplete `Config.COALESCE_GROUP_TIMEOUT_MINUTES` after it was submitted
+    raises an exception, as do failed exports that can't be submitted again.
+
+    Args:
+        - resubmitted: exports already submitted again by `_resubmit_failed_exports`, by the
+          arn of the export that failed
+
+    Returns:
+        - the arn of each export submitted again, by the arn of the export that failed
+    """
+    table_s3_prefix = (
+        f"{Config.S3_BUCKET_PREFIX}dynamodb-export/incremental-export/{table}"
+    )
+    table_resubmitted = {}
+    for group in export_groups.list_pending_groups(
+        s3_client, s3_bucket, table_s3_prefix
+    ):
+        export_ids = list(group["export_ids"])
+        pending = []
+        for index, export_id in enumerate(export_ids):
+            if s3_utils.exists(
+                s3_client,
+                s3_bucket,
+                export_groups.get_manifest_summary_path(table_s3_prefix, export_id),
+            ):
+                continue
+            export_arn = f"{Config.TABLE_ARN_PREFIX}{table}/export/{export_id}"
+            if export_arn in resubmitted:
+                new_export_arn = resubmitted[export_arn]
+            elif not _is_export_failed(dynamodb_client, table, export_arn):
+                pending.append(export_id)
+                continue
+            elif group["export_windows"] is None:
+                raise Exception(
+                    f"Export {export_id} of the backlog {group['export_ids']} of table {table} failed, "
+                    "and has no export window to submit it again"
+                )
             else:
-                logger.info(f"incrementally exporting table {table}")
-                table_s3_prefix = f"{Config.s3_bucket_prefix}/dynamodb-export/incremental-export/{table}"
-                last_export_s3_path = f"{table_s3_prefix}/last-export-time.txt"
-                last_export_to_datetime = _get_last_export_to_datetime(
-                    s3_client=s3_client,
-                    s3_bucket=s3_bucket,
-                    last_export_s3_path=last_export_s3_path,
+                export_from_time, export_to_time = (
+                    export_groups.parse_datetime(t)
+                    for t in group["export_windows"][index]
                 )
-                export_from_datetime = export_from_datetime or last_export_to_datetime
-
-                specs = _get_incremental_export_specifications(
-                    from_time=export_from_datetime,
-                    to_time=export_time,
+                response = dynamodb_client.export_table_to_point_in_time(
+                    **_get_incremental_export_spec(
+                        s3_bucket, table, export_time, export_from_time, export_to_time
+                    )
                 )
+                new_export_arn = response["ExportDescription"]["ExportArn"]
+                table_resubmitted[export_arn] = new_export_arn
+            export_ids[index] = export_groups.get_export_id(new_export_arn)
+            pending.append(export_ids[index])
 
-                for spec in specs:
-                    response = dynamodb_client.export_table_to_point_in_time(
-                        S3Bucket=s3_bucket,
-                        S3Prefix=table_s3_prefix,
-                        TableArn=Config.table_arn_prefix + table,
-                        ExportTime=export_time,
-                        S3SseAlgorithm="AES256",
-                        ExportFormat="DYNAMODB_JSON",
-                        ExportType="INCREMENTAL_EXPORT",
-                        IncrementalExportSpecification=spec,
-                    )
-                    responses.append(response)
+        submitted_at = export_groups.parse_datetime(group["submitted_at"])
+        if export_ids != group["export_ids"]:
+            # the backlog waits for the exports submitted again from now
+            submitted_at = export_time
+            export_groups.write_group(
+                s3_client=s3_client,
+                s3_bucket=s3_bucket,
+                table_s3_prefix=table_s3_prefix,
+                export_ids=export_ids,
+                export_windows=[
+                    [export_groups.parse_datetime(t) for t in window]
+                    for window in group["export_windows"]
+                ]
+                if group["export_windows"] is not None
+                else None,
+                submitted_at=submitted_at,
+                group_id=group["group_id"],
+            )
+        if pending and export_time - submitted_at > timedelta(
+            minutes=Config.COALESCE_GROUP_TIMEOUT_MINUTES
+        ):
+            raise Exception(
+                f"Backlog {export_ids} of table {table} is still waiting for exports {pending}, "
+                f"submitted at {group['submitted_at']}"
+            )
+    return table_resubmitted
 
-                    # update the last export time
-                    if export_time > last_export_to_datetime:
-                        s3_client.put_object(
-                            Bucket=s3_bucket,
-                            Key=last_export_s3_path,
-                            Body=export_time.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
-                        )
 
-                    # If multiple specs, add a pause to ensure ordering
-                    if len(specs) > 1:
-                        time.sleep(10)
+def _is_export_failed(dynamodb_client: Any, table: str, export_arn: str) -> bool:
+    export_description = dynamodb_client.describe_export(ExportArn=export_arn)[
+        "ExportDescription"
+    ]
+    if export_description["ExportStatus"] != "FAILED":
+        return False
+    logger.warning(
+        f"export {export_arn} of table {table} failed "
+        f"({export_description.get('FailureMessage')}), submitting it again"
+    )
+    return True
 
-        except Exception as ex:
-            # don't throw here, attempt other tables first
-            logger.error(f"Error when backing up or exporting table {table}: {ex}")
-            errors.append({"Table": table, "Exception": ex})
 
-    if errors:
-        raise Exception(
-            f"1 or more errors found backing up tables from DynamoDB to s3 (incremental={is_incremental}). See logs for more details."
-        ) from errors[0]["Exception"]
+def _get_incremental_export_spec(
+    s3_bucket: str,
+    table: str,
+    export_time: datetime,
+    export_from_time: datetime,
+    export_to_time: datetime,
+) -> dict:
+    """Get the arguments of `export_table_to_point_in_time` to export a window of a table."""
+    return dict(
+        S3Bucket=s3_bucket,
+        S3Prefix=f"{Config.S3_BUCKET_PREFIX}dynamodb-export/incremental-export/{table}",
+        TableArn=Config.TABLE_ARN_PREFIX + table,
+        ExportTime=export_time,
+        S3SseAlgorithm="AES256",
+        ExportFormat="DYNAMODB_JSON",
+        ExportType="INCREMENTAL_EXPORT",
+        IncrementalExportSpecification={
+            "ExportFromTime": export_from_time,
+            "ExportToTime": export_to_time,
+            "ExportViewType": "NEW_AND_OLD_IMAGES",
+        },
+    )
+
 
-    return responses[0] if is_single_table else responses
+def _submit_export(
+    dynamodb_client: Any,
+    s3_client: Any,
+    s3_bucket: str,
+    table_export: dict,
+    spec: dict,
+) -> Any:
+    """Submit one export, then move the table's last export time on to the end of its period."""
+    response = dynamodb_client.export_table_to_point_in_time(**spec)
+
+    # update the last export time
+    if table_export["last_export_s3_path"] is not None:
+        export_from_datetime = spec["IncrementalExportSpecification"]["ExportFromTime"]
+        export_to_datetime = spec["IncrementalExportSpecification"]["ExportToTime"]
+        if Config.ORDERED_APPLY:
+            export_ledger.record_submitted(
+                s3_client=s3_client,
+                s3_bucket=s3_bucket,
+                table_s3_prefix=table_export["table_s3_prefix"],
+                export_arn=response["ExportDescription"]["ExportArn"],
+                export_from_time=export_from_datetime,
+                export_to_time=export_to_datetime,
+            )
+        put_response = s3_client.put_object(
+            Bucket=s3_bucket,
+            Key=table_export["last_export_s3_path"],
+            Body=export_to_datetime.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+        )
+        _WATERMARK_CACHE.set(
+            (s3_bucket, table_export["last_export_s3_path"]),
+            (put_response["ETag"], export_to_datetime),
+        )
+    return response
 
 
 def _get_last_export_to_datetime(
@@ -125,13 +494,24 @@ def _get_last_export_to_datetime(
     s3_bucket: str,
     last_export_s3_path: str,
 ):
-    """Get the datetime to export from, based on the last `export to` time in s3, or 24 hours ago if no previous export."""
-    if not s3_utils.exists(s3_client, s3_bucket, last_export_s3_path):
+    """
+    Get the datetime to export from, based on the last `export to` time in s3, or 24 hours ago if no previous export.
+    The last export time can be cached between warm invocations, see `Config.WATERMARK_CACHE_TTL_SECONDS`,
+    but is only used while the ETag of the file in s3 is the one it was cached with, as another
+    invocation may have advanced it since.
+    """
+    etag = checkpoints.get_etag(s3_client, s3_bucket, last_export_s3_path)
+    if etag is None:
         export_from_datetime = datetime.now() - timedelta(days=1)
         return export_from_datetime
 
+    cached = _WATERMARK_CACHE.get((s3_bucket, last_export_s3_path))
+    if cached is not None and cached[0] == etag:
+        return cached[1]
+
     date_str = s3_utils.read_contents_from_s3(s3_client, s3_bucket, last_export_s3_path)
     export_from_datetime = datetime.strptime(date_str, "%Y-%m-%dT%H:%M:%S.%fZ")
+    _WATERMARK_CACHE.set((s3_bucket, last_export_s3_path), (etag, export_from_datetime))
     return export_from_datetime
 
 
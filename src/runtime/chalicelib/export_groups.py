@@ -0,0 +1,125 @@
+import json
+from datetime import datetime
+from typing import Any, List, Tuple, Union
+from . import s3_utils
+
+_DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+
+def get_export_id(export_arn: str) -> str:
+    """Get the export id from an export arn, e.g. 'arn:aws:dynamodb:...:table/my-table/export/<export-id>'"""
+    return export_arn.split("/")[-1]
+
+
+def get_manifest_summary_path(table_s3_prefix: str, export_id: str) -> str:
+    """s3 path DynamoDB writes the `manifest-summary.json` of an export to, once it has completed."""
+    return f"{table_s3_prefix}/AWSDynamoDB/{export_id}/manifest-summary.json"
+
+
+def write_group(
+    s3_client: Any,
+    s3_bucket: str,
+    table_s3_prefix: str,
+    export_ids: List[str],
+    export_windows: List[Tuple[datetime, datetime]] = None,
+    submitted_at: datetime = None,
+    group_id: str = None,
+):
+    """
+    Record that a backlog of incremental exports should be applied to Redshift together.
+
+    One file is written per export, so the group can be found from any of its exports, and
+    the group is listed as pending until it has been applied, see `list_pending_groups`.
+
+    Args:
+        - s3_client: boto3 s3 client
+        - s3_bucket: s3 bucket the exports are written to
+        - table_s3_prefix: s3 prefix of the exported table
+        - export_ids: ids of the exports in the group, oldest export window first
+        - export_windows: `ExportFromTime` and `ExportToTime` of each export, to submit it again
+        - submitted_at: when the group was submitted, defaults to now
+        - group_id: id of the group, defaults to the id of its first export
+    """
+    group_id = group_id or export_ids[0]
+    for export_id in export_ids:
+        s3_client.put_object(
+            Bucket=s3_bucket,
+            Key=_get_group_path(table_s3_prefix, export_id),
+            Body=json.dumps({"export_ids": export_ids, "group_id": group_id}),
+        )
+    s3_client.put_object(
+        Bucket=s3_bucket,
+        Key=_get_pending_path(table_s3_prefix, group_id),
+        Body=json.dumps(
+            {
+                "group_id": group_id,
+                "export_ids": export_ids,
+                "export_windows": [
+                    [t.strftime(_DATETIME_FORMAT) for t in window]
+                    for window in export_windows
+                ]
+                if export_windows is not None
+                else None,
+                "submitted_at": (submitted_at or datetime.now()).strftime(
+                    _DATETIME_FORMAT
+                ),
+            }
+        ),
+    )
+
+
+def read_group(
+    s3_client: Any,
+    s3_bucket: str,
+    table_s3_prefix: str,
+    export_id: str,
+) -> Union[List[str], None]:
+    """Get the ids of the exports grouped with `export_id`, oldest first, or None if not grouped."""
+    group_path = _get_group_path(table_s3_prefix, export_id)
+    if not s3_utils.exists(s3_client, s3_bucket, group_path):
+        return None
+    return s3_utils.read_json_from_s3(s3_client, s3_bucket, group_path)["export_ids"]
+
+
+def list_pending_groups(
+    s3_client: Any,
+    s3_bucket: str,
+    table_s3_prefix: str,
+) -> List[dict]:
+    """Get the groups of the table that haven't been applied to Redshift yet, see `write_group`."""
+    paginator = s3_client.get_paginator("list_objects_v2")
+    return [
+        s3_utils.read_json_from_s3(s3_client, s3_bucket, obj["Key"])
+        for page in paginator.paginate(
+            Bucket=s3_bucket, Prefix=f"{table_s3_prefix}/coalesce/pending/"
+        )
+        for obj in page.get("Contents", [])
+    ]
+
+
+def complete_group(
+    s3_client: Any,
+    s3_bucket: str,
+    table_s3_prefix: str,
+    export_id: str,
+):
+    """Stop listing the group of an export as pending, once it has been applied."""
+    group_path = _get_group_path(table_s3_prefix, export_id)
+    group_id = s3_utils.read_json_from_s3(s3_client, s3_bucket, group_path).get(
+        "group_id", export_id
+    )
+    s3_client.delete_object(
+        Bucket=s3_bucket, Key=_get_pending_path(table_s3_prefix, group_id)
+    )
+
+
+def parse_datetime(value: str) -> datetime:
+    return datetime.strptime(value, _DATETIME_FORMAT)
+
+
+def _get_group_path(table_s3_prefix: str, export_id: str) -> str:
+    return f"{table_s3_prefix}/coalesce/{export_id}.json"
+
+
+def _get_pending_path(table_s3_prefix: str, group_id: str) -> str:
+    return f"{table_s3_prefix}/coalesce/pending/{group_id}.json"
@@ -0,0 +1,122 @@
+import json
+from datetime import datetime
+from typing import Any, List, Union
+from . import export_groups
+
+SUBMITTED = "SUBMITTED"
+READY = "READY"
+
+_DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+
+def record_submitted(
+    s3_client: Any,
+    s3_bucket: str,
+    table_s3_prefix: str,
+    export_arn: str,
+    export_from_time: datetime,
+    export_to_time: datetime,
+):
+    """
+    Add a submitted incremental export to the table's ledger.
+
+    Each export is a file under `<table_s3_prefix>/export-ledger/`, named by its
+    `ExportFromTime` so listing the ledger returns exports in window order.
+
+    Args:
+        - s3_client: boto3 s3 client
+        - s3_bucket: s3 bucket the exports are written to
+        - table_s3_prefix: s3 prefix of the exported table
+        - export_arn: arn of the submitted export
+        - export_from_time: start of the export window
+        - export_to_time: end of the export window
+    """
+    entry = {
+        "ExportArn": export_arn,
+        "ExportFromTime": export_from_time.strftime(_DATETIME_FORMAT),
+        "ExportToTime": export_to_time.strftime(_DATETIME_FORMAT),
+        "Status": SUBMITTED,
+        "RedshiftManifest": None,
+    }
+    entry_path = _get_entry_path(table_s3_prefix, entry)
+    s3_client.put_object(Bucket=s3_bucket, Key=entry_path, Body=json.dumps(entry))
+
+
+def record_ready(
+    s3_client: Any,
+    s3_bucket: str,
+    table_s3_prefix: str,
+    export_arn: str,
+    redshift_manifest: Union[str, None],
+) -> bool:
+    """
+    Mark an export in the ledger as processed and ready to apply to Redshift.
+
+    Args:
+        - redshift_manifest: s3 path to the redshift manifest to apply, or None if the export has no data
+
+    Returns:
+        - False if the export is not in the ledger, e.g. it was submitted before the ledger was enabled
+    """
+    entry = next(
+        (
+            e
+            for e in list_entries(s3_client, s3_bucket, table_s3_prefix)
+            if e["ExportArn"] == export_arn
+        ),
+        None,
+    )
+    if entry is None:
+        return False
+
+    entry["Status"] = READY
+    entry["RedshiftManifest"] = redshift_manifest
+    s3_client.put_object(
+        Bucket=s3_bucket,
+        Key=_get_entry_path(table_s3_prefix, entry),
+        Body=json.dumps(entry),
+    )
+    return True
+
+
+def list_entries(
+    s3_client: Any,
+    s3_bucket: str,
+    table_s3_prefix: str,
+) -> List[dict]:
+    """Get the exports in the table's ledger, oldest export window first."""
+    paginator = s3_client.get_paginator("list_objects_v2")
+    keys = [
+        obj["Key"]
+        for page in paginator.paginate(
+            Bucket=s3_bucket, Prefix=f"{table_s3_prefix}/export-ledger/"
+        )
+        for obj in page.get("Contents", [])
+    ]
+    entries = []
+    for key in sorted(keys):
+        body = s3_client.get_object(Bucket=s3_bucket, Key=key)["Body"].read()
+        entries.append(json.loads(body))
+    return entries
+
+
+def remove_entries(
+    s3_client: Any,
+    s3_bucket: str,
+    table_s3_prefix: str,
+    entries: List[dict],
+):
+    """Remove exports from the table's ledger, once they have been applied to Redshift."""
+    for entry in entries:
+        s3_client.delete_object(
+            Bucket=s3_bucket, Key=_get_entry_path(table_s3_prefix, entry)
+        )
+
+
+def parse_datetime(value: str) -> datetime:
+    return datetime.strptime(value, _DATETIME_FORMAT)
+
+
+def _get_entry_path(table_s3_prefix: str, entry: dict) -> str:
+    export_id = export_groups.get_export_id(entry["ExportArn"])
+    return f"{table_s3_prefix}/export-ledger/{entry['ExportFromTime']}_{export_id}.json"
@@ -0,0 +1,107 @@
+import json
+from datetime import datetime, timedelta
+from typing import Any, Union
+from . import s3_utils
+from .config import Config
+
+# weight of the latest export in the change rate of a table, see `record_export`
+_SMOOTHING = 0.5
+
+
+def get_schedule_path(table_s3_prefix: str) -> str:
+    return f"{table_s3_prefix}/export-schedule.json"
+
+
+def record_export(
+    s3_client: Any,
+    s3_bucket: str,
+    table_s3_prefix: str,
+    manifest_summary: dict,
+) -> Union[dict, None]:
+    """
+    Update a table's change rate with a completed incremental export, and work out the
+    interval to its next export from it, see `get_interval`. The rates are smoothed over
+    exports, so one burst doesn't set the interval on its own.
+
+    Each export is only recorded once, keyed on the end of its window: an export ending no
+    later than the last one recorded, e.g. a retry of its manifest, is skipped.
+
+    Args:
+        - s3_client: boto3 s3 client
+        - s3_bucket: s3 bucket the export is in
+        - table_s3_prefix: s3 prefix of the exported table
+        - manifest_summary: the `manifest-summary.json` of the export
+
+    Returns:
+        - the table's schedule, or None if the export has no window to rate it over, or
+          was already recorded
+    """
+    export_from_time = _parse_time(manifest_summary.get("exportFromTime"))
+    export_to_time = _parse_time(manifest_summary.get("exportToTime"))
+    if export_from_time is None or export_to_time is None:
+        return None
+    window_seconds = max((export_to_time - export_from_time).total_seconds(), 1)
+    items_per_second = manifest_summary.get("itemCount", 0) / window_seconds
+    bytes_per_second = manifest_summary.get("billedSizeBytes", 0) / window_seconds
+
+    schedule_path = get_schedule_path(table_s3_prefix)
+    if s3_utils.exists(s3_client, s3_bucket, schedule_path):
+        previous = s3_utils.read_json_from_s3(s3_client, s3_bucket, schedule_path)
+        last_export_to_time = _parse_time(previous.get("last_export_to_time"))
+        if last_export_to_time is not None and export_to_time <= last_export_to_time:
+            return None
+        items_per_second = _smooth(previous["items_per_second"], items_per_second)
+        bytes_per_second = _smooth(previous["bytes_per_second"], bytes_per_second)
+    schedule = {
+        "items_per_second": items_per_second,
+        "bytes_per_second": bytes_per_second,
+        "interval_seconds": get_interval(items_per_second, bytes_per_second),
+        "last_export_to_time": manifest_summary["exportToTime"],
+    }
+    s3_client.put_object(Bucket=s3_bucket, Key=schedule_path, Body=json.dumps(schedule))
+    return schedule
+
+
+def get_interval(items_per_second: float, bytes_per_second: float) -> float:
+    """
+    Get the seconds between exports of a table changing at this rate: long enough for an
+    export to reach `Config.EXPORT_TARGET_ITEMS` or `Config.EXPORT_TARGET_BYTES`, whichever
+    is first, within `Config.EXPORT_MIN_INTERVAL_MINUTES` and `Config.EXPORT_MAX_INTERVAL_MINUTES`.
+    """
+    intervals = [Config.EXPORT_MAX_INTERVAL_MINUTES * 60]
+    if items_per_second > 0:
+        intervals.append(Config.EXPORT_TARGET_ITEMS / items_per_second)
+    if bytes_per_second > 0:
+        intervals.append(Config.EXPORT_TARGET_BYTES / bytes_per_second)
+    return max(min(intervals), Config.EXPORT_MIN_INTERVAL_MINUTES * 60)
+
+
+def is_due(
+    s3_client: Any,
+    s3_bucket: str,
+    table_s3_prefix: str,
+    last_export_to_time: datetime,
+    export_time: datetime,
+) -> bool:
+    """
+    Whether a table is due an incremental export, i.e. its interval has passed since the end of
+    its last export. Tables with no completed export yet are exported at the minimum interval.
+    """
+    schedule_path = get_schedule_path(table_s3_prefix)
+    interval_seconds = Config.EXPORT_MIN_INTERVAL_MINUTES * 60
+    if s3_utils.exists(s3_client, s3_bucket, schedule_path):
+        interval_seconds = s3_utils.read_json_from_s3(
+            s3_client, s3_bucket, schedule_path
+        )["interval_seconds"]
+    return export_time >= last_export_to_time + timedelta(seconds=interval_seconds)
+
+
+def _smooth(previous: float, latest: float) -> float:
+    return _SMOOTHING * latest + (1 - _SMOOTHING) * previous
+
+
+def _parse_time(value: Union[str, None]) -> Union[datetime, None]:
+    """Parse a time of a manifest summary, e.g. '2023-09-01T00:15:00.000Z', as naive UTC."""
+    if not value:
+        return None
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).replace(tzinfo=None)
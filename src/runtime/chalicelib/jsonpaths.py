@@ -0,0 +1,84 @@
+import re
+from typing import Any, Dict, List, Tuple, Union
+
+# Matches one bracket segment of a jsonpath, either ['key'] or [0]
+_BRACKET_SEGMENT = re.compile(r"\[(?:'([^']*)'|\"([^\"]*)\"|(\d+))\]")
+
+# A compiled projection is a tree of attribute names, where a leaf (None) means 'keep the whole value'
+Projection = Dict[str, Union["Projection", None]]
+
+
+def parse_jsonpath(jsonpath: str) -> Tuple[Union[str, int], ...]:
+    """
+    Parse a Redshift COPY jsonpath expression into its keys.
+    Supports bracket notation, e.g. "$['Item']['PK']['S']", and dot notation, e.g. "$.Item.PK.S".
+    Array indexes are returned as ints.
+
+    Raises:
+        - ValueError: if the expression is not a valid jsonpath
+    """
+    if not jsonpath.startswith("$"):
+        raise ValueError(f"Invalid jsonpath '{jsonpath}', must start with '$'")
+
+    remainder = jsonpath[1:]
+    if remainder.startswith("."):
+        return tuple(remainder[1:].split("."))
+
+    keys = []
+    position = 0
+    while position < len(remainder):
+        match = _BRACKET_SEGMENT.match(remainder, position)
+        if match is None:
+            raise ValueError(f"Invalid jsonpath '{jsonpath}'")
+        key, quoted_key, index = match.groups()
+        if index is not None:
+            keys.append(int(index))
+        else:
+            keys.append(key if key is not None else quoted_key)
+        position = match.end()
+    return tuple(keys)
+
+
+def compile_projection(jsonpaths: List[str], root: str = "Item") -> Projection:
+    """
+    Compile the jsonpaths of a table mapping into a projection of the `root` object,
+    i.e. a tree of only the attributes Redshift will load.
+
+    Paths through an array keep the whole array, so element positions are preserved.
+
+    Raises:
+        - ValueError: if a jsonpath is invalid or not under `root`
+    """
+    projection = {}
+    for jsonpath in jsonpaths:
+        keys = parse_jsonpath(jsonpath)
+        if len(keys) < 2 or keys[0] != root:
+            raise ValueError(f"Invalid jsonpath '{jsonpath}', must be under '{root}'")
+
+        node = projection
+        keys = keys[1:]
+        for i, key in enumerate(keys):
+            is_leaf = i == len(keys) - 1 or isinstance(keys[i + 1], int)
+            if is_leaf:
+                node[key] = None
+                break
+            if key in node and node[key] is None:
+                break  # a shorter path already keeps the whole value
+            node = node.setdefault(key, {})
+    return projection
+
+
+def project_item(item: Dict[str, Any], projection: Projection) -> Dict[str, Any]:
+    """Return a copy of `item` that only has the attributes in `projection`."""
+    projected = {}
+    for key, sub_projection in projection.items():
+        if key not in item:
+            continue
+        value = item[key]
+        if sub_projection is None:
+            projected[key] = value
+        elif isinstance(value, dict):
+            projected_value = project_item(value, sub_projection)
+            if projected_value:
+                projected[key] = projected_value
+    return projected
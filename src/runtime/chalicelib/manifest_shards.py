@@ -0,0 +1,116 @@
+import json
+import os
+from typing import Any, List, Union
+from . import s3_utils
+
+# suffixes of the files of a sharded export, each triggers a lambda, see app.py
+SHARD_SUFFIX = ".shard.json"
+SHARD_DONE_SUFFIX = ".shard-done.json"
+
+# phase of a job whose shards index the latest change per key before the export is processed
+INDEX_PHASE = "index"
+
+
+def get_shards_dir(export_s3_directory: str, phase: str = None) -> str:
+    if phase is not None:
+        return f"{export_s3_directory}/{phase}-shards"
+    return f"{export_s3_directory}/shards"
+
+
+def write_shards(
+    s3_client: Any,
+    s3_bucket: str,
+    export_s3_directory: str,
+    job: dict,
+    shards: List[dict],
+    phase: str = None,
+) -> List[str]:
+    """
+    Fan out the processing of an export: write the job, then one task per shard. Writing a
+    task triggers its worker, so the job is written first. The shards of each phase of a job,
+    e.g. `INDEX_PHASE`, have their own directory, so are fanned in on their own.
+
+    Args:
+        - s3_client: boto3 s3 client
+        - s3_bucket: s3 bucket the export is in
+        - export_s3_directory: s3 directory of the export
+        - job: what the fan in needs to write the redshift manifest, see `read_job`
+        - shards: the task of each shard, e.g. its data files
+        - phase: the phase of the job, None for processing the export
+
+    Returns:
+        - s3 paths to the shard tasks, in shard order
+    """
+    shards_dir = get_shards_dir(export_s3_directory, phase)
+    s3_client.put_object(
+        Bucket=s3_bucket,
+        Key=f"{shards_dir}/job.json",
+        Body=json.dumps({**job, "shard_count": len(shards), "phase": phase}),
+    )
+    shard_files = []
+    for shard_index, shard in enumerate(shards):
+        shard_file = f"{shards_dir}/{shard_index:05d}{SHARD_SUFFIX}"
+        s3_client.put_object(
+            Bucket=s3_bucket,
+            Key=shard_file,
+            Body=json.dumps({**shard, "shard_index": shard_index}),
+        )
+        shard_files.append(shard_file)
+    return shard_files
+
+
+def read_job(s3_client: Any, s3_bucket: str, shard_file: str) -> dict:
+    """Get the job of a shard task, or of its done record."""
+    return s3_utils.read_json_from_s3(
+        s3_client, s3_bucket, f"{os.path.dirname(shard_file)}/job.json"
+    )
+
+
+def record_done(
+    s3_client: Any,
+    s3_bucket: str,
+    shard_file: str,
+    processed_files: List[str],
+) -> str:
+    """Record that a shard has been processed, which triggers the fan in. Returns the s3 path to the record."""
+    done_file = shard_file[: -len(SHARD_SUFFIX)] + SHARD_DONE_SUFFIX
+    s3_client.put_object(
+        Bucket=s3_bucket,
+        Key=done_file,
+        Body=json.dumps({"processed_files": processed_files}),
+    )
+    return done_file
+
+
+def read_done(
+    s3_client: Any,
+    s3_bucket: str,
+    shards_dir: str,
+    shard_count: int,
+) -> Union[List[List[str]], None]:
+    """Get the processed files of each shard, in shard order, or None if any shard is not done yet."""
+    paginator = s3_client.get_paginator("list_objects_v2")
+    done_files = sorted(
+        obj["Key"]
+        for page in paginator.paginate(Bucket=s3_bucket, Prefix=f"{shards_dir}/")
+        for obj in page.get("Contents", [])
+        if obj["Key"].endswith(SHARD_DONE_SUFFIX)
+    )
+    if len(done_files) < shard_count:
+        return None
+    return [
+        s3_utils.read_json_from_s3(s3_client, s3_bucket, f)["processed_files"]
+        for f in done_files
+    ]
+
+
+def claim_fan_in(s3_client: Any, s3_bucket: str, shards_dir: str) -> bool:
+    """
+    Claim the fan in of a job, so the redshift manifest is only written once. Returns False if
+    it was already claimed. Fan ins must run one at a time for this to hold, see app.py.
+    """
+    claim_path = f"{shards_dir}/fan-in.json"
+    if s3_utils.exists(s3_client, s3_bucket, claim_path):
+        return False
+    s3_client.put_object(Bucket=s3_bucket, Key=claim_path, Body="{}")
+    return True
@@ -0,0 +1,159 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator
+from aws_lambda_powertools.metrics import EphemeralMetrics, MetricUnit
+from .config import Config
+
+# caches whose hits and misses are added to the metrics of a stage, by stage, see `register_cache`
+_STAGE_CACHES: Dict[str, Dict[str, Any]] = {}
+
+
+def register_cache(stage: str, name: str, cache: Any):
+    """
+    Add the hits and misses of a `ttl_cache.TTLCache` to the next `StageMetrics` of `stage`
+    flushed, as `StageMetrics.add_cache` does, if it was used since. For caches used by the
+    stage from outside its own code, e.g. the Redshift credentials of app.py.
+    """
+    _STAGE_CACHES.setdefault(stage, {})[name] = cache
+
+
+class StageMetrics:
+    """
+    Collect the metrics of one stage of a lambda for one table, and publish them together,
+    in CloudWatch embedded metric format, with `stage` and `table` dimensions.
+    Metrics are only published with `Config.METRICS_ENABLED`, but `timed` blocks are
+    always traced, as X-Ray subsegments.
+
+    Metrics can be added from multiple threads, but `timed` should only be used from the
+    thread of the lambda handler, as that's where the X-Ray segment is.
+
+    Example
+    -------
+    with StageMetrics("redshift_upsert", "schema.table") as stage_metrics:
+        with stage_metrics.timed("Copy"):
+            cur.execute(copy_command)
+        stage_metrics.add("RowsWritten", rows)
+    """
+
+    def __init__(self, stage: str, table: str = None):
+        self.stage = stage
+        self.table = table
+        self._metrics = EphemeralMetrics(
+            namespace=Config.METRICS_NAMESPACE, service=Config.app_name
+        )
+        self._has_metrics = False
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def add(self, name: str, value: float, unit: MetricUnit = MetricUnit.Count):
+        if not Config.METRICS_ENABLED:
+            return
+        with self._lock:
+            self._metrics.add_metric(name=name, unit=unit, value=value)
+            self._has_metrics = True
+
+    def add_seconds(self, name: str, seconds: float):
+        """Add a duration, as `<name>Time` in milliseconds."""
+        self.add(f"{name}Time", seconds * 1000, MetricUnit.Milliseconds)
+
+    def add_cache(self, name: str, cache: Any):
+        """
+        Add the hits and misses of a `ttl_cache.TTLCache` since they were last added, as
+        `<name>CacheHits` and `<name>CacheMisses`.
+        """
+        hits, misses = cache.take_counts()
+        self.add(f"{name}CacheHits", hits)
+        self.add(f"{name}CacheMisses", misses)
+
+    def add_timings(self, timings: Dict[str, float]):
+        """Add durations in seconds by name, e.g. collected with `timed_iter`."""
+        for name, seconds in timings.items():
+            self.add_seconds(name, seconds)
+
+    @contextmanager
+    def timed(self, name: str):
+        """Time a block, as `<name>Time`, in an X-Ray subsegment `## <name>`."""
+        with Config.tracer.provider.in_subsegment(f"## {name}") as subsegment:
+            subsegment.put_annotation("stage", self.stage)
+            if self.table:
+                subsegment.put_annotation("table", self.table)
+            start = time.perf_counter()
+            try:
+                yield subsegment
+            finally:
+                self.add_seconds(name, time.perf_counter() - start)
+
+    def flush(self):
+        """Publish the metrics added so far, with those of the stage's caches, see `register_cache`."""
+        for name, cache in _STAGE_CACHES.get(self.stage, {}).items():
+            hits, misses = cache.take_counts()
+            if hits or misses:
+                self.add(f"{name}CacheHits", hits)
+                self.add(f"{name}CacheMisses", misses)
+        with self._lock:
+            if not self._has_metrics:
+                return
+            self._metrics.add_dimension(name="stage", value=self.stage)
+            if self.table:
+                self._metrics.add_dimension(name="table", value=self.table)
+            self._metrics.flush_metrics()
+            self._has_metrics = False
+
+
+class TimedCursor:
+    """
+    Wrap a database cursor to time each statement it executes, as `<first keyword>Time`,
+    e.g. `CopyTime`, `DeleteTime` or `MergeTime`, and count the rows of each DELETE, MERGE
+    and INSERT, as e.g. `DeleteRows`.
+    """
+
+    def __init__(self, cursor: Any, stage_metrics: StageMetrics):
+        self._cursor = cursor
+        self._stage_metrics = stage_metrics
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._cursor, name)
+
+    def execute(self, sql: str, params: Any = None):
+        name = get_statement_name(sql)
+        with self._stage_metrics.timed(name):
+            result = self._cursor.execute(sql, params)
+        rowcount = getattr(self._cursor, "rowcount", -1)
+        if (
+            name in ("Delete", "Merge", "Insert")
+            and isinstance(rowcount, int)
+            and rowcount >= 0
+        ):
+            self._stage_metrics.add(f"{name}Rows", rowcount)
+        return result
+
+
+def get_statement_name(sql: str) -> str:
+    """The first keyword of a sql statement, e.g. "Copy", ignoring comments."""
+    for line in sql.strip().splitlines():
+        line = line.strip()
+        if line and not line.startswith("--"):
+            return line.split()[0].strip(";").capitalize()
+    return "Statement"
+
+
+def timed_iter(
+    iterable: Iterable[Any], timings: Dict[str, float], name: str
+) -> Iterator[Any]:
+    """Yield from `iterable`, adding the seconds spent waiting for each item to `timings[name]`."""
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            timings[name] += time.perf_counter() - start
+            return
+        timings[name] += time.perf_counter() - start
+        yield item
@@ -0,0 +1,398 @@
+import base64
+import decimal
+import itertools
+import json
+import re
+import threading
+from collections import namedtuple
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Union
+from . import jsonpaths, s3_utils
+
+JSON = "json"
+PARQUET = "parquet"
+OUTPUT_FORMATS = (JSON, PARQUET)
+
+FILE_EXTENSIONS = {JSON: ".json.gz", PARQUET: ".parquet"}
+
+# DynamoDB JSON type descriptors, e.g. the 'S' in {"PK": {"S": "value"}}
+_TYPE_DESCRIPTORS = {"S", "N", "B", "BOOL", "NULL", "M", "L", "SS", "NS", "BS"}
+# `N` has no default type: any default would lose the precision of some numbers, see `compile_columns`
+_DEFAULT_COLUMN_TYPES = {"S": "string", "BOOL": "bool", "B": "binary"}
+_COLUMN_TYPES = ("string", "int64", "float64", "bool", "binary", "timestamp")
+_DECIMAL_TYPE = re.compile(r"decimal\((\d+),\s*(\d+)\)")
+
+# A column of the flattened output: its name, the keys under 'Item' to read it from, and its type
+Column = namedtuple("Column", ["name", "keys", "type"])
+
+
+def compile_columns(
+    json_paths: List[str],
+    column_types: Dict[str, str] = None,
+) -> List[Column]:
+    """
+    Compile the jsonpaths of a table mapping into the typed columns of a flattened (e.g. parquet) row.
+    Columns are in jsonpaths order, which must be the column order of the redshift table.
+
+    Args:
+        - json_paths: jsonpaths of the table mapping
+        - column_types: type per jsonpath, overriding the type implied by its DynamoDB type descriptor.
+          One of string, int64, float64, bool, binary, timestamp, decimal(precision, scale).
+          `N` jsonpaths have no implied type, so their column type is None unless set here.
+
+    Raises:
+        - ValueError: if a jsonpath or type is invalid
+    """
+    column_types = column_types or {}
+    columns = []
+    names = set()
+    for json_path in json_paths:
+        keys = jsonpaths.parse_jsonpath(json_path)[1:]
+        column_type = column_types.get(json_path)
+        if column_type is not None:
+            _check_column_type(column_type)
+        elif keys[-1] != "N":
+            column_type = _DEFAULT_COLUMN_TYPES.get(keys[-1], "string")
+
+        name = "_".join(
+            str(k).lower() for k in keys if k not in _TYPE_DESCRIPTORS
+        ) or str(len(columns))
+        while name in names:
+            name = f"{name}_{len(columns)}"
+        names.add(name)
+
+        columns.append(Column(name, keys, column_type))
+    return columns
+
+
+class JsonItemWriter:
+    """Write items as gzipped `{"Item": ...}` json lines, the format `COPY ... json 'jsonpaths'` loads."""
+
+    def __init__(
+        self,
+        s3_client: Any,
+        s3_bucket: str,
+        s3_file_path: str,
+        part_size: int = 8 * 1024 * 1024,
+    ):
+        self.s3_file_path = s3_file_path
+        self._writer = s3_utils.S3GzipWriter(
+            s3_client, s3_bucket, s3_file_path, part_size=part_size
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._writer.__exit__(exc_type, exc_value, traceback)
+
+    @property
+    def rows(self) -> int:
+        return self._writer.rows
+
+    @property
+    def bytes_in(self) -> int:
+        return self._writer.bytes_in
+
+    @property
+    def bytes_out(self) -> int:
+        return self._writer.bytes_out
+
+    @property
+    def upload_seconds(self) -> float:
+        return self._writer.upload_seconds
+
+    @property
+    def files(self) -> List[str]:
+        """s3 path of the file, once it has been written."""
+        return [self.s3_file_path] if self._writer.completed else []
+
+    def write_item(self, item: dict):
+        self._writer.write_line(json.dumps({"Item": item}))
+
+    def close(self):
+        self._writer.close()
+
+    def abort(self):
+        self._writer.abort()
+
+
+class ParquetItemWriter:
+    """
+    Write items as rows of a parquet file, flattened into `columns`, the format
+    `COPY ... FORMAT AS PARQUET` loads. Rows are buffered and written a row group at a time,
+    and the file is uploaded in parts, so memory use stays bounded.
+
+    Requires `pyarrow`, and a type for every column, see `compile_columns`.
+    """
+
+    def __init__(
+        self,
+        s3_client: Any,
+        s3_bucket: str,
+        s3_file_path: str,
+        columns: List[Column],
+        part_size: int = 8 * 1024 * 1024,
+        row_group_size: int = 100_000,
+    ):
+        untyped = [c.name for c in columns if c.type is None]
+        if untyped:
+            raise ValueError(
+                f"Columns {untyped} have no parquet type, set one in the table's parquet_types, "
+                "e.g. decimal(precision, scale) or int64 for DynamoDB numbers"
+            )
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as ex:
+            raise ImportError(
+                "pyarrow is required for OUTPUT_FORMAT=parquet, deploy it as a lambda layer, see layers/pyarrow"
+            ) from ex
+
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self.s3_file_path = s3_file_path
+        self.columns = columns
+        self.row_group_size = row_group_size
+        self.rows = 0
+        self.bytes_in = 0
+        self._schema = pyarrow.schema(
+            [(c.name, _get_arrow_type(c.type, pyarrow)) for c in columns]
+        )
+        self._sink = s3_utils.S3MultipartWriter(
+            s3_client, s3_bucket, s3_file_path, part_size=part_size
+        )
+        self._writer = None
+        self._values = [[] for _ in columns]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+    @property
+    def bytes_out(self) -> int:
+        return self._sink.bytes_out
+
+    @property
+    def upload_seconds(self) -> float:
+        return self._sink.upload_seconds
+
+    @property
+    def files(self) -> List[str]:
+        """s3 path of the file, once it has been written."""
+        return [self.s3_file_path] if self._sink.completed else []
+
+    def write_item(self, item: dict):
+        for values, column in zip(self._values, self.columns):
+            value = _get_value(item, column)
+            values.append(value)
+            self.bytes_in += len(value) if isinstance(value, (str, bytes)) else 8
+        self.rows += 1
+        if len(self._values[0]) >= self.row_group_size:
+            self._write_row_group()
+
+    def close(self):
+        """Write remaining rows and complete the upload. Nothing is written if no rows were written."""
+        if self._sink.closed:
+            return
+        if self.rows == 0:
+            self.abort()
+            return
+        if self._values[0]:
+            self._write_row_group()
+        self._writer.close()
+        self._sink.close()
+
+    def abort(self):
+        self._sink.abort()
+
+    def _write_row_group(self):
+        if self._writer is None:
+            self._writer = self._pq.ParquetWriter(
+                self._pa.PythonFile(self._sink, mode="w"),
+                self._schema,
+                compression="snappy",
+            )
+        table = self._pa.Table.from_arrays(
+            [
+                self._pa.array(values, type=field.type)
+                for values, field in zip(self._values, self._schema)
+            ],
+            schema=self._schema,
+        )
+        self._writer.write_table(table)
+        self._values = [[] for _ in self.columns]
+
+
+def open_item_writer(
+    s3_client: Any,
+    s3_bucket: str,
+    s3_file_stem: str,
+    output_format: str,
+    columns: List[Column],
+    part_size: int = 8 * 1024 * 1024,
+) -> Union[JsonItemWriter, ParquetItemWriter]:
+    """
+    Open a writer for processed items, at `s3_file_stem` plus the file extension of `output_format`.
+
+    Raises:
+        - ValueError: if `output_format` is not one of `OUTPUT_FORMATS`
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(
+            f"Invalid output format '{output_format}', must be one of {OUTPUT_FORMATS}"
+        )
+    s3_file_path = s3_file_stem + FILE_EXTENSIONS[output_format]
+    if output_format == PARQUET:
+        return ParquetItemWriter(
+            s3_client, s3_bucket, s3_file_path, columns, part_size=part_size
+        )
+    return JsonItemWriter(s3_client, s3_bucket, s3_file_path, part_size=part_size)
+
+
+class ChunkedItemWriter:
+    """
+    Write items to a set of evenly sized files, e.g. one per Redshift slice.
+
+    Items are spread round-robin over `slots` files, so the files grow at the same rate.
+    When a file reaches `target_bytes` (uncompressed) it is completed and a new file is
+    started in its slot, so the output is sets of `slots` files of roughly `target_bytes`
+    each, followed by one last set of equal, smaller files.
+
+    `write_item` can be called from multiple threads; each slot is written independently.
+
+    Args:
+        - open_chunk: called with (slot, chunk number) to open the writer for a new file
+        - slots: number of files written at a time
+        - target_bytes: uncompressed size at which a file is completed
+    """
+
+    def __init__(
+        self,
+        open_chunk: Callable[[int, int], Any],
+        slots: int,
+        target_bytes: int,
+    ):
+        self.open_chunk = open_chunk
+        self.target_bytes = target_bytes
+        self._next_slot = itertools.count()
+        self._slots = [
+            {"lock": threading.Lock(), "writer": None, "chunk": 0}
+            for _ in range(max(slots, 1))
+        ]
+        self._files = []
+        self._files_lock = threading.Lock()
+        # totals of the completed files
+        self.rows = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.upload_seconds = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+    @property
+    def files(self) -> List[str]:
+        """s3 paths of the files written so far, in name order."""
+        return sorted(self._files)
+
+    def write_item(self, item: dict):
+        slot_index = next(self._next_slot) % len(self._slots)
+        slot = self._slots[slot_index]
+        with slot["lock"]:
+            if slot["writer"] is None:
+                slot["writer"] = self.open_chunk(slot_index, slot["chunk"])
+                slot["chunk"] += 1
+            slot["writer"].write_item(item)
+            if slot["writer"].bytes_in >= self.target_bytes:
+                self._complete(slot)
+
+    def close(self):
+        for slot in self._slots:
+            with slot["lock"]:
+                if slot["writer"] is not None:
+                    self._complete(slot)
+
+    def abort(self):
+        """Discard the files still being written. Files already completed are left in place."""
+        for slot in self._slots:
+            with slot["lock"]:
+                if slot["writer"] is not None:
+                    slot["writer"].abort()
+                    slot["writer"] = None
+
+    def _complete(self, slot: dict):
+        writer = slot["writer"]
+        writer.close()
+        slot["writer"] = None
+        with self._files_lock:
+            self._files.append(writer.s3_file_path)
+            self.rows += writer.rows
+            self.bytes_in += writer.bytes_in
+            self.bytes_out += writer.bytes_out
+            self.upload_seconds += writer.upload_seconds
+
+
+def _get_value(item: dict, column: Column) -> Any:
+    """Read the value of `column` from an item, converted to the column's type."""
+    value = item
+    for key in column.keys:
+        if isinstance(value, dict):
+            value = value.get(key)
+        elif isinstance(value, list) and isinstance(key, int) and key < len(value):
+            value = value[key]
+        else:
+            value = None
+        if value is None:
+            return None
+
+    column_type = column.type
+    if column_type == "string":
+        return value if isinstance(value, str) else json.dumps(value)
+    if column_type == "int64":
+        return int(decimal.Decimal(value))
+    if column_type == "float64":
+        return float(value)
+    if column_type == "bool":
+        return value if isinstance(value, bool) else str(value).lower() == "true"
+    if column_type == "binary":
+        return base64.b64decode(value)
+    if column_type == "timestamp":
+        timestamp = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+        return timestamp
+    return decimal.Decimal(value)  # decimal(precision, scale)
+
+
+def _check_column_type(column_type: str):
+    if column_type not in _COLUMN_TYPES and not _DECIMAL_TYPE.fullmatch(column_type):
+        raise ValueError(
+            f"Invalid column type '{column_type}', must be one of {_COLUMN_TYPES} or decimal(precision, scale)"
+        )
+
+
+def _get_arrow_type(column_type: str, pyarrow: Any):
+    """Get the pyarrow type of a column type, see `compile_columns`."""
+    decimal_match = _DECIMAL_TYPE.fullmatch(column_type)
+    if decimal_match:
+        return pyarrow.decimal128(int(decimal_match[1]), int(decimal_match[2]))
+    return {
+        "string": pyarrow.string(),
+        "int64": pyarrow.int64(),
+        "float64": pyarrow.float64(),
+        "bool": pyarrow.bool_(),
+        "binary": pyarrow.binary(),
+        "timestamp": pyarrow.timestamp("us"),
+    }[column_type]
@@ -1,10 +1,34 @@
 import os
 import json
-import gzip
-from typing import Any, Union
-from . import s3_utils, redshift_utils
+import hashlib
+import heapq
+import itertools
+import time
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Tuple, Union
+from aws_lambda_powertools.metrics import MetricUnit
+from . import (
+    checkpoints,
+    digest_index,
+    export_groups,
+    export_ledger,
+    export_schedule,
+    jsonpaths,
+    manifest_shards,
+    metrics,
+    output_formats,
+    s3_utils,
+)
 from .config import Config
 
+# (write timestamp in micros, data file index, line index) of a change in an incremental export
+ChangePosition = Tuple[int, int, int]
+
+# sub directory of processed files for the key-only delete files, see `Config.SPLIT_INCREMENTAL_DELETES`
+_DELETES_DIR = "deletes"
+
 
 def handle(
     s3_client: Any,
@@ -21,6 +45,41 @@ def handle(
     Returns:
         str: s3 path to redshift manifest file
     """
+    with metrics.StageMetrics("redshift_manifest_creation") as stage_metrics:
+        redshift_manifest_file = _handle(
+            s3_client, manifest_summary_file, stage_metrics
+        )
+        if Config.ADAPTIVE_EXPORT_SCHEDULE:
+            # once processed, so a retry of a failed manifest doesn't count its export twice
+            _record_export(s3_client, manifest_summary_file, stage_metrics)
+        return redshift_manifest_file
+
+
+def _record_export(
+    s3_client: Any,
+    manifest_summary_file: str,
+    stage_metrics: metrics.StageMetrics,
+):
+    """Schedule the next export of the table from how much this one changed, see `export_schedule.record_export`."""
+    manifest_summary = s3_utils.read_json_from_s3(
+        s3_client, Config.S3_BUCKET, manifest_summary_file
+    )
+    if manifest_summary.get("exportType") != "INCREMENTAL_EXPORT":
+        return
+    schedule = export_schedule.record_export(
+        s3_client, Config.S3_BUCKET, manifest_summary["s3Prefix"], manifest_summary
+    )
+    if schedule is not None:
+        stage_metrics.add(
+            "ExportIntervalSeconds", schedule["interval_seconds"], MetricUnit.Seconds
+        )
+
+
+def _handle(
+    s3_client: Any,
+    manifest_summary_file: str,
+    stage_metrics: metrics.StageMetrics,
+):
     Config.logger.info("file received " + manifest_summary_file)
 
     manifest_summary = s3_utils.read_json_from_s3(
@@ -32,43 +91,490 @@ def handle(
     table_s3_prefix = manifest_summary["s3Prefix"]
     dynamodb_table_name = table_s3_prefix.split("/")[-1]
     export_s3_directory = os.path.dirname(manifest_summary_file)
+    stage_metrics.table = dynamodb_table_name
 
-    processed_files = []
+    table_details = Config.TABLE_DETAILS.get(dynamodb_table_name, None)
+    if table_details is None:
+        raise Exception(
+            f"Unable to find table details for {dynamodb_table_name} in table_mapping.json"
+        )
 
-    manifest_files_path = manifest_summary["manifestFilesS3Key"]
-    manifest_files_content = s3_utils.read_json_from_s3(
+    export_arns = [manifest_summary.get("exportArn")]
+    item_count = manifest_summary.get("itemCount", 0)
+    data_files = _get_data_files(s3_client, manifest_summary)
+
+    if is_incremental and Config.COALESCE_BACKLOG_EXPORTS:
+        export_id = export_groups.get_export_id(manifest_summary["exportArn"])
+        group = export_groups.read_group(
+            s3_client, Config.S3_BUCKET, table_s3_prefix, export_id
+        )
+        if group is not None:
+            group_manifest_summaries = _get_group_manifest_summaries(
+                s3_client, table_s3_prefix, group
+            )
+            if group_manifest_summaries is None:
+                Config.logger.info(
+                    f"Export {export_id} is part of a backlog of {len(group)} exports, waiting for the rest to complete"
+                )
+                return None
+
+            # all exports in the backlog are complete, apply them to redshift as one
+            Config.logger.info(f"Coalescing backlog of exports {group}")
+            export_groups.complete_group(
+                s3_client, Config.S3_BUCKET, table_s3_prefix, export_id
+            )
+            export_arns = [m.get("exportArn") for m in group_manifest_summaries]
+            item_count = sum(m.get("itemCount", 0) for m in group_manifest_summaries)
+            data_files = [
+                data_file
+                for m in group_manifest_summaries
+                for data_file in _get_data_files(s3_client, m)
+            ]
+            export_s3_directory = os.path.dirname(
+                export_groups.get_manifest_summary_path(table_s3_prefix, group[-1])
+            )
+
+    latest_changes = None
+    digest_diff = None
+    processed_dir = f"{table_s3_prefix}/AWSDynamoDB/processed"
+    if not is_incremental and Config.DIFF_FULL_EXPORTS:
+        if item_count > Config.DIFF_FULL_EXPORTS_MAX_ITEMS:
+            raise Exception(
+                f"Full export of {dynamodb_table_name} has {item_count} items, more than "
+                f"DIFF_FULL_EXPORTS_MAX_ITEMS ({Config.DIFF_FULL_EXPORTS_MAX_ITEMS}) can diff"
+            )
+        # only load what changed since the last full export applied, as an incremental export
+        digest_diff = _DigestDiff(
+            s3_client,
+            _get_key_attributes(dynamodb_table_name),
+            digest_index.read_current(s3_client, Config.S3_BUCKET, table_s3_prefix),
+            f"{export_s3_directory}/digest-runs",
+        )
+        if digest_diff.previous is None:
+            Config.logger.info(f"No digest index for {dynamodb_table_name} yet")
+    # a diffed full export is applied as an incremental one
+    is_applied_incremental = is_incremental or (
+        digest_diff is not None and digest_diff.previous is not None
+    )
+    job = {
+        "dynamodb_table_name": dynamodb_table_name,
+        "table_s3_prefix": table_s3_prefix,
+        "export_s3_directory": export_s3_directory,
+        "is_incremental": is_applied_incremental,
+        "export_arns": export_arns,
+        "item_count": item_count,
+        # write deletes to their own key-only files, and upserts shaped like the target.
+        # Full exports replacing the table are loaded straight into a table like the target
+        "split_deletes": (
+            Config.SPLIT_INCREMENTAL_DELETES
+            if is_applied_incremental
+            else Config.FULL_REFRESH_STRATEGY != "insert"
+        ),
+    }
+
+    is_compacted = is_incremental and Config.COMPACT_INCREMENTAL_CHANGES
+    is_sharded = (
+        0 < Config.MANIFEST_SHARD_FILES < len(data_files) and digest_diff is None
+    )
+    if is_compacted and not is_sharded:
+        # only load the last change per key, so redshift sees one row per key
+        with stage_metrics.timed("IndexChanges"):
+            latest_changes = _get_latest_changes(
+                s3_client,
+                data_files,
+                _get_noop_projection(dynamodb_table_name),
+                stage_metrics,
+            )
+
+    with stage_metrics.timed("ProcessDataFiles"):
+        if (
+            not is_incremental
+            and Config.OUTPUT_FORMAT == output_formats.JSON
+            and digest_diff is None
+        ):
+            # For full export to json, no processing required
+            processed_files = data_files
+        elif is_sharded:
+            # too many files for one invocation, see `handle_shard` and `handle_fan_in`
+            if is_compacted:
+                # the shards index the latest changes too, before processing
+                shard_files = _write_index_shards(s3_client, job, data_files)
+            else:
+                shard_files = _write_shards(s3_client, job, data_files)
+            stage_metrics.add("Shards", len(shard_files))
+            stage_metrics.add("DataFiles", len(data_files))
+            Config.logger.info(
+                f"Processing {len(data_files)} data files in {len(shard_files)} shards"
+            )
+            return None
+        else:
+            processed_files = _process(
+                s3_client,
+                job,
+                f"{processed_dir}/{os.path.basename(export_s3_directory)}",
+                data_files,
+                latest_changes,
+                stage_metrics,
+                digest_diff,
+            )
+    if digest_diff is not None:
+        with stage_metrics.timed("WriteDigestIndex"):
+            processed_files += _write_digest_index(
+                s3_client,
+                job,
+                f"{processed_dir}/{os.path.basename(export_s3_directory)}",
+                digest_diff,
+            )
+        stage_metrics.add("UnchangedRows", digest_diff.unchanged)
+    stage_metrics.add("DataFiles", len(data_files))
+    stage_metrics.add("ProcessedFiles", len(processed_files))
+
+    return _write_redshift_manifest(s3_client, job, processed_files)
+
+
+def handle_shard(s3_client: Any, shard_file: str) -> str:
+    """
+    Process the data files of one shard of an export, see `Config.MANIFEST_SHARD_FILES`,
+    or index their latest changes, see `_write_index_shards`, and record it done, which
+    triggers `handle_fan_in`.
+
+    Args:
+        s3_client (Any): boto3 s3 client
+        shard_file (str): s3 path to the shard task, written by `_write_shards` or `_write_index_shards`
+
+    Returns:
+        str: s3 path to the record that the shard is done
+    """
+    Config.logger.info("shard received " + shard_file)
+    job = manifest_shards.read_job(s3_client, Config.S3_BUCKET, shard_file)
+    shard = s3_utils.read_json_from_s3(s3_client, Config.S3_BUCKET, shard_file)
+    if job["phase"] == manifest_shards.INDEX_PHASE:
+        return _index_shard(s3_client, job, shard_file, shard)
+    latest_changes = None
+    if shard["latest_changes_file"] is not None:
+        latest_changes = _read_latest_changes(s3_client, shard["latest_changes_file"])
+
+    with metrics.StageMetrics(
+        "redshift_manifest_creation", job["dynamodb_table_name"]
+    ) as stage_metrics:
+        with stage_metrics.timed("ProcessDataFiles"):
+            processed_files = _process(
+                s3_client,
+                job,
+                f"{job['table_s3_prefix']}/AWSDynamoDB/processed/"
+                f"{os.path.basename(job['export_s3_directory'])}/shard-{shard['shard_index']:05d}",
+                shard["data_files"],
+                latest_changes,
+                stage_metrics,
+            )
+        stage_metrics.add("DataFiles", len(shard["data_files"]))
+        stage_metrics.add("ProcessedFiles", len(processed_files))
+
+    return manifest_shards.record_done(
+        s3_client, Config.S3_BUCKET, shard_file, processed_files
+    )
+
+
+def handle_fan_in(s3_client: Any, shard_done_file: str) -> Union[str, None]:
+    """
+    Write the redshift manifest of a sharded export, once every shard is done, or, once
+    every index shard is done, the shards that process it, see `_write_index_shards`.
+    Must not run concurrently for the same export, see app.py.
+
+    Args:
+        s3_client (Any): boto3 s3 client
+        shard_done_file (str): s3 path to the record that a shard is done
+
+    Returns:
+        str: s3 path to redshift manifest file, or None if shards are still processing
+    """
+    job = manifest_shards.read_job(s3_client, Config.S3_BUCKET, shard_done_file)
+    shards_dir = os.path.dirname(shard_done_file)
+    shard_processed_files = manifest_shards.read_done(
+        s3_client, Config.S3_BUCKET, shards_dir, job["shard_count"]
+    )
+    if shard_processed_files is None:
+        Config.logger.info(f"Waiting for the other shards in {shards_dir}")
+        return None
+    if not manifest_shards.claim_fan_in(s3_client, Config.S3_BUCKET, shards_dir):
+        Config.logger.info(f"Shards in {shards_dir} have already been fanned in")
+        return None
+
+    Config.logger.info(f"All {job['shard_count']} shards in {shards_dir} are done")
+    shard_files = [f for files in shard_processed_files for f in files]
+    if job["phase"] == manifest_shards.INDEX_PHASE:
+        _write_compacted_shards(s3_client, job, shard_files)
+        return None
+    return _write_redshift_manifest(s3_client, job, shard_files)
+
+
+def _write_shards(
+    s3_client: Any,
+    job: dict,
+    data_files: List[str],
+    latest_changes_files: List[str] = None,
+) -> List[str]:
+    """
+    Split the data files into shards of `Config.MANIFEST_SHARD_FILES`, and write a task for each,
+    with the latest changes in its files, if compacted, see `_write_compacted_shards`.
+    """
+    shard_size = Config.MANIFEST_SHARD_FILES
+    shards = [
+        {
+            "data_files": data_files[start : start + shard_size],
+            "latest_changes_file": (
+                None
+                if latest_changes_files is None
+                else latest_changes_files[start // shard_size]
+            ),
+        }
+        for start in range(0, len(data_files), shard_size)
+    ]
+    return manifest_shards.write_shards(
+        s3_client, Config.S3_BUCKET, job["export_s3_directory"], job, shards
+    )
+
+
+def _write_index_shards(
+    s3_client: Any,
+    job: dict,
+    data_files: List[str],
+) -> List[str]:
+    """
+    Split the data files into shards of `Config.MANIFEST_SHARD_FILES`, each to index the latest
+    change per key in its files, see `_index_shard`, so no invocation reads the whole export.
+    The fan in resolves the latest change per key across them, then writes the shards that
+    process the export, see `_write_compacted_shards`.
+    """
+    shard_size = Config.MANIFEST_SHARD_FILES
+    shards = [
+        {"data_files": data_files[start : start + shard_size], "file_offset": start}
+        for start in range(0, len(data_files), shard_size)
+    ]
+    return manifest_shards.write_shards(
         s3_client,
         Config.S3_BUCKET,
-        manifest_files_path,
+        job["export_s3_directory"],
+        {**job, "data_files": data_files},
+        shards,
+        phase=manifest_shards.INDEX_PHASE,
     )
-    data_files = [x["dataFileS3Key"] for x in manifest_files_content]
 
-    if is_incremental:
-        # For incremental; deletes, updates, inserts can be in the same file
-        # and we need to do some work upfront for redshift
-        processed_files = [
-            _process_data_file(s3_client, table_s3_prefix, file) for file in data_files
-        ]
-    else:
-        # For full export, no processing required
-        processed_files = data_files
 
-    processed_files = [f for f in processed_files if f is not None]
+def _index_shard(s3_client: Any, job: dict, shard_file: str, shard: dict) -> str:
+    """
+    Index the latest change per key in the data files of an index shard, as a run of lines sorted
+    by key, see `_format_change_position`, and record it done. Returns the s3 path to the record.
+    """
+    with metrics.StageMetrics(
+        "redshift_manifest_creation", job["dynamodb_table_name"]
+    ) as stage_metrics:
+        with stage_metrics.timed("IndexChanges"):
+            latest_changes = _get_latest_changes(
+                s3_client,
+                shard["data_files"],
+                _get_noop_projection(job["dynamodb_table_name"]),
+                stage_metrics,
+            )
+            lines = sorted(
+                _format_change_position(
+                    key,
+                    (write_timestamp, shard["file_offset"] + file_index, line_index),
+                )
+                for key, (
+                    write_timestamp,
+                    file_index,
+                    line_index,
+                ) in latest_changes.items()
+            )
+            run_path = (
+                shard_file[: -len(manifest_shards.SHARD_SUFFIX)] + ".latest-changes.gz"
+            )
+            with s3_utils.S3GzipWriter(s3_client, Config.S3_BUCKET, run_path) as writer:
+                for line in lines:
+                    writer.write_line(line)
+        stage_metrics.add("DataFiles", len(shard["data_files"]))
+
+    return manifest_shards.record_done(
+        s3_client, Config.S3_BUCKET, shard_file, [run_path] if writer.rows else []
+    )
+
 
-    # If all processed files are None, then they are all empty, and there is nothing to process
-    if not processed_files:
+def _write_compacted_shards(
+    s3_client: Any,
+    job: dict,
+    run_paths: List[str],
+) -> List[str]:
+    """
+    Resolve the latest change per key of a sharded export from the sorted runs of its index
+    shards, and write the shards that process it, see `_write_shards`. The runs are streamed,
+    so only keys are read, a line per run at a time, and each latest change is written to the
+    file of the shard it is in, positioned relative to the shard's first file, so a change is
+    kept by exactly one shard, see `_transform_data_file`.
+
+    Returns:
+        List[str]: s3 paths to the shard tasks
+    """
+    data_files = job["data_files"]
+    shard_size = Config.MANIFEST_SHARD_FILES
+    shards_dir = manifest_shards.get_shards_dir(job["export_s3_directory"])
+    latest_changes_files = [
+        f"{shards_dir}/{shard_index:05d}.latest-changes.gz"
+        for shard_index in range((len(data_files) + shard_size - 1) // shard_size)
+    ]
+    writers = [
+        s3_utils.S3GzipWriter(s3_client, Config.S3_BUCKET, f)
+        for f in latest_changes_files
+    ]
+    lines = heapq.merge(
+        *(
+            s3_utils.iter_lines_from_s3(s3_client, Config.S3_BUCKET, p)
+            for p in run_paths
+        )
+    )
+    try:
+        changes = (_parse_change_position(line) for line in lines)
+        for key, key_changes in itertools.groupby(changes, key=lambda c: c[0]):
+            write_timestamp, file_index, line_index = max(p for _, p in key_changes)
+            shard_index, shard_file_index = divmod(file_index, shard_size)
+            writers[shard_index].write_line(
+                _format_change_position(
+                    key, (write_timestamp, shard_file_index, line_index)
+                )
+            )
+        for writer in writers:
+            writer.close()
+    except:
+        for writer in writers:
+            writer.abort()
+        raise
+
+    process_job = {
+        k: v for k, v in job.items() if k not in ("data_files", "shard_count", "phase")
+    }
+    return _write_shards(s3_client, process_job, data_files, latest_changes_files)
+
+
+def _format_change_position(key: str, position: ChangePosition) -> str:
+    """
+    A line of the latest changes of a shard, `<key>\\t<write timestamp>\\t<file index>\\t<line index>`.
+    Keys are compact json, so have no tabs, and lines sort by key.
+    """
+    return "\t".join([key, *(str(p) for p in position)])
+
+
+def _parse_change_position(line: str) -> Tuple[str, ChangePosition]:
+    key, *position = line.rsplit("\t", 3)
+    return key, tuple(int(p) for p in position)
+
+
+def _read_latest_changes(
+    s3_client: Any,
+    latest_changes_file: str,
+) -> Dict[str, ChangePosition]:
+    """Get the latest changes of a shard, see `_write_compacted_shards`, none if the file is empty."""
+    if not s3_utils.exists(s3_client, Config.S3_BUCKET, latest_changes_file):
+        return {}  # no changes in the shard's files are the latest of their key
+    return dict(
+        _parse_change_position(line)
+        for line in s3_utils.iter_lines_from_s3(
+            s3_client, Config.S3_BUCKET, latest_changes_file
+        )
+    )
+
+
+def _get_noop_projection(dynamodb_table_name: str) -> Union[jsonpaths.Projection, None]:
+    """The projection `_get_latest_changes` drops no-op updates with, with `Config.DROP_NOOP_UPDATES`."""
+    if not Config.DROP_NOOP_UPDATES:
+        return None
+    return Config.TABLE_PROJECTIONS[dynamodb_table_name]
+
+
+def _process(
+    s3_client: Any,
+    job: dict,
+    chunks_dir: str,
+    data_files: List[str],
+    latest_changes: Dict[str, ChangePosition],
+    stage_metrics: metrics.StageMetrics,
+    digest_diff: "_DigestDiff" = None,
+) -> List[str]:
+    """Process data files, with `Config.REDSHIFT_SLICE_COUNT` into `chunks_dir`. Returns the processed files."""
+    dynamodb_table_name = job["dynamodb_table_name"]
+    if Config.REDSHIFT_SLICE_COUNT > 0:
+        if Config.CHECKPOINT_PROCESSED_FILES:
+            Config.logger.warning(
+                "CHECKPOINT_PROCESSED_FILES is ignored with REDSHIFT_SLICE_COUNT, "
+                "as the chunks hold rows from every data file"
+            )
+        # re-chunk into evenly sized files, to keep every redshift slice busy in the COPY
+        return _process_data_files_into_chunks(
+            s3_client,
+            dynamodb_table_name,
+            chunks_dir,
+            data_files,
+            latest_changes,
+            job["split_deletes"],
+            stage_metrics,
+            digest_diff,
+        )
+    # For incremental; deletes, updates, inserts can be in the same file
+    # and we need to do some work upfront for redshift
+    return [
+        f
+        for files in _process_data_files(
+            s3_client,
+            dynamodb_table_name,
+            f"{job['table_s3_prefix']}/AWSDynamoDB/processed",
+            data_files,
+            latest_changes,
+            job["split_deletes"],
+            stage_metrics,
+            digest_diff,
+        )
+        for f in files
+    ]
+
+
+def _write_redshift_manifest(
+    s3_client: Any,
+    job: dict,
+    processed_files: List[str],
+) -> Union[str, None]:
+    """
+    Write the redshift manifest of an export's processed files, which triggers the upsert.
+
+    Returns:
+        str: s3 path to redshift manifest file, or None if there is nothing to apply
+    """
+    dynamodb_table_name = job["dynamodb_table_name"]
+    table_s3_prefix = job["table_s3_prefix"]
+    export_s3_directory = job["export_s3_directory"]
+    is_incremental = job["is_incremental"]
+    export_arns = job["export_arns"]
+    split_deletes = job["split_deletes"]
+    table_details = Config.TABLE_DETAILS[dynamodb_table_name]
+
+    deletes_files = [f for f in processed_files if _is_deletes_file(f)]
+    processed_files = [f for f in processed_files if not _is_deletes_file(f)]
+
+    redshift_manifest_path = f"{export_s3_directory}/redshift.manifest"
+    is_ordered = is_incremental and Config.ORDERED_APPLY
+
+    # If there are no processed files, then the data files are all empty, and there is nothing to process
+    if not processed_files and not deletes_files:
         Config.logger.info(f"All files are empty, skipping")
         empty_marker_path = f"{export_s3_directory}/processed_no_data.txt"
         s3_client.put_object(Bucket=Config.S3_BUCKET, Key=empty_marker_path, Body="")
-        return None
+        if job.get("digest_index"):
+            # nothing changed since the last full export, so nothing to apply first
+            digest_index.promote(s3_client, Config.S3_BUCKET, job["digest_index"])
+        if not is_ordered or not _record_ready(
+            s3_client, table_s3_prefix, export_arns, None
+        ):
+            return None
 
     # add required info to the redshift manifest file, so the COPY command can use it
-    dynamodb_table_name = table_s3_prefix.split("/")[-1]
-    table_details = Config.TABLE_DETAILS.get(dynamodb_table_name, None)
-    if table_details is None:
-        raise Exception(
-            f"Unable to find table details for {dynamodb_table_name} in table_mapping.json"
-        )
     json_paths = table_details["jsonpaths"]
     redshift_table = (
         Config.REDSHIFT_TARGET_SCHEMA + "." + table_details["redshift_table"]
@@ -77,11 +583,27 @@ def handle(
     sort_key = table_details.get("sort_key", None)
     format_time = table_details["format_time"]
 
+    output_format = Config.OUTPUT_FORMAT
+    deletes_manifest_path = None
+    if split_deletes:
+        json_paths = _get_upsert_jsonpaths(json_paths)
+    if deletes_files:
+        deletes_manifest_path = f"{export_s3_directory}/redshift-deletes.manifest"
+        deletes_manifest = {
+            "entries": _get_manifest_entries(s3_client, deletes_files),
+            "jsonpaths": _get_key_jsonpaths(dynamodb_table_name),
+            "key_columns": [k for k in (partition_key, sort_key) if k],
+        }
+        # written first, as the redshift.manifest triggers the upsert
+        s3_client.put_object(
+            Bucket=Config.S3_BUCKET,
+            Key=deletes_manifest_path,
+            Body=json.dumps(deletes_manifest, indent=4),
+        )
+
     redshift_manifest = {
-        "entries": [
-            {"url": f"s3://{Config.S3_BUCKET}/{p}", "mandatory": True}
-            for p in processed_files
-        ],
+        "entries": _get_manifest_entries(s3_client, processed_files),
+        "output_format": output_format,
         "dynamodb_table_name": dynamodb_table_name,
         "is_incremental": is_incremental,
         "redshift_table": redshift_table,
@@ -89,10 +611,24 @@ def handle(
         "sort_key": sort_key,
         "format_time": format_time,
         "jsonpaths": json_paths,
+        "export_arns": export_arns,
+        "split_deletes": split_deletes,
+        "deletes_manifest": deletes_manifest_path,
+        "item_count": job["item_count"],
+        "digest_index": job.get("digest_index"),
     }
+    if is_incremental and Config.UPSERT_ACCUMULATE:
+        # used to decide when enough has accumulated, see upsert_accumulator.py
+        redshift_manifest["content_length"] = sum(
+            _get_content_length(s3_client, p) for p in processed_files + deletes_files
+        )
 
-    # write the manifest file to s3
-    redshift_manifest_path = f"{export_s3_directory}/redshift.manifest"
+    if is_ordered and (processed_files or deletes_files):
+        # the ledger must say the export is ready before the manifest triggers the upsert
+        _record_ready(s3_client, table_s3_prefix, export_arns, redshift_manifest_path)
+
+    # write the manifest file to s3. With no data, in ordered mode, this is only to trigger
+    # the upsert to apply any later exports that were held waiting for this one
     Config.logger.info(f"Saving redshift manifest to {redshift_manifest_path}")
     s3_client.put_object(
         Bucket=Config.S3_BUCKET,
@@ -103,57 +639,853 @@ def handle(
     return redshift_manifest_path
 
 
-def _process_data_file(
+def _record_ready(
+    s3_client: Any,
+    table_s3_prefix: str,
+    export_arns: List[str],
+    redshift_manifest_path: Union[str, None],
+) -> bool:
+    """Mark exports ready to apply in the table's ledger. Returns False if none are in the ledger."""
+    recorded = [
+        export_ledger.record_ready(
+            s3_client,
+            Config.S3_BUCKET,
+            table_s3_prefix,
+            export_arn,
+            redshift_manifest_path,
+        )
+        for export_arn in export_arns
+    ]
+    return any(recorded)
+
+
+def _get_manifest_entries(s3_client: Any, files: List[str]) -> List[dict]:
+    """Get the entries of a redshift manifest, to COPY `files`."""
+    entries = [
+        {"url": f"s3://{Config.S3_BUCKET}/{p}", "mandatory": True} for p in files
+    ]
+    if Config.OUTPUT_FORMAT == output_formats.PARQUET:
+        # COPY from columnar files requires the size of each file in the manifest
+        for entry, p in zip(entries, files):
+            entry["meta"] = {"content_length": _get_content_length(s3_client, p)}
+    return entries
+
+
+def _get_upsert_jsonpaths(json_paths: List[str]) -> List[str]:
+    """The jsonpaths of the columns of the target table, i.e. without `is_active`."""
+    return [p for p in json_paths if jsonpaths.parse_jsonpath(p)[1] != "is_active"]
+
+
+def _get_key_attributes(dynamodb_table_name: str) -> List[str]:
+    table_details = Config.TABLE_DETAILS[dynamodb_table_name]
+    return [
+        k for k in (table_details["partition_key"], table_details.get("sort_key")) if k
+    ]
+
+
+def _get_key_jsonpaths(dynamodb_table_name: str) -> List[str]:
+    """
+    The jsonpaths of the key columns, in key order, for COPY of key-only delete files.
+
+    Raises:
+        - Exception: if a key attribute is not in the table's jsonpaths
+    """
+    json_paths = Config.TABLE_DETAILS[dynamodb_table_name]["jsonpaths"]
+    key_json_paths = []
+    for key in _get_key_attributes(dynamodb_table_name):
+        key_json_path = next(
+            (p for p in json_paths if jsonpaths.parse_jsonpath(p)[1] == key), None
+        )
+        if key_json_path is None:
+            raise Exception(
+                f"Key {key} of {dynamodb_table_name} is not in its jsonpaths in table_mapping.json"
+            )
+        key_json_paths.append(key_json_path)
+    return key_json_paths
+
+
+def _is_deletes_file(s3_file_path: str) -> bool:
+    return f"/{_DELETES_DIR}/" in s3_file_path
+
+
+def _get_data_files(s3_client: Any, manifest_summary: dict) -> List[str]:
+    """Get the s3 paths of the data files of an export, from its manifest summary."""
+    manifest_files_content = s3_utils.read_json_from_s3(
+        s3_client,
+        Config.S3_BUCKET,
+        manifest_summary["manifestFilesS3Key"],
+    )
+    if isinstance(manifest_files_content, dict):
+        # a single data file is a single json line, so reads as one object
+        manifest_files_content = [manifest_files_content]
+    return [x["dataFileS3Key"] for x in manifest_files_content]
+
+
+def _get_group_manifest_summaries(
     s3_client: Any,
     table_s3_prefix: str,
+    group: List[str],
+) -> Union[List[dict], None]:
+    """
+    Get the manifest summaries of a group of backlog exports, oldest first,
+    or None if any of the exports has not completed yet.
+
+    If the last two exports of a group complete at the same time, both invocations can see the
+    group as complete, and the same combined manifest is written twice. Applying it twice is safe,
+    as it holds at most one change per key (see `Config.COMPACT_INCREMENTAL_CHANGES`).
+    """
+    manifest_summary_paths = [
+        export_groups.get_manifest_summary_path(table_s3_prefix, export_id)
+        for export_id in group
+    ]
+    if not all(
+        s3_utils.exists(s3_client, Config.S3_BUCKET, path)
+        for path in manifest_summary_paths
+    ):
+        return None
+    return [
+        s3_utils.read_json_from_s3(s3_client, Config.S3_BUCKET, path)
+        for path in manifest_summary_paths
+    ]
+
+
+def _process_data_files(
+    s3_client: Any,
+    dynamodb_table_name: str,
+    processed_dir: str,
+    data_files: List[str],
+    latest_changes: Dict[str, ChangePosition] = None,
+    split_deletes: bool = False,
+    stage_metrics: metrics.StageMetrics = None,
+    digest_diff: "_DigestDiff" = None,
+) -> List[List[str]]:
+    """
+    Processes data files concurrently, with at most `Config.MANIFEST_MAX_WORKERS` files in flight.
+    With `Config.CHECKPOINT_PROCESSED_FILES`, files already processed by an earlier attempt
+    are skipped, see `checkpoints.read_checkpoint`.
+
+    Args:
+        s3_client (Any): boto3 s3 client
+        dynamodb_table_name (str): name of the exported table
+        processed_dir (str): s3 directory to write the processed files to
+        data_files (List[str]): s3 paths to data files
+        latest_changes (Dict[str, ChangePosition]): if given, only the latest change per key is kept,
+            see `_get_latest_changes`
+        split_deletes (bool): write deletes to separate key-only files, see `_open_processed_writer`
+        stage_metrics (metrics.StageMetrics): if given, the processing metrics are added to it,
+            see `_add_processing_metrics`
+        digest_diff (_DigestDiff): if given, items unchanged since the last full export are dropped
+
+    Returns:
+        List[List[str]]: s3 paths to the processed files of each data file, in the same order as `data_files`
+
+    Raises:
+        Exception: if any data file failed to process, after all files have been attempted
+    """
+    stats = _ProcessingStats()
+    settings = {
+        "output_format": Config.OUTPUT_FORMAT,
+        # which changes are kept depends on every file of the export, and their order
+        "compacted_with": (
+            None
+            if latest_changes is None
+            else hashlib.sha256("\n".join(data_files).encode()).hexdigest()
+        ),
+        "split_deletes": split_deletes,
+        "drop_noop_updates": Config.DROP_NOOP_UPDATES,
+    }
+    skipped = []
+
+    def process(file_index, file):
+        etag = None
+        # the digests of a skipped file would be missing from the digest index
+        if Config.CHECKPOINT_PROCESSED_FILES and digest_diff is None:
+            # a retry only processes the files an earlier attempt didn't finish
+            etag = checkpoints.get_etag(s3_client, Config.S3_BUCKET, file)
+            files = checkpoints.read_checkpoint(
+                s3_client, Config.S3_BUCKET, processed_dir, file, etag, settings
+            )
+            if files is not None:
+                Config.logger.info(f"File {file} is already processed, skipping")
+                skipped.append(file)
+                return files
+        files = _process_data_file(
+            s3_client,
+            dynamodb_table_name,
+            processed_dir,
+            file,
+            file_index=file_index,
+            latest_changes=latest_changes,
+            split_deletes=split_deletes,
+            stats=stats,
+            digest_diff=digest_diff,
+        )
+        if etag is not None:
+            checkpoints.write_checkpoint(
+                s3_client, Config.S3_BUCKET, processed_dir, file, etag, settings, files
+            )
+        return files
+
+    processed_files = _map_data_files(
+        process, data_files, f"processing for {dynamodb_table_name}"
+    )
+    if stage_metrics is not None:
+        _add_processing_metrics(stage_metrics, stats)
+        if Config.CHECKPOINT_PROCESSED_FILES:
+            stage_metrics.add("CheckpointedFiles", len(skipped))
+    return processed_files
+
+
+def _get_latest_changes(
+    s3_client: Any,
+    data_files: List[str],
+    projection: jsonpaths.Projection = None,
+    stage_metrics: metrics.StageMetrics = None,
+) -> Dict[str, ChangePosition]:
+    """
+    Find the latest change for each key in an incremental export.
+
+    Changes are ordered by the `WriteTimestampMicros` export metadata, then by position
+    in the export (data file, then line) for changes written in the same microsecond.
+    Only keys and positions are held in memory, not the changes themselves.
+
+    Args:
+        s3_client (Any): boto3 s3 client
+        data_files (List[str]): s3 paths to data files
+        projection (jsonpaths.Projection): if given, no-op updates are not changes, see
+            `_is_noop_update`. The latest change is then the last one loaded columns can
+            tell apart, and keys with only no-op updates have none
+        stage_metrics (metrics.StageMetrics): if given, the no-op updates are added to it
+
+    Returns:
+        Dict[str, ChangePosition]: position of the latest change, by key
+    """
+    noop_updates = []
+
+    def index_file(file_index, file):
+        latest_changes = {}
+        file_noop_updates = 0
+        lines = s3_utils.iter_lines_from_s3(
+            s3_client,
+            Config.S3_BUCKET,
+            file,
+            part_size=Config.S3_DOWNLOAD_PART_SIZE_BYTES,
+            max_concurrency=Config.S3_DOWNLOAD_CONCURRENCY,
+        )
+        for line_index, line in enumerate(lines):
+            change = json.loads(line)
+            if projection is not None and _is_noop_update(change, projection):
+                file_noop_updates += 1
+                continue
+            key, position = _get_change_position(change, file_index, line_index)
+            if key not in latest_changes or position > latest_changes[key]:
+                latest_changes[key] = position
+        noop_updates.append(file_noop_updates)
+        return latest_changes
+
+    latest_changes = {}
+    for file_latest_changes in _map_data_files(index_file, data_files, "indexing"):
+        for key, position in file_latest_changes.items():
+            if key not in latest_changes or position > latest_changes[key]:
+                latest_changes[key] = position
+    if stage_metrics is not None and projection is not None:
+        stage_metrics.add("NoopUpdates", sum(noop_updates))
+    return latest_changes
+
+
+def _get_change_position(
+    change: dict,
+    file_index: int,
+    line_index: int,
+) -> Tuple[str, ChangePosition]:
+    """Get the key of a change, and its position in the order changes were written."""
+    key = json.dumps(change["Keys"], sort_keys=True, separators=(",", ":"))
+    write_timestamp = (
+        change.get("Metadata", {}).get("WriteTimestampMicros", {}).get("N", 0)
+    )
+    return key, (int(write_timestamp), file_index, line_index)
+
+
+def _map_data_files(
+    func: Callable[[int, str], Any],
+    data_files: List[str],
+    description: str,
+) -> List[Any]:
+    """
+    Call `func(file_index, file)` for each data file, with at most `Config.MANIFEST_MAX_WORKERS`
+    files in flight. Results are returned in the same order as `data_files`.
+
+    Raises:
+        Exception: if any call failed, after all files have been attempted
+    """
+
+    def call(args):
+        file_index, file = args
+        try:
+            return func(file_index, file), None
+        except Exception as ex:
+            # don't throw here, attempt other files first
+            Config.logger.error(f"Error when {description} file {file}: {ex}")
+            return None, ex
+
+    with ThreadPoolExecutor(max_workers=Config.MANIFEST_MAX_WORKERS) as executor:
+        results = list(executor.map(call, enumerate(data_files)))
+
+    errors = [
+        {"File": file, "Exception": ex}
+        for file, (_, ex) in zip(data_files, results)
+        if ex is not None
+    ]
+    if errors:
+        raise Exception(
+            f"{len(errors)} of {len(data_files)} data files failed {description}. See logs for more details."
+        ) from errors[0]["Exception"]
+
+    return [result for result, _ in results]
+
+
+def _process_data_files_into_chunks(
+    s3_client: Any,
+    dynamodb_table_name: str,
+    processed_dir: str,
+    data_files: List[str],
+    latest_changes: Dict[str, ChangePosition] = None,
+    split_deletes: bool = False,
+    stage_metrics: metrics.StageMetrics = None,
+    digest_diff: "_DigestDiff" = None,
+) -> List[str]:
+    """
+    Processes data files concurrently, re-chunking the rows into evenly sized files
+    rather than writing one processed file per data file.
+
+    The files are written in sets of `Config.REDSHIFT_SLICE_COUNT`, each up to
+    `Config.PROCESSED_FILE_TARGET_BYTES` uncompressed, so a `COPY ... MANIFEST` can split
+    the load evenly across the slices of the cluster.
+
+    Args:
+        s3_client (Any): boto3 s3 client
+        dynamodb_table_name (str): name of the exported table
+        processed_dir (str): s3 directory to write the processed files to
+        data_files (List[str]): s3 paths to data files
+        latest_changes (Dict[str, ChangePosition]): if given, only the latest change per key is kept,
+            see `_get_latest_changes`
+        split_deletes (bool): write deletes to separate key-only files, see `_open_processed_writer`
+        stage_metrics (metrics.StageMetrics): if given, the processing metrics are added to it,
+            see `_add_processing_metrics`
+        digest_diff (_DigestDiff): if given, items unchanged since the last full export are dropped
+
+    Returns:
+        List[str]: s3 paths to processed files
+
+    Raises:
+        Exception: if any data file failed to process, after all files have been attempted
+    """
+
+    def open_chunks(sub_dir="", columns=None):
+        return output_formats.ChunkedItemWriter(
+            lambda slot, chunk: _open_item_writer(
+                s3_client,
+                dynamodb_table_name,
+                f"{processed_dir}/{sub_dir}part-{slot:04d}-{chunk:04d}",
+                columns,
+            ),
+            slots=Config.REDSHIFT_SLICE_COUNT,
+            target_bytes=Config.PROCESSED_FILE_TARGET_BYTES,
+        )
+
+    stats = _ProcessingStats()
+
+    def process(file_index, file):
+        Config.logger.info(f"Processing file {file}")
+        file_stats = defaultdict(float)
+        _write_items(
+            writer,
+            _transform_data_file(
+                s3_client,
+                dynamodb_table_name,
+                file,
+                file_index,
+                latest_changes,
+                file_stats,
+                digest_diff,
+            ),
+            file_stats,
+        )
+        stats.merge(file_stats)
+
+    if split_deletes:
+        writer = _SplitItemWriter(
+            open_chunks(columns=_get_upsert_columns(dynamodb_table_name)),
+            open_chunks(f"{_DELETES_DIR}/", _get_key_columns(dynamodb_table_name)),
+            _get_key_attributes(dynamodb_table_name),
+        )
+    else:
+        writer = open_chunks()
+
+    with writer:
+        _map_data_files(process, data_files, f"processing for {processed_dir}")
+
+    if stage_metrics is not None:
+        # the chunks are shared by all files, so their totals are only known once closed
+        stats.merge(_get_writer_stats(writer))
+        _add_processing_metrics(stage_metrics, stats)
+    Config.logger.info(f"Saved {len(writer.files)} processed files to {processed_dir}")
+    return writer.files
+
+
+def _process_data_file(
+    s3_client: Any,
+    dynamodb_table_name: str,
+    processed_dir: str,
     file: str,
-) -> Union[str, None]:
+    file_index: int = 0,
+    latest_changes: Dict[str, ChangePosition] = None,
+    split_deletes: bool = False,
+    stats: "_ProcessingStats" = None,
+    digest_diff: "_DigestDiff" = None,
+) -> List[str]:
     """
     Processes a single data file from dynamodb export into a format Redshift can ingest.
 
+    The file is streamed: rows are read, transformed and compressed one at a time, and
+    uploaded in parts, so memory use does not depend on the size of the file.
+    Only the attributes in the table's jsonpaths are written, plus `is_active`.
+
     Args:
         s3_client (Any): boto3 s3 client
-        table_s3_prefix (str): s3 path to dynamodb table
+        dynamodb_table_name (str): name of the exported table
+        processed_dir (str): s3 directory to write the processed file to
         file (str): s3 path to data file
+        file_index (int): position of the file in the export, used with `latest_changes`
+        latest_changes (Dict[str, ChangePosition]): if given, changes that are not the latest
+            for their key are dropped
+        split_deletes (bool): write deletes to separate key-only files, see `_open_processed_writer`
+        stats (_ProcessingStats): if given, the stats of the file are added to it
+        digest_diff (_DigestDiff): if given, items unchanged since the last full export are dropped
 
     Returns:
-        str: s3 path to processed data file, or None if the file is empty
+        List[str]: s3 paths to processed files, empty if the file is empty
     """
     Config.logger.info(f"Processing file {file}")
-    contents = s3_utils.read_contents_from_s3(
+    file_name = file.split("/")[-1].split(".")[0]
+
+    with _open_processed_writer(
+        s3_client, dynamodb_table_name, processed_dir, file_name, split_deletes
+    ) as writer:
+        file_stats = defaultdict(float)
+        _write_items(
+            writer,
+            _transform_data_file(
+                s3_client,
+                dynamodb_table_name,
+                file,
+                file_index,
+                latest_changes,
+                file_stats,
+                digest_diff,
+            ),
+            file_stats,
+        )
+
+        if writer.rows == 0:
+            Config.logger.info(f"File {file} is empty, skipping")
+
+    if stats is not None:
+        file_stats.update(_get_writer_stats(writer))
+        stats.merge(file_stats)
+    Config.logger.info(f"Saved processed files {writer.files}")
+    return writer.files
+
+
+def _write_items(writer: Any, items: Iterator[dict], stats: Dict[str, float]):
+    """Write `items`, adding the seconds spent producing them ("Transform") and writing them ("Write") to `stats`."""
+    for item in metrics.timed_iter(items, stats, "Transform"):
+        start = time.perf_counter()
+        writer.write_item(item)
+        stats["Write"] += time.perf_counter() - start
+
+
+def _get_writer_stats(writer: Any) -> Dict[str, float]:
+    return {
+        "rows_written": writer.rows,
+        "bytes_in": writer.bytes_in,
+        "bytes_out": writer.bytes_out,
+        "S3Write": writer.upload_seconds,
+    }
+
+
+class _ProcessingStats:
+    """Totals of the stats of each processed data file, which are processed concurrently."""
+
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def merge(self, stats: Dict[str, float]):
+        with self._lock:
+            for name, value in stats.items():
+                self.totals[name] += value
+
+
+def _add_processing_metrics(
+    stage_metrics: metrics.StageMetrics, stats: _ProcessingStats
+):
+    """
+    Add the processing metrics of a manifest. Times are summed over the data files, which are
+    processed concurrently, so can add up to more than the time taken:
+    - S3ReadTime, reading and decompressing the data files
+    - TransformTime, parsing, compacting and projecting the rows
+    - EncodeTime, encoding and compressing the processed rows
+    - S3WriteTime, uploading the processed files
+    """
+    totals = stats.totals
+    stage_metrics.add_timings(
+        {
+            "S3Read": totals["S3Read"],
+            "Transform": max(totals["Transform"] - totals["S3Read"], 0),
+            "Encode": max(totals["Write"] - totals["S3Write"], 0),
+            "S3Write": totals["S3Write"],
+        }
+    )
+    stage_metrics.add("S3ReadBytes", totals["bytes_read"], MetricUnit.Bytes)
+    stage_metrics.add("S3WriteBytes", totals["bytes_out"], MetricUnit.Bytes)
+    stage_metrics.add("RowsRead", totals["rows_read"])
+    stage_metrics.add("RowsWritten", totals["rows_written"])
+    stage_metrics.add("Upserts", totals["upserts"])
+    stage_metrics.add("Deletes", totals["deletes"])
+    if Config.DROP_NOOP_UPDATES and "noop_updates" in totals:
+        stage_metrics.add("NoopUpdates", totals["noop_updates"])
+    if totals["bytes_in"] > 0:
+        stage_metrics.add(
+            "CompressionPercent",
+            100 * totals["bytes_out"] / totals["bytes_in"],
+            MetricUnit.Percent,
+        )
+
+
+def _open_processed_writer(
+    s3_client: Any,
+    dynamodb_table_name: str,
+    processed_dir: str,
+    file_name: str,
+    split_deletes: bool = False,
+) -> Union[
+    output_formats.JsonItemWriter, output_formats.ParquetItemWriter, "_SplitItemWriter"
+]:
+    """
+    Open a writer for the processed items of a data file, at `processed_dir/file_name`.
+
+    With `split_deletes`, only active items are written there, without `is_active`, so shaped
+    like the target table. The keys of deleted items are written to `processed_dir/deletes/file_name`.
+    """
+    if not split_deletes:
+        return _open_item_writer(
+            s3_client, dynamodb_table_name, f"{processed_dir}/{file_name}"
+        )
+    return _SplitItemWriter(
+        _open_item_writer(
+            s3_client,
+            dynamodb_table_name,
+            f"{processed_dir}/{file_name}",
+            _get_upsert_columns(dynamodb_table_name),
+        ),
+        _open_item_writer(
+            s3_client,
+            dynamodb_table_name,
+            f"{processed_dir}/{_DELETES_DIR}/{file_name}",
+            _get_key_columns(dynamodb_table_name),
+        ),
+        _get_key_attributes(dynamodb_table_name),
+    )
+
+
+def _open_item_writer(
+    s3_client: Any,
+    dynamodb_table_name: str,
+    s3_file_stem: str,
+    columns: List[output_formats.Column] = None,
+) -> Union[output_formats.JsonItemWriter, output_formats.ParquetItemWriter]:
+    """Open a writer for processed items in `Config.OUTPUT_FORMAT`, by default with all the table's columns."""
+    return output_formats.open_item_writer(
         s3_client,
         Config.S3_BUCKET,
-        file,
+        s3_file_stem,
+        Config.OUTPUT_FORMAT,
+        columns or Config.TABLE_COLUMNS[dynamodb_table_name],
+        part_size=Config.MULTIPART_PART_SIZE_BYTES,
     )
-    if not contents:
-        Config.logger.info(f"File {file} is empty, skipping")
-        return None
 
-    lines = contents.splitlines()
 
-    def process_row(line):
-        line = json.loads(line)
-        if "NewImage" not in line:
-            # handle deletion
-            line["Item"] = line.pop("OldImage")
-            line["Item"]["is_active"] = {"BOOL": False}
+def _get_upsert_columns(dynamodb_table_name: str) -> List[output_formats.Column]:
+    return [
+        c for c in Config.TABLE_COLUMNS[dynamodb_table_name] if c.keys[0] != "is_active"
+    ]
+
+
+def _get_key_columns(dynamodb_table_name: str) -> List[output_formats.Column]:
+    """The key columns of the table, in key order, see `_get_key_jsonpaths`."""
+    columns = Config.TABLE_COLUMNS[dynamodb_table_name]
+    return [
+        next(c for c in columns if c.keys[0] == key)
+        for key in _get_key_attributes(dynamodb_table_name)
+    ]
+
+
+class _SplitItemWriter:
+    """
+    Write active items, without `is_active`, to `upserts`, and only the keys of inactive
+    (deleted) items to `deletes`. Both writers are closed, or aborted, together.
+    """
+
+    def __init__(self, upserts: Any, deletes: Any, key_attributes: List[str]):
+        self.upserts = upserts
+        self.deletes = deletes
+        self.key_attributes = key_attributes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
         else:
-            # handle new item and update item
-            line["Item"] = line.pop("NewImage")
-            line["Item"]["is_active"] = {"BOOL": True}
-            line.pop("OldImage", None)  # ignore old image in the case of update
-        return json.dumps(line)
-
-    results = [process_row(line) for line in lines]
-    processed_contents = "\n".join(list(results))
-    compressed_contents = gzip.compress(bytes(processed_contents, "utf-8"))
-    processed_dir = f"{table_s3_prefix}/AWSDynamoDB/processed"
-    processed_file_path = f"{processed_dir}/{file.split('/')[-1]}"
+            self.close()
 
-    Config.logger.info(f"Saving processed file to {processed_file_path}")
-    s3_client.put_object(
-        Bucket=Config.S3_BUCKET,
-        Key=processed_file_path,
-        Body=compressed_contents,
+    @property
+    def rows(self) -> int:
+        return self.upserts.rows + self.deletes.rows
+
+    @property
+    def files(self) -> List[str]:
+        return self.upserts.files + self.deletes.files
+
+    @property
+    def bytes_in(self) -> int:
+        return self.upserts.bytes_in + self.deletes.bytes_in
+
+    @property
+    def bytes_out(self) -> int:
+        return self.upserts.bytes_out + self.deletes.bytes_out
+
+    @property
+    def upload_seconds(self) -> float:
+        return self.upserts.upload_seconds + self.deletes.upload_seconds
+
+    def write_item(self, item: dict):
+        item = dict(item)
+        is_active = item.pop("is_active")["BOOL"]
+        if is_active:
+            self.upserts.write_item(item)
+        else:
+            self.deletes.write_item(
+                {k: item[k] for k in self.key_attributes if k in item}
+            )
+
+    def close(self):
+        self.upserts.close()
+        self.deletes.close()
+
+    def abort(self):
+        self.upserts.abort()
+        self.deletes.abort()
+
+
+def _transform_data_file(
+    s3_client: Any,
+    dynamodb_table_name: str,
+    file: str,
+    file_index: int = 0,
+    latest_changes: Dict[str, ChangePosition] = None,
+    stats: Dict[str, float] = None,
+    digest_diff: "_DigestDiff" = None,
+) -> Iterator[dict]:
+    """
+    Stream the processed items of a data file, see `_process_data_file`.
+    If `stats` is given, the rows, bytes and seconds read, and the upserts and deletes kept,
+    are added to it.
+
+    With `Config.DROP_NOOP_UPDATES`, no-op updates are dropped, see `_is_noop_update`. With
+    `latest_changes` they already were, when indexed.
+    """
+    stats = defaultdict(float) if stats is None else stats
+    projection = Config.TABLE_PROJECTIONS[dynamodb_table_name]
+    digest_lines = []  # of the file's items, sorted into a run once read
+    lines = metrics.timed_iter(
+        s3_utils.iter_lines_from_s3(
+            s3_client,
+            Config.S3_BUCKET,
+            file,
+            stats,
+            part_size=Config.S3_DOWNLOAD_PART_SIZE_BYTES,
+            max_concurrency=Config.S3_DOWNLOAD_CONCURRENCY,
+        ),
+        stats,
+        "S3Read",
     )
-    return processed_file_path
+    for line_index, line in enumerate(lines):
+        stats["rows_read"] += 1
+        change = json.loads(line)
+        if latest_changes is not None:
+            key, position = _get_change_position(change, file_index, line_index)
+            if latest_changes.get(key) != position:
+                continue  # superseded by a later change to the same key, or in another shard
+        item = _process_change(change, projection)
+        if (
+            Config.DROP_NOOP_UPDATES
+            and latest_changes is None
+            and _is_noop_update(change, projection, item)
+        ):
+            stats["noop_updates"] += 1
+            continue
+        if digest_diff is not None and not digest_diff.is_changed(item, digest_lines):
+            continue
+        stats["upserts" if item["is_active"]["BOOL"] else "deletes"] += 1
+        yield item
+    if digest_diff is not None:
+        digest_diff.write_run(file, digest_lines)
+
+
+class _DigestDiff:
+    """
+    Diff the items of a full export against the digest index of the last one applied, see
+    `Config.DIFF_FULL_EXPORTS`. Items are digested as projected, so changes to attributes
+    that aren't loaded are ignored.
+
+    The previous digests are held as a `digest_index.DigestLookup`, at 16 bytes per item,
+    and the digests of each data file are sorted into a run in s3 once it has been read, so
+    the new index is merged from the runs without holding it, see `digest_index.write_index`.
+    """
+
+    def __init__(
+        self,
+        s3_client: Any,
+        key_attributes: List[str],
+        previous_index: Union[str, None],
+        runs_dir: str,
+    ):
+        self.s3_client = s3_client
+        self.key_attributes = key_attributes
+        # digest index of the last full export applied, None to keep every item
+        self.previous_index = previous_index
+        self.previous = (
+            digest_index.DigestLookup(s3_client, Config.S3_BUCKET, previous_index)
+            if previous_index is not None
+            else None
+        )
+        self.runs_dir = runs_dir
+        self.run_paths = []
+        self.unchanged = 0
+        self._lock = threading.Lock()  # data files are processed concurrently
+
+    def is_changed(self, item: dict, digest_lines: List[str]) -> bool:
+        """Add the digest of an item of the export to its file's lines. Returns False if it is unchanged."""
+        key = json.dumps(
+            {k: item.get(k) for k in self.key_attributes},
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+        digest = hashlib.blake2b(
+            json.dumps(item, sort_keys=True, separators=(",", ":")).encode("utf-8"),
+            digest_size=8,
+        ).hexdigest()
+        digest_lines.append(digest_index.format_line(key, digest))
+        is_unchanged = self.previous is not None and self.previous.contains(key, digest)
+        if is_unchanged:
+            with self._lock:
+                self.unchanged += 1
+        return not is_unchanged
+
+    def write_run(self, data_file: str, digest_lines: List[str]):
+        """Sort the digests of a data file into a run, once all its items have been diffed."""
+        run_path = f"{self.runs_dir}/{os.path.basename(data_file)}"
+        if digest_index.write_run(
+            self.s3_client, Config.S3_BUCKET, run_path, digest_lines
+        ):
+            with self._lock:
+                self.run_paths.append(run_path)
+
+
+def _write_digest_index(
+    s3_client: Any,
+    job: dict,
+    processed_dir: str,
+    digest_diff: _DigestDiff,
+) -> List[str]:
+    """
+    Write the digest index of a full export, and the items deleted since the last one applied,
+    see `_DigestDiff`. Returns the processed files of the deleted items.
+    """
+
+    def on_deleted(key: str):
+        item = json.loads(key)
+        item["is_active"] = {"BOOL": False}
+        writer.write_item(item)
+
+    with _open_processed_writer(
+        s3_client,
+        job["dynamodb_table_name"],
+        processed_dir,
+        "deleted",
+        job["split_deletes"],
+    ) as writer:
+        job["digest_index"] = digest_index.write_index(
+            s3_client,
+            Config.S3_BUCKET,
+            job["table_s3_prefix"],
+            job["export_s3_directory"],
+            sorted(digest_diff.run_paths),
+            digest_diff.previous_index,
+            on_deleted,
+        )
+    Config.logger.info(f"Saved {writer.rows} deleted items to {writer.files}")
+    return writer.files
+
+
+def _is_noop_update(
+    change: dict,
+    projection: jsonpaths.Projection,
+    item: dict = None,
+) -> bool:
+    """
+    Whether a change of an incremental export is an update that doesn't change any loaded
+    attribute, e.g. of a TTL or counter, so the target already has the new item. Needs the
+    exports to have the old images, which they do unless the table's stream only has new ones.
+
+    Args:
+        change (dict): a row of an incremental export
+        projection (jsonpaths.Projection): the projection of the table's items
+        item (dict): the change as processed by `_process_change`, if it already has been
+    """
+    if "NewImage" not in change or "OldImage" not in change:
+        return False  # an insert or delete, or no old image to compare
+    if item is None:
+        item = jsonpaths.project_item(change["NewImage"], projection)
+    else:
+        item = {k: v for k, v in item.items() if k != "is_active"}
+    return item == jsonpaths.project_item(change["OldImage"], projection)
+
+
+def _process_change(change: dict, projection: jsonpaths.Projection) -> dict:
+    """
+    Convert a row of an export to a slimmed item with an `is_active` flag.
+    Incremental exports have a `NewImage` and/or `OldImage`, full exports an `Item`.
+    """
+    if "Item" in change:
+        # handle full export
+        item = jsonpaths.project_item(change["Item"], projection)
+        item["is_active"] = {"BOOL": True}
+    elif "NewImage" not in change:
+        # handle deletion
+        item = jsonpaths.project_item(change["OldImage"], projection)
+        item["is_active"] = {"BOOL": False}
+    else:
+        # handle new item and update item, ignoring the old image in the case of update
+        item = jsonpaths.project_item(change["NewImage"], projection)
+        item["is_active"] = {"BOOL": True}
+    return item
+
+
+def _get_content_length(s3_client: Any, s3_file_path: str) -> int:
+    return s3_client.head_object(Bucket=Config.S3_BUCKET, Key=s3_file_path)[
+        "ContentLength"
+    ]
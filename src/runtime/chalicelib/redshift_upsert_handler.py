@@ -1,6 +1,29 @@
-from typing import Any, Callable
-from . import s3_utils, redshift_utils
+import hashlib
+import json
+from datetime import datetime
+from typing import Any, Callable, List, Tuple
+from . import digest_index, export_ledger, metrics, s3_utils, upsert_accumulator
 from .config import Config
+from .exceptions import RedshiftQueryException
+from .ttl_cache import TTLCache
+
+# ledger tables known to exist, so they are only created once per warm container
+_LEDGER_TABLES = TTLCache(ttl_seconds=Config.TABLE_METADATA_CACHE_TTL_SECONDS)
+
+# Full refresh strategies, see `Config.FULL_REFRESH_STRATEGY`
+INSERT = "insert"  # TRUNCATE and INSERT ... SELECT from a temp table
+SWAP = "swap"  # load a staging table and rename it over the target
+APPEND = "append"  # load a staging table and move its blocks with ALTER TABLE APPEND
+FULL_REFRESH_STRATEGIES = (INSERT, SWAP, APPEND)
+
+# Execution backends, see `Config.REDSHIFT_EXECUTION_BACKEND`
+PSYCOPG2 = "psycopg2"  # run the statements on a connection, waiting for them to finish
+DATA_API = "data_api"  # submit the statements as a Redshift Data API batch, and return
+EXECUTION_BACKENDS = (PSYCOPG2, DATA_API)
+
+# Batch commit modes, see `Config.UPSERT_BATCH_COMMIT`
+TABLE = "table"  # commit each manifest on its own
+GROUP = "group"  # commit all the manifests of a batch together
 
 
 def handle(
@@ -12,6 +35,10 @@ def handle(
     """
     Handle the Redshift UPSERT for the table described by the
     redshift.mainfest file that triggered the lambda.
+
+    With `Config.ORDERED_APPLY`, incremental manifests are applied in export window order,
+    see `_apply_in_order`. Full exports are applied with `Config.FULL_REFRESH_STRATEGY`,
+    see `_replace_table`.
     """
     Config.logger.info("redshift manifest received " + redshift_manifest_file)
 
@@ -20,83 +47,870 @@ def handle(
         Config.S3_BUCKET,
         redshift_manifest_file,
     )
-    dynamodb_table_name = redshift_manifest["dynamodb_table_name"]
+    target = redshift_manifest["redshift_table"]
+
+    with metrics.StageMetrics("redshift_upsert", target) as stage_metrics:
+        with get_redshift_connection_callback(credentials) as conn:
+            try:
+                conn.rollback()  # ensure no transaction is open
+                _apply(
+                    s3_client,
+                    conn,
+                    credentials,
+                    redshift_manifest_file,
+                    redshift_manifest,
+                    stage_metrics,
+                )
+
+                # Commit transaction
+                with stage_metrics.timed("Commit"):
+                    conn.commit()
+                if redshift_manifest.get("digest_index"):
+                    # the next full export is diffed against this one, now it's applied
+                    digest_index.promote(
+                        s3_client, Config.S3_BUCKET, redshift_manifest["digest_index"]
+                    )
+
+            except:
+                conn.rollback()
+                _LEDGER_TABLES.invalidate()  # in case the rollback undid creating one
+                stage_metrics.add("UpsertErrors", 1)
+                raise
+    return target
+
+
+def enqueue(
+    s3_client: Any,
+    redshift_manifest_file: str,
+) -> str:
+    """
+    Add a redshift manifest to the pending upserts, to be applied by `handle_batch`.
+
+    Returns:
+        str: s3 path to the pending upsert
+    """
+    pending_path = (
+        f"{_get_pending_dir()}/{datetime.utcnow().strftime('%Y%m%dT%H%M%S%fZ')}_"
+        f"{hashlib.sha1(redshift_manifest_file.encode('utf-8')).hexdigest()}.json"
+    )
+    Config.logger.info(f"Queueing {redshift_manifest_file} as {pending_path}")
+    s3_client.put_object(
+        Bucket=Config.S3_BUCKET,
+        Key=pending_path,
+        Body=json.dumps({"redshift_manifest": redshift_manifest_file}),
+    )
+    return pending_path
+
+
+def handle_batch(
+    s3_client: Any,
+    credentials: dict,
+    get_redshift_connection_callback: Callable[..., Any],
+) -> List[str]:
+    """
+    Apply all pending upserts, across tables, in the order they were queued, in one Redshift session.
+
+    With `Config.UPSERT_BATCH_COMMIT` "table", each manifest is committed on its own, and one that
+    fails is rolled back and left pending for the next batch, without stopping the others. Later
+    manifests for the same table are left pending too, so they aren't applied before it.
+    With "group", all manifests are committed together, or none are.
+    Note the swap and append full refresh strategies always commit as they go.
+
+    Returns:
+        List[str]: the redshift tables upserted
+
+    Raises:
+        Exception: if any manifest failed, after all manifests have been attempted
+    """
+    pending = _list_pending(s3_client)
+    if not pending:
+        Config.logger.info("No pending upserts")
+        return []
+    Config.logger.info(f"Applying {len(pending)} pending upserts")
+
+    targets = []
+    errors = {}
+    with get_redshift_connection_callback(credentials) as conn:
+        conn.rollback()  # ensure no transaction is open
+        if Config.UPSERT_BATCH_COMMIT == GROUP:
+            try:
+                for _, redshift_manifest_file in pending:
+                    targets.append(
+                        _apply_file(
+                            s3_client, conn, credentials, redshift_manifest_file
+                        )
+                    )
+                conn.commit()
+            except:
+                conn.rollback()
+                _LEDGER_TABLES.invalidate()
+                raise
+            for _, redshift_manifest_file in pending:
+                digest_index.complete(
+                    s3_client, Config.S3_BUCKET, redshift_manifest_file
+                )
+            _remove_pending(s3_client, [path for path, _ in pending])
+        else:
+            failed_targets = set()
+            for pending_path, redshift_manifest_file in pending:
+                target = _get_pending_target(s3_client, redshift_manifest_file)
+                if target in failed_targets:
+                    Config.logger.warning(
+                        f"Holding {redshift_manifest_file} until an earlier upsert to {target} succeeds"
+                    )
+                    continue
+                try:
+                    targets.append(
+                        _apply_file(
+                            s3_client, conn, credentials, redshift_manifest_file
+                        )
+                    )
+                    conn.commit()
+                except Exception as ex:
+                    # don't throw here, attempt other manifests first
+                    conn.rollback()
+                    _LEDGER_TABLES.invalidate()
+                    Config.logger.error(
+                        f"Error when upserting {redshift_manifest_file}: {ex}"
+                    )
+                    errors[redshift_manifest_file] = ex
+                    failed_targets.add(target)
+                    continue
+                digest_index.complete(
+                    s3_client, Config.S3_BUCKET, redshift_manifest_file
+                )
+                _remove_pending(s3_client, [pending_path])
+
+    if errors:
+        raise Exception(
+            f"{len(errors)} of {len(pending)} pending upserts failed. See logs for more details."
+        ) from next(iter(errors.values()))
+    return targets
+
+
+def handle_async(
+    s3_client: Any,
+    redshift_data_client: Any,
+    credentials: dict,
+    get_redshift_connection_callback: Callable[..., Any],
+    redshift_manifest_file: str,
+) -> dict:
+    """
+    Submit the Redshift UPSERT for a redshift manifest as one Redshift Data API batch, which
+    runs in a single transaction, and return without waiting for it, see `check_statements`.
+
+    The statements are the same as `handle` runs. Manifests that need more than one
+    transaction, or to read from Redshift (the swap and append full refresh strategies,
+    and `Config.ORDERED_APPLY`), are applied with `handle` instead.
+
+    The Data API keeps the sql of a statement, readable by anyone who can describe it, so the
+    COPY must use `Config.REDSHIFT_IAM_ROLE` rather than access keys.
+
+    Returns:
+        dict: the redshift table, and the id of the statement submitted, if any
+
+    Raises:
+        ValueError: if `Config.REDSHIFT_IAM_ROLE` is not set
+    """
+    if not Config.REDSHIFT_IAM_ROLE:
+        raise ValueError(
+            "REDSHIFT_IAM_ROLE must be set to submit upserts to the Data API, "
+            "which keeps their sql, so a COPY can't use access keys"
+        )
+    redshift_manifest = s3_utils.read_json_from_s3(
+        s3_client, Config.S3_BUCKET, redshift_manifest_file
+    )
+    target = redshift_manifest["redshift_table"]
+    if _replaces_table(redshift_manifest) or (
+        Config.ORDERED_APPLY and redshift_manifest["is_incremental"]
+    ):
+        Config.logger.info(
+            f"Can't submit {redshift_manifest_file} to the Data API, applying it directly"
+        )
+        handle(
+            s3_client,
+            credentials,
+            get_redshift_connection_callback,
+            redshift_manifest_file,
+        )
+        upsert_accumulator.complete(s3_client, redshift_manifest_file)
+        return {"redshift_table": target, "statement_id": None}
+
+    statements = _get_manifest_statements(
+        credentials, redshift_manifest_file, redshift_manifest
+    )
+    if not statements:
+        upsert_accumulator.complete(s3_client, redshift_manifest_file)
+        digest_index.complete(s3_client, Config.S3_BUCKET, redshift_manifest_file)
+        return {"redshift_table": target, "statement_id": None}
+
+    response = redshift_data_client.batch_execute_statement(
+        ClusterIdentifier=Config.REDSHIFT_CLUSTER,
+        Database=Config.REDSHIFT_DATABASE,
+        SecretArn=Config.REDSHIFT_SECRET_ID,
+        Sqls=statements,
+        StatementName=f"redshift_upsert {target}",
+        WithEvent=True,  # also reports completion to EventBridge
+    )
+    statement_id = response["Id"]
+    Config.logger.info(
+        f"Submitted {redshift_manifest_file} to {target} as statement {statement_id}"
+    )
+    s3_client.put_object(
+        Bucket=Config.S3_BUCKET,
+        Key=f"{_get_statements_dir()}/{statement_id}.json",
+        Body=json.dumps(
+            {
+                "statement_id": statement_id,
+                "redshift_manifest": redshift_manifest_file,
+                "redshift_table": target,
+                "submitted_at": datetime.utcnow().isoformat(),
+            }
+        ),
+    )
+    return {"redshift_table": target, "statement_id": statement_id}
+
+
+def check_statements(
+    s3_client: Any,
+    redshift_data_client: Any,
+) -> List[str]:
+    """
+    Check the status of the statements submitted by `handle_async`, and stop tracking those
+    that have finished, failed or been aborted. Manifests accumulated into a finished one
+    are released, see `upsert_accumulator.complete`, and its digest index is promoted, see
+    `digest_index.complete`. The manifest of a failed one is queued to be applied by
+    `handle_batch` instead, and the statement is kept under `upsert-statements-failed/`.
+
+    Returns:
+        List[str]: the redshift manifests applied since the last check
+
+    Raises:
+        RedshiftQueryException: if any statement failed, after all statements have been checked
+    """
+    paginator = s3_client.get_paginator("list_objects_v2")
+    statement_paths = sorted(
+        obj["Key"]
+        for page in paginator.paginate(
+            Bucket=Config.S3_BUCKET, Prefix=f"{_get_statements_dir()}/"
+        )
+        for obj in page.get("Contents", [])
+    )
+
+    applied = []
+    errors = {}
+    for statement_path in statement_paths:
+        statement = s3_utils.read_json_from_s3(
+            s3_client, Config.S3_BUCKET, statement_path
+        )
+        redshift_manifest_file = statement["redshift_manifest"]
+        description = redshift_data_client.describe_statement(
+            Id=statement["statement_id"]
+        )
+        status = description["Status"]
+        if status == "FINISHED":
+            Config.logger.info(f"Applied {redshift_manifest_file}")
+            _add_statement_metrics(statement["redshift_table"], description)
+            upsert_accumulator.complete(s3_client, redshift_manifest_file)
+            digest_index.complete(s3_client, Config.S3_BUCKET, redshift_manifest_file)
+            applied.append(redshift_manifest_file)
+        elif status in ("FAILED", "ABORTED"):
+            Config.logger.error(
+                f"Error when upserting {redshift_manifest_file}: {status} {description.get('Error')}"
+            )
+            errors[redshift_manifest_file] = description.get("Error")
+            # retried by redshift_upsert_batch, as the lambda retry of a direct upsert would
+            enqueue(s3_client, redshift_manifest_file)
+            s3_client.put_object(
+                Bucket=Config.S3_BUCKET,
+                Key=f"{_get_statements_dir()}-failed/{statement['statement_id']}.json",
+                Body=json.dumps(
+                    {**statement, "status": status, "error": description.get("Error")}
+                ),
+            )
+        else:
+            continue  # still running
+        s3_client.delete_object(Bucket=Config.S3_BUCKET, Key=statement_path)
+
+    if errors:
+        raise RedshiftQueryException(
+            f"{len(errors)} of {len(statement_paths)} submitted upserts failed. See logs for more details."
+        )
+    return applied
+
+
+def _add_statement_metrics(target: str, description: dict):
+    """Add the time of each statement of a finished Data API batch, as `TimedCursor` does."""
+    with metrics.StageMetrics("redshift_upsert", target) as stage_metrics:
+        for sub_statement in description.get("SubStatements", []):
+            # durations are in nanoseconds
+            stage_metrics.add_seconds(
+                metrics.get_statement_name(sub_statement["QueryString"]),
+                sub_statement.get("Duration", 0) / 1e9,
+            )
+        stage_metrics.add_seconds("Statement", description.get("Duration", 0) / 1e9)
+
+
+def _get_statements_dir() -> str:
+    return f"{Config.S3_BUCKET_PREFIX}dynamodb-export/upsert-statements"
+
+
+def _replaces_table(redshift_manifest: dict) -> bool:
+    """Whether a full export is applied by `_replace_table`, rather than in one transaction."""
+    return (
+        not redshift_manifest["is_incremental"]
+        and Config.FULL_REFRESH_STRATEGY != INSERT
+    )
+
+
+def _apply_file(
+    s3_client: Any,
+    conn: Any,
+    credentials: dict,
+    redshift_manifest_file: str,
+) -> str:
+    """Read a redshift manifest and apply it in the open transaction of `conn`. Returns the target table."""
+    redshift_manifest = s3_utils.read_json_from_s3(
+        s3_client, Config.S3_BUCKET, redshift_manifest_file
+    )
+    target = redshift_manifest["redshift_table"]
+    with metrics.StageMetrics("redshift_upsert", target) as stage_metrics:
+        _apply(
+            s3_client,
+            conn,
+            credentials,
+            redshift_manifest_file,
+            redshift_manifest,
+            stage_metrics,
+        )
+    return target
+
+
+def _apply(
+    s3_client: Any,
+    conn: Any,
+    credentials: dict,
+    redshift_manifest_file: str,
+    redshift_manifest: dict,
+    stage_metrics: metrics.StageMetrics,
+):
+    """
+    Apply a redshift manifest in the open transaction of `conn`, without committing.
+    Each statement is timed in `stage_metrics`, see `metrics.TimedCursor`.
+    """
+    cur = metrics.TimedCursor(conn.cursor(), stage_metrics)
+    if _replaces_table(redshift_manifest):
+        _replace_table(
+            cur,
+            conn,
+            credentials,
+            redshift_manifest_file,
+            redshift_manifest,
+            stage_metrics,
+        )
+    elif Config.ORDERED_APPLY and redshift_manifest["is_incremental"]:
+        _apply_in_order(
+            s3_client,
+            cur,
+            credentials,
+            redshift_manifest_file,
+            redshift_manifest,
+        )
+        stage_metrics.add_cache("LedgerTable", _LEDGER_TABLES)
+    else:
+        _apply_manifest(cur, credentials, redshift_manifest_file, redshift_manifest)
+
+
+def _get_pending_dir() -> str:
+    return f"{Config.S3_BUCKET_PREFIX}dynamodb-export/upsert-pending"
+
+
+def _list_pending(s3_client: Any) -> List[Tuple[str, str]]:
+    """Get the pending upserts, as (pending path, redshift manifest), oldest first, without duplicates."""
+    paginator = s3_client.get_paginator("list_objects_v2")
+    pending_paths = sorted(
+        obj["Key"]
+        for page in paginator.paginate(
+            Bucket=Config.S3_BUCKET, Prefix=f"{_get_pending_dir()}/"
+        )
+        for obj in page.get("Contents", [])
+    )
+    pending = []
+    redshift_manifest_files = set()
+    for pending_path in pending_paths:
+        redshift_manifest_file = s3_utils.read_json_from_s3(
+            s3_client, Config.S3_BUCKET, pending_path
+        )["redshift_manifest"]
+        if redshift_manifest_file in redshift_manifest_files:
+            # queued twice, e.g. the manifest was rewritten, only apply it once
+            _remove_pending(s3_client, [pending_path])
+            continue
+        redshift_manifest_files.add(redshift_manifest_file)
+        pending.append((pending_path, redshift_manifest_file))
+    return pending
+
+
+def _get_pending_target(s3_client: Any, redshift_manifest_file: str) -> str:
+    """
+    The redshift table a pending manifest upserts to, or the manifest itself if it can't be
+    read, as it can't be applied to any table then.
+    """
+    try:
+        return s3_utils.read_json_from_s3(
+            s3_client, Config.S3_BUCKET, redshift_manifest_file
+        )["redshift_table"]
+    except Exception:
+        return redshift_manifest_file
+
+
+def _remove_pending(s3_client: Any, pending_paths: List[str]):
+    for pending_path in pending_paths:
+        s3_client.delete_object(Bucket=Config.S3_BUCKET, Key=pending_path)
+
+
+def _apply_manifest(
+    cur: Any,
+    credentials: dict,
+    redshift_manifest_file: str,
+    redshift_manifest: dict,
+):
+    """
+    Run the COPY and UPSERT for one redshift manifest, in the open transaction of `cur`.
+    """
+    for statement in _get_manifest_statements(
+        credentials, redshift_manifest_file, redshift_manifest
+    ):
+        cur.execute(statement)
+
+
+def _get_manifest_statements(
+    credentials: dict,
+    redshift_manifest_file: str,
+    redshift_manifest: dict,
+) -> List[str]:
+    """
+    Get the COPY and UPSERT for one redshift manifest, as single statements to run in one
+    transaction, by either execution backend, see `Config.REDSHIFT_EXECUTION_BACKEND`.
+    """
     is_incremental = redshift_manifest["is_incremental"]
+    # full exports are shaped like the target for `_replace_table`, and have no deletes
+    is_shaped = bool(redshift_manifest.get("split_deletes"))
+    if is_incremental and is_shaped:
+        return _get_split_manifest_statements(
+            credentials, redshift_manifest_file, redshift_manifest
+        )
+    if not redshift_manifest["entries"]:
+        Config.logger.info(f"No data to apply in {redshift_manifest_file}")
+        return []
+
+    dynamodb_table_name = redshift_manifest["dynamodb_table_name"]
     target = redshift_manifest["redshift_table"]
-    source = f"#{target}_staging"  # temp table
+    source = f"#{target.split('.')[-1]}_staging"  # temp table, can't have a schema
     partition_key = redshift_manifest["partition_key"]
     sort_key = redshift_manifest.get("sort_key", None)
-    format_time = redshift_manifest["format_time"]
     # no need to load jsonpaths, they are only used in the COPY
 
     Config.logger.info(f"Upserting from {dynamodb_table_name} to {target}")
-    with get_redshift_connection_callback(credentials) as conn:
-        try:
-            conn.rollback()  # ensure no transaction is open
-            cur = conn.cursor()
-
-            # create a temp table to load s3 json files to
-            Config.logger.info(f"Executing create temp table")
-            create_source_table_command = f"""
-            DROP TABLE IF EXISTS {source};
-            CREATE TABLE {source} (LIKE {target});
-            ALTER TABLE {source} ADD COLUMN is_active BOOLEAN; -- for incremental loads
+
+    # create a temp table to load s3 json files to, and load them
+    statements = [
+        f"DROP TABLE IF EXISTS {source};",
+        f"CREATE TABLE {source} (LIKE {target});",
+    ]
+    if not is_shaped:
+        statements.append(
+            f"ALTER TABLE {source} ADD COLUMN is_active BOOLEAN;"  # for incremental loads
+        )
+    statements.append(
+        _get_copy_command(
+            source, credentials, redshift_manifest_file, redshift_manifest
+        )
+    )
+
+    if is_incremental:
+        # Delete records that are deleted in DynamoDB
+        statements.append(
+            f"""
+            DELETE FROM {target} USING {source} AS source
+            WHERE {target}.{partition_key} = source.{partition_key}
+            {(f'AND {target}.{sort_key} = source.{sort_key}' if sort_key else '')}
+            AND source.is_active = FALSE;
+            """
+        )
+
+        # Upsert (MERGE) the remaining records
+        # See https://docs.aws.amazon.com/redshift/latest/dg/r_MERGE.html#sub-examples-merge
+        statements += [
+            f"DELETE FROM {source} WHERE is_active = FALSE;",
+            # columns must match target for merge
+            f"ALTER TABLE {source} DROP COLUMN is_active;",
+            # but dropping the column doesn't work in the same transaction
+            f"SELECT * INTO {source}_active FROM {source};",
+            f"""
+            MERGE INTO {target} USING {source}_active AS source
+            ON {target}.{partition_key} = source.{partition_key}
+            {(f'AND {target}.{sort_key} = source.{sort_key}' if sort_key else '')}
+            REMOVE DUPLICATES;
+            """,
+        ]
+
+    else:
+        if not is_shaped:
+            # all records are active in full export
+            statements.append(f"ALTER TABLE {source} DROP COLUMN is_active;")
+        statements += [
+            f"TRUNCATE TABLE {target};",
+            f"INSERT INTO {target} SELECT * FROM {source};",
+        ]
+
+    # Clean up
+    statements += [
+        f"DROP TABLE IF EXISTS {source};",
+        f"DROP TABLE IF EXISTS {source}_active;",
+    ]
+    return statements
+
+
+def _get_split_manifest_statements(
+    credentials: dict,
+    redshift_manifest_file: str,
+    redshift_manifest: dict,
+) -> List[str]:
+    """
+    Get the DELETE and MERGE for an incremental manifest whose deletes were written separately,
+    see `Config.SPLIT_INCREMENTAL_DELETES`. Upserts are already shaped like the target, and
+    deletes only have keys, so each is loaded to its own temp table and used as it is.
+    """
+    deletes_manifest_file = redshift_manifest["deletes_manifest"]
+    if not redshift_manifest["entries"] and not deletes_manifest_file:
+        Config.logger.info(f"No data to apply in {redshift_manifest_file}")
+        return []
+
+    target = redshift_manifest["redshift_table"]
+    table_name = target.split(".")[-1]
+    source = f"#{table_name}_staging"  # temp table, can't have a schema
+    deletes = f"#{table_name}_deletes"
+    partition_key = redshift_manifest["partition_key"]
+    sort_key = redshift_manifest.get("sort_key", None)
+    key_columns = [k for k in (partition_key, sort_key) if k]
+
+    statements = []
+    if deletes_manifest_file:
+        Config.logger.info(f"Deleting from {deletes_manifest_file} to {target}")
+        statements += [
+            f"DROP TABLE IF EXISTS {deletes};",
+            f"CREATE TABLE {deletes} AS SELECT {', '.join(key_columns)} FROM {target} LIMIT 0;",
+            _get_copy_command(
+                deletes, credentials, deletes_manifest_file, redshift_manifest
+            ),
+            f"""
+            DELETE FROM {target} USING {deletes}
+            WHERE {_get_key_condition(target, deletes, partition_key, sort_key)};
+            """,
+            f"DROP TABLE IF EXISTS {deletes};",
+        ]
+
+    if redshift_manifest["entries"]:
+        # Upsert (MERGE) the records
+        # See https://docs.aws.amazon.com/redshift/latest/dg/r_MERGE.html#sub-examples-merge
+        Config.logger.info(f"Merging from {redshift_manifest_file} to {target}")
+        statements += [
+            f"DROP TABLE IF EXISTS {source};",
+            f"CREATE TABLE {source} (LIKE {target});",
+            _get_copy_command(
+                source, credentials, redshift_manifest_file, redshift_manifest
+            ),
+            f"""
+            MERGE INTO {target} USING {source}
+            ON {_get_key_condition(target, source, partition_key, sort_key)}
+            REMOVE DUPLICATES;
+            """,
+            f"DROP TABLE IF EXISTS {source};",
+        ]
+    return statements
+
+
+def _get_key_condition(
+    target: str, other: str, partition_key: str, sort_key: str = None
+) -> str:
+    condition = f"{target}.{partition_key} = {other}.{partition_key}"
+    if sort_key:
+        condition += f" AND {target}.{sort_key} = {other}.{sort_key}"
+    return condition
+
+
+def _replace_table(
+    cur: Any,
+    conn: Any,
+    credentials: dict,
+    redshift_manifest_file: str,
+    redshift_manifest: dict,
+    stage_metrics: metrics.StageMetrics,
+):
+    """
+    Replace the contents of the target table with a full export, without rewriting the table.
+
+    The export, written shaped like the target (see `Config.FULL_REFRESH_STRATEGY` in
+    redshift_manifest_handler.py), is loaded into a permanent staging table created `LIKE`
+    the target (so with the same distribution, sort keys and encodings), which is then either:
+    - swap: renamed over the target in one transaction, so readers never see an empty table.
+      The new table has none of the target's grants, which must be granted again, e.g. by
+      default privileges. Views that are not late binding would keep the old table, so the
+      swap fails before loading if any depend on the target.
+    - append: moved into the target with `ALTER TABLE APPEND`, which moves blocks rather than
+      copying rows, so grants and views are kept. The target's rows are first moved aside the
+      same way, and moved back if the append fails. As `ALTER TABLE APPEND` can't run in a
+      transaction, readers see an empty table until it completes, so it doesn't avoid an
+      empty table, only rewriting it. If moving the rows back fails too, the target is left
+      empty: this is logged with the table holding its rows, and counted as
+      `AppendRestoreFailures`, to alarm on.
+
+    Commits as it goes, as the strategies need more than one transaction.
+
+    Raises:
+        - ValueError: for an invalid strategy, or a swap of a table that views depend on
+    """
+    strategy = Config.FULL_REFRESH_STRATEGY
+    if strategy not in (SWAP, APPEND):
+        raise ValueError(
+            f"Invalid full refresh strategy '{strategy}', must be one of {FULL_REFRESH_STRATEGIES}"
+        )
+    if not redshift_manifest["entries"]:
+        Config.logger.info(f"No data to apply in {redshift_manifest_file}")
+        return
+
+    target = redshift_manifest["redshift_table"]
+    schema, _, table_name = target.rpartition(".")
+    schema_prefix = f"{schema}." if schema else ""
+    staging = f"{schema_prefix}{table_name}_staging"
+    previous = f"{schema_prefix}{table_name}_previous"
+
+    if strategy == SWAP:
+        views = _get_dependent_views(cur, target)
+        if views:
+            raise ValueError(
+                f"Can't swap {target}, views {views} depend on it and are not late binding, "
+                f"recreate them WITH NO SCHEMA BINDING or use the '{APPEND}' strategy"
+            )
+
+    Config.logger.info(f"Executing COPY from s3 to {staging}")
+    cur.execute(
+        f"""
+        DROP TABLE IF EXISTS {staging};
+        CREATE TABLE {staging} (LIKE {target});
+        """
+    )
+    cur.execute(
+        _get_copy_command(
+            staging, credentials, redshift_manifest_file, redshift_manifest
+        )
+    )
+    conn.commit()
+
+    if strategy == SWAP:
+        Config.logger.info(f"Executing SWAP of {staging} with {target}")
+        cur.execute(
+            f"""
+            DROP TABLE IF EXISTS {previous};
+            ALTER TABLE {target} RENAME TO {table_name}_previous;
+            ALTER TABLE {staging} RENAME TO {table_name};
+            DROP TABLE {previous};
             """
-            cur.execute(create_source_table_command)
-
-            # load s3 files into temp table
-            Config.logger.info(f"Executing COPY from s3 to temp table")
-            copy_command = f"""
-            COPY {source} FROM 's3://{Config.S3_BUCKET}/{redshift_manifest_file}' 
-            credentials 'aws_access_key_id={credentials['aws_access_key_id']};aws_secret_access_key={credentials['aws_secret_access_key']}'
-            json 's3://{Config.S3_BUCKET}/{redshift_manifest_file}'
-            gzip
-            {format_time}
-            MANIFEST;
+        )
+        conn.commit()
+
+    else:
+        Config.logger.info(f"Executing APPEND from {staging} to {target}")
+        cur.execute(
+            f"""
+            DROP TABLE IF EXISTS {previous};
+            CREATE TABLE {previous} (LIKE {target});
             """
-            cur.execute(copy_command)
-
-            if is_incremental:
-                # Delete records that are deleted in DynamoDB
-                Config.logger.info(f"Executing DELETE from temp table to {target}")
-                delete_command = f"""
-                DELETE FROM {target} USING {source} AS source
-                WHERE {target}.{partition_key} = source.{partition_key}
-                {(f'AND {target}.{sort_key} = source.{sort_key}' if sort_key else '')}
-                AND source.is_active = FALSE;
-                """
-                cur.execute(delete_command)
-
-                # Upsert (MERGE) the remaining records
-                # See https://docs.aws.amazon.com/redshift/latest/dg/r_MERGE.html#sub-examples-merge
-                Config.logger.info(f"Executing MERGE from temp table to {target}")
-                merge_command = f"""
-                DELETE FROM {source} WHERE is_active = FALSE;
-                ALTER TABLE {source} DROP COLUMN is_active; --columns must match target for merge
-                SELECT * INTO {source}_active FROM {source}; --but dropping the column doesn't work in the same transaction
-                MERGE INTO {target} USING {source}_active AS source
-                ON {target}.{partition_key} = source.{partition_key}
-                {(f'AND {target}.{sort_key} = source.{sort_key}' if sort_key else '')}
-                REMOVE DUPLICATES;
-                """
-                cur.execute(merge_command)
-
-            else:
-                Config.logger.info(f"Executing REPLACE from temp table to {target}")
-                replace_command = f"""
-                ALTER TABLE {source} DROP COLUMN is_active; -- all records are active in full export
-                TRUNCATE TABLE {target};
-                INSERT INTO {target} SELECT * FROM {source};"""
-                cur.execute(replace_command)
-
-            # Clean up
-            cur.execute(f"DROP TABLE IF EXISTS {source};")
-            cur.execute(f"DROP TABLE IF EXISTS {source}_active;")
-
-            # Commit transaction
-            conn.commit()
-
-        except:
-            conn.rollback()
-            raise
-    return target
+        )
+        conn.commit()
+        conn.autocommit = True
+        try:
+            # move the current rows aside rather than truncating, to restore them on failure
+            cur.execute(f"ALTER TABLE {previous} APPEND FROM {target};")
+            try:
+                cur.execute(f"ALTER TABLE {target} APPEND FROM {staging};")
+            except Exception:
+                Config.logger.error(
+                    f"APPEND to {target} failed, restoring its rows from {previous}"
+                )
+                try:
+                    cur.execute(f"ALTER TABLE {target} APPEND FROM {previous};")
+                except Exception as restore_ex:
+                    Config.logger.error(
+                        f"Restoring {target} failed, it is empty and its rows are in {previous}. "
+                        f"Restore them with ALTER TABLE {target} APPEND FROM {previous}; "
+                        f"before the next full refresh drops {previous}: {restore_ex}"
+                    )
+                    stage_metrics.add("AppendRestoreFailures", 1)
+                raise
+            cur.execute(f"DROP TABLE {previous};")
+            cur.execute(f"DROP TABLE {staging};")
+        finally:
+            conn.autocommit = False
+
+
+def _get_dependent_views(cur: Any, table: str) -> List[str]:
+    """The views bound to a table, i.e. that aren't late binding."""
+    cur.execute(
+        """
+        SELECT DISTINCT view_class.relname
+        FROM pg_depend
+        JOIN pg_rewrite ON pg_depend.objid = pg_rewrite.oid
+        JOIN pg_class view_class ON pg_rewrite.ev_class = view_class.oid
+        WHERE pg_depend.refobjid = %s::regclass
+        AND view_class.oid != pg_depend.refobjid;
+        """,
+        (table,),
+    )
+    return [row[0] for row in cur.fetchall()]
+
+
+def _get_copy_command(
+    table: str,
+    credentials: dict,
+    redshift_manifest_file: str,
+    redshift_manifest: dict,
+) -> str:
+    """
+    Get the COPY of the files in a redshift manifest to `table`, authorized with
+    `Config.REDSHIFT_IAM_ROLE` if set, otherwise the access keys of `credentials`.
+    """
+    format_time = redshift_manifest["format_time"]
+    output_format = redshift_manifest.get("output_format", "json")
+    if Config.REDSHIFT_IAM_ROLE:
+        authorization = f"IAM_ROLE '{Config.REDSHIFT_IAM_ROLE}'"
+    else:
+        authorization = f"credentials 'aws_access_key_id={credentials['aws_access_key_id']};aws_secret_access_key={credentials['aws_secret_access_key']}'"
+    if output_format == "parquet":
+        return f"""
+        COPY {table} FROM 's3://{Config.S3_BUCKET}/{redshift_manifest_file}'
+        {authorization}
+        FORMAT AS PARQUET
+        MANIFEST;
+        """
+    return f"""
+        COPY {table} FROM 's3://{Config.S3_BUCKET}/{redshift_manifest_file}'
+        {authorization}
+        json 's3://{Config.S3_BUCKET}/{redshift_manifest_file}'
+        gzip
+        {format_time}
+        MANIFEST;
+        """
+
+
+def _apply_in_order(
+    s3_client: Any,
+    cur: Any,
+    credentials: dict,
+    redshift_manifest_file: str,
+    redshift_manifest: dict,
+):
+    """
+    Apply every ready export of the table, in export window order, stopping at the first
+    export that is not ready yet, so an older window can never overwrite a newer one.
+
+    The exports applied are recorded in the target's own ledger table in Redshift, in the same
+    transaction as the changes themselves, and the ledger table is locked so only one invocation
+    applies a table's exports at a time, without holding up the other tables. A manifest that
+    arrives before an older export is ready is held, and applied by the invocation for that
+    older export.
+    """
+    dynamodb_table_name = redshift_manifest["dynamodb_table_name"]
+    export_arns = redshift_manifest.get("export_arns") or []
+    table_s3_prefix = redshift_manifest_file.split("/AWSDynamoDB/")[0]
+    ledger_table = _get_ledger_table(redshift_manifest["redshift_table"])
+
+    if not _LEDGER_TABLES.get(ledger_table):
+        cur.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {ledger_table} (
+                dynamodb_table_name VARCHAR(256) NOT NULL,
+                export_arn VARCHAR(512) NOT NULL,
+                export_from_time TIMESTAMP,
+                export_to_time TIMESTAMP,
+                redshift_manifest VARCHAR(1024),
+                applied_at TIMESTAMP DEFAULT GETDATE()
+            );
+            """
+        )
+        _LEDGER_TABLES.set(ledger_table, True)
+
+    Config.logger.info(f"Locking ledger {ledger_table}")
+    cur.execute(f"LOCK {ledger_table};")
+    cur.execute(
+        f"SELECT export_arn FROM {ledger_table} WHERE dynamodb_table_name = %s;",
+        (dynamodb_table_name,),
+    )
+    committed_export_arns = {row[0] for row in cur.fetchall()}
+    applied_export_arns = set(committed_export_arns)
+
+    entries = export_ledger.list_entries(s3_client, Config.S3_BUCKET, table_s3_prefix)
+    if not any(e["ExportArn"] in export_arns for e in entries):
+        if not set(export_arns) & applied_export_arns:
+            # not in the ledger, e.g. submitted before the ledger was enabled
+            Config.logger.info(f"Exports {export_arns} are not in the ledger")
+            _apply_manifest(cur, credentials, redshift_manifest_file, redshift_manifest)
+        return
+
+    applied_manifests = set()
+    for entry in entries:
+        if entry["ExportArn"] in applied_export_arns:
+            continue
+        if entry["Status"] != export_ledger.READY:
+            Config.logger.info(
+                f"Holding later exports of {dynamodb_table_name} until {entry['ExportArn']} is ready"
+            )
+            break
+
+        entry_manifest_file = entry["RedshiftManifest"]
+        if entry_manifest_file and entry_manifest_file not in applied_manifests:
+            Config.logger.info(f"Applying {entry_manifest_file}")
+            _apply_manifest(
+                cur,
+                credentials,
+                entry_manifest_file,
+                s3_utils.read_json_from_s3(
+                    s3_client, Config.S3_BUCKET, entry_manifest_file
+                ),
+            )
+            applied_manifests.add(entry_manifest_file)
+
+        cur.execute(
+            f"""
+            INSERT INTO {ledger_table}
+            (dynamodb_table_name, export_arn, export_from_time, export_to_time, redshift_manifest)
+            VALUES (%s, %s, %s, %s, %s);
+            """,
+            (
+                dynamodb_table_name,
+                entry["ExportArn"],
+                export_ledger.parse_datetime(entry["ExportFromTime"]),
+                export_ledger.parse_datetime(entry["ExportToTime"]),
+                entry_manifest_file,
+            ),
+        )
+        applied_export_arns.add(entry["ExportArn"])
+
+    # Exports applied by an earlier, committed, drain are recorded in redshift so can leave
+    # the s3 ledger. Those applied by this drain are left until the next one, in case the
+    # commit fails.
+    export_ledger.remove_entries(
+        s3_client,
+        Config.S3_BUCKET,
+        table_s3_prefix,
+        [e for e in entries if e["ExportArn"] in committed_export_arns],
+    )
+
+
+def _get_ledger_table(target: str) -> str:
+    """The ledger table of a target table, one per target so locking it only serializes that table."""
+    ledger_table = (
+        Config.REDSHIFT_LEDGER_TABLE
+        or f"{Config.REDSHIFT_TARGET_SCHEMA}.dynamodb_export_ledger"
+    )
+    return f"{ledger_table}_{target.split('.')[-1]}"
@@ -1,6 +1,15 @@
+import io
 import json
 import gzip
-from typing import Any
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator
+from botocore.exceptions import ClientError
+
+# S3 requires every part of a multipart upload, except the last, to be at least 5MB
+MIN_MULTIPART_PART_SIZE = 5 * 1024 * 1024
 
 
 def read_json_from_s3(
@@ -41,13 +50,336 @@ def read_contents_from_s3(
     s3_client: Any,
     s3_bucket: str,
     s3_file_path: str,
+    part_size: int = 0,
+    max_concurrency: int = 1,
 ) -> str:
     """
     Read file from s3 and return as a string. Can handle gzip files.
+    With `max_concurrency` > 1, files larger than `part_size` are downloaded with
+    concurrent ranged GETs, see `S3RangedReader`.
+    """
+    body, _ = _open_body(s3_client, s3_bucket, s3_file_path, part_size, max_concurrency)
+    try:
+        if s3_file_path.endswith(".gz"):
+            with gzip.GzipFile(fileobj=body) as gzipfile:
+                return gzipfile.read().decode("utf-8")
+        else:
+            return body.read().decode("utf-8")
+    finally:
+        body.close()
+
+
+def exists(
+    s3_client: Any,
+    s3_bucket: str,
+    s3_file_path: str,
+) -> bool:
+    """
+    Check if a file exists in s3.
+    """
+    try:
+        s3_client.head_object(Bucket=s3_bucket, Key=s3_file_path)
+        return True
+    except ClientError as ex:
+        if ex.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+
+def iter_lines_from_s3(
+    s3_client: Any,
+    s3_bucket: str,
+    s3_file_path: str,
+    stats: Dict[str, float] = None,
+    part_size: int = 0,
+    max_concurrency: int = 1,
+) -> Iterator[str]:
     """
+    Read file from s3 line by line, without holding the whole file in memory.
+    Can handle gzip files. Empty lines are skipped.
+    If `stats` is given, the size of the file is added to its "bytes_read".
+    With `max_concurrency` > 1, files larger than `part_size` are downloaded with
+    concurrent ranged GETs, see `S3RangedReader`.
+    """
+    body, content_length = _open_body(
+        s3_client, s3_bucket, s3_file_path, part_size, max_concurrency
+    )
+    if stats is not None:
+        stats["bytes_read"] += content_length
+    try:
+        if s3_file_path.endswith(".gz"):
+            lines = gzip.GzipFile(fileobj=body)
+        elif isinstance(body, io.BufferedReader):
+            lines = body
+        else:
+            lines = body.iter_lines(keepends=True)
+
+        for line in lines:
+            line = line.decode("utf-8").rstrip("\r\n")
+            if line:
+                yield line
+    finally:
+        body.close()
+
+
+def _open_body(
+    s3_client: Any,
+    s3_bucket: str,
+    s3_file_path: str,
+    part_size: int = 0,
+    max_concurrency: int = 1,
+):
+    """Open the body of an s3 object, as one stream, or in concurrent ranges. Returns the body and its size."""
+    if max_concurrency > 1 and part_size > 0:
+        reader = S3RangedReader(
+            s3_client, s3_bucket, s3_file_path, part_size, max_concurrency
+        )
+        return io.BufferedReader(reader, buffer_size=64 * 1024), reader.content_length
     obj = s3_client.get_object(Bucket=s3_bucket, Key=s3_file_path)
-    if s3_file_path.endswith(".gz"):
-        with gzip.GzipFile(fileobj=obj["Body"]) as gzipfile:
-            return gzipfile.read().decode("utf-8")
-    else:
-        return obj["Body"].read().decode("utf-8")
+    return obj["Body"], obj.get("ContentLength", 0)
+
+
+class S3RangedReader(io.RawIOBase):
+    """
+    Read an s3 object as a stream, downloading it in ranges of `part_size` bytes, with up to
+    `max_concurrency` ranged GETs in flight, so a large object isn't limited to the throughput
+    of one connection. Ranges are read ahead, in order, so at most `max_concurrency` parts are
+    held in memory.
+
+    The first range is read straight away, and gives the size of the object, so an object no
+    larger than `part_size` is read with a single GET. The other ranges are only read if the
+    object is unchanged (`IfMatch` its ETag).
+
+    Example
+    -------
+    with gzip.GzipFile(fileobj=S3RangedReader(s3_client, bucket, key, 8 * 1024 * 1024, 8)) as f:
+        for line in f:
+            ...
+    """
+
+    def __init__(
+        self,
+        s3_client: Any,
+        s3_bucket: str,
+        s3_file_path: str,
+        part_size: int,
+        max_concurrency: int,
+    ):
+        super().__init__()
+        self.s3_client = s3_client
+        self.s3_bucket = s3_bucket
+        self.s3_file_path = s3_file_path
+        self.part_size = part_size
+        self.max_concurrency = max_concurrency
+        self._executor = None
+        self._parts = deque()
+        try:
+            first_part = s3_client.get_object(
+                Bucket=s3_bucket,
+                Key=s3_file_path,
+                Range=f"bytes=0-{part_size - 1}",
+            )
+        except ClientError as ex:
+            if ex.response["Error"]["Code"] != "InvalidRange":
+                raise
+            # an empty object has no range to read
+            self.content_length = 0
+            self._buffer = memoryview(b"")
+            self._next_offset = 0
+            return
+
+        self._etag = first_part["ETag"]
+        content_range = first_part.get("ContentRange")
+        self.content_length = (
+            int(content_range.split("/")[-1])
+            if content_range
+            else first_part["ContentLength"]
+        )
+        self._buffer = memoryview(first_part["Body"].read())
+        self._next_offset = len(self._buffer)
+        if self._next_offset < self.content_length:
+            self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+            self._read_ahead()
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self._buffer:
+            if not self._parts:
+                return 0
+            self._buffer = memoryview(self._parts.popleft().result())
+            self._read_ahead()
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+    def close(self):
+        if self._executor is not None:
+            for part in self._parts:
+                part.cancel()
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self._parts.clear()
+        super().close()
+
+    def _read_ahead(self):
+        while (
+            len(self._parts) < self.max_concurrency
+            and self._next_offset < self.content_length
+        ):
+            start = self._next_offset
+            end = min(start + self.part_size, self.content_length) - 1
+            self._parts.append(self._executor.submit(self._get_range, start, end))
+            self._next_offset = end + 1
+
+    def _get_range(self, start: int, end: int) -> bytes:
+        return self.s3_client.get_object(
+            Bucket=self.s3_bucket,
+            Key=self.s3_file_path,
+            Range=f"bytes={start}-{end}",
+            IfMatch=self._etag,
+        )["Body"].read()
+
+
+class S3MultipartWriter:
+    """
+    Write bytes to an s3 file as they arrive.
+
+    Bytes are buffered until `part_size` is reached, then uploaded as one part of a
+    multipart upload, so memory use stays bounded however large the file gets.
+    If the whole file fits in a single part it is written with a single `put_object` instead.
+    """
+
+    def __init__(
+        self,
+        s3_client: Any,
+        s3_bucket: str,
+        s3_file_path: str,
+        part_size: int = 8 * 1024 * 1024,
+    ):
+        self.s3_client = s3_client
+        self.s3_bucket = s3_bucket
+        self.s3_file_path = s3_file_path
+        self.part_size = max(part_size, MIN_MULTIPART_PART_SIZE)
+        self.bytes_out = 0
+        self.upload_seconds = 0.0  # time spent waiting on s3
+        self.closed = False
+        self.completed = False  # the file was written, not aborted
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+    def write(self, data: bytes) -> int:
+        self._buffer += data
+        self.bytes_out += len(data)
+        if len(self._buffer) >= self.part_size:
+            self._upload_part()
+        return len(data)
+
+    def tell(self) -> int:
+        return self.bytes_out
+
+    def close(self):
+        """Upload any remaining bytes and complete the upload."""
+        if self.closed:
+            return
+        if self._upload_id is None:
+            start = time.perf_counter()
+            self.s3_client.put_object(
+                Bucket=self.s3_bucket,
+                Key=self.s3_file_path,
+                Body=bytes(self._buffer),
+            )
+            self.upload_seconds += time.perf_counter() - start
+        else:
+            self._upload_part()
+            start = time.perf_counter()
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.s3_bucket,
+                Key=self.s3_file_path,
+                UploadId=self._upload_id,
+                MultipartUpload={"Parts": self._parts},
+            )
+            self.upload_seconds += time.perf_counter() - start
+        self._buffer = bytearray()
+        self.closed = True
+        self.completed = True
+
+    def abort(self):
+        """Discard everything written so far."""
+        if self.closed:
+            return
+        if self._upload_id is not None:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.s3_bucket,
+                Key=self.s3_file_path,
+                UploadId=self._upload_id,
+            )
+        self._buffer = bytearray()
+        self.closed = True
+
+    def _upload_part(self):
+        start = time.perf_counter()
+        if self._upload_id is None:
+            response = self.s3_client.create_multipart_upload(
+                Bucket=self.s3_bucket,
+                Key=self.s3_file_path,
+            )
+            self._upload_id = response["UploadId"]
+
+        part_number = len(self._parts) + 1
+        response = self.s3_client.upload_part(
+            Bucket=self.s3_bucket,
+            Key=self.s3_file_path,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=bytes(self._buffer),
+        )
+        self._parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+        self._buffer = bytearray()
+        self.upload_seconds += time.perf_counter() - start
+
+
+class S3GzipWriter(S3MultipartWriter):
+    """
+    Write lines to a gzipped s3 file, compressing them as they arrive, see `S3MultipartWriter`.
+    Nothing is written if no lines were written.
+
+    Example
+    -------
+    with S3GzipWriter(s3_client, bucket, "path/to/file.json.gz") as writer:
+        for line in lines:
+            writer.write_line(line)
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rows = 0
+        self.bytes_in = 0
+        self._compressor = zlib.compressobj(wbits=31)  # 31 = gzip container
+
+    def write_line(self, line: str):
+        data = (line + "\n").encode("utf-8")
+        self.rows += 1
+        self.bytes_in += len(data)
+        self.write(self._compressor.compress(data))
+
+    def close(self):
+        if self.closed:
+            return
+        if self.rows == 0:
+            self.abort()
+            return
+        self.write(self._compressor.flush())
+        super().close()
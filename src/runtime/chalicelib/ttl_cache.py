@@ -0,0 +1,76 @@
+import threading
+import time
+from typing import Any, Callable, Hashable, Tuple
+
+
+class TTLCache:
+    """
+    Thread-safe in-memory cache, whose entries expire `ttl_seconds` after they are set.
+
+    Kept at module level, it survives warm lambda invocations, so values that rarely
+    change (secrets, watermarks, table metadata) are not fetched on every invocation.
+
+    Example
+    -------
+    _CACHE = TTLCache(ttl_seconds=300)
+    value = _CACHE.get_or_load("key", lambda: expensive_lookup())
+    """
+
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._taken = (0, 0)  # hits and misses when last taken, see `take_counts`
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Get an entry if it has not expired, otherwise `default`."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self.hits += 1
+                return entry[0]
+            self._entries.pop(key, None)
+            self.misses += 1
+            return default
+
+    def set(self, key: Hashable, value: Any, ttl_seconds: float = None):
+        """Set an entry, expiring after `ttl_seconds`, or the cache's default TTL."""
+        ttl_seconds = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        if ttl_seconds <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl_seconds)
+
+    def get_or_load(
+        self,
+        key: Hashable,
+        load: Callable[[], Any],
+        ttl_seconds: float = None,
+    ) -> Any:
+        """Get an entry, or if missing or expired, load and set it."""
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = load()
+            self.set(key, value, ttl_seconds)
+        return value
+
+    def invalidate(self, key: Hashable = None):
+        """Remove an entry, e.g. after a secret is rotated, or all entries if `key` is None."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+    def take_counts(self) -> Tuple[int, int]:
+        """Get the hits and misses since this was last called, e.g. to publish them per invocation."""
+        with self._lock:
+            hits, misses = self.hits - self._taken[0], self.misses - self._taken[1]
+            self._taken = (self.hits, self.misses)
+        return hits, misses
@@ -0,0 +1,420 @@
+import hashlib
+import json
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List, Tuple, Union
+from . import output_formats, s3_utils
+from .config import Config
+
+_DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+# the combined manifests must not end in redshift.manifest, which would trigger redshift_upsert
+_COMBINED_MANIFEST = "combined.manifest"
+_COMBINED_DELETES_MANIFEST = "combined-deletes.manifest"
+
+
+def accumulate(
+    s3_client: Any,
+    redshift_manifest_file: str,
+) -> Union[str, None]:
+    """
+    Hold an incremental redshift manifest with the others of its table, until enough has
+    accumulated to apply them as one, see `Config.UPSERT_ACCUMULATE`.
+
+    The manifests held are applied once their items reach `Config.ACCUMULATE_MIN_ITEMS`, their
+    processed files reach `Config.ACCUMULATE_MIN_BYTES`, or the oldest is older than
+    `Config.ACCUMULATE_MAX_AGE_SECONDS`, see `flush_due` for the last. Only one combined
+    manifest of a table is applied at a time, see `_claim`: while one is, the others are held.
+
+    Manifests that can't be combined (full exports, diffed or not, parquet output, or with
+    `Config.ORDERED_APPLY`, which orders manifests itself) are not held.
+
+    Returns:
+        str: s3 path to the manifest to apply now, either `redshift_manifest_file` or a combined
+            manifest (see `complete`), or None if it is held
+    """
+    redshift_manifest = s3_utils.read_json_from_s3(
+        s3_client, Config.S3_BUCKET, redshift_manifest_file
+    )
+    if (
+        not redshift_manifest["is_incremental"]
+        or redshift_manifest.get("digest_index")
+        or redshift_manifest.get("output_format", output_formats.JSON)
+        != output_formats.JSON
+        or Config.ORDERED_APPLY
+    ):
+        return redshift_manifest_file
+
+    table = redshift_manifest["dynamodb_table_name"]
+    queued_at = datetime.utcnow()
+    pending_path = (
+        f"{_get_accumulating_dir(table)}/{queued_at.strftime('%Y%m%dT%H%M%S%fZ')}_"
+        f"{hashlib.sha1(redshift_manifest_file.encode('utf-8')).hexdigest()}.json"
+    )
+    s3_client.put_object(
+        Bucket=Config.S3_BUCKET,
+        Key=pending_path,
+        Body=json.dumps(
+            {
+                "redshift_manifest": redshift_manifest_file,
+                "item_count": redshift_manifest.get("item_count", 0),
+                "content_length": redshift_manifest.get("content_length", 0),
+                "queued_at": queued_at.strftime(_DATETIME_FORMAT),
+            }
+        ),
+    )
+
+    pending = _list_pending(s3_client, table)
+    if not _is_due(pending, check_size=True):
+        Config.logger.info(
+            f"Holding {redshift_manifest_file}, {len(pending)} manifests accumulated for {table}"
+        )
+        return None
+    return _combine(s3_client, table, pending)
+
+
+def flush_due(s3_client: Any) -> List[str]:
+    """
+    Combine the manifests of every table whose oldest held manifest is older than
+    `Config.ACCUMULATE_MAX_AGE_SECONDS`, for when no new manifest arrives to trigger it.
+
+    A combined manifest claimed longer than that without being completed, e.g. its upsert
+    failed, is returned again to be retried, as the table's other manifests wait for it.
+
+    Returns:
+        List[str]: s3 paths to the combined manifests to apply, see `complete`
+    """
+    prefix = f"{_get_accumulating_dir()}/"
+    paginator = s3_client.get_paginator("list_objects_v2")
+    tables = {
+        common_prefix["Prefix"][len(prefix) :].rstrip("/")
+        for page in paginator.paginate(
+            Bucket=Config.S3_BUCKET, Prefix=prefix, Delimiter="/"
+        )
+        for common_prefix in page.get("CommonPrefixes", [])
+    }
+
+    combined_manifest_files = []
+    for table in sorted(tables):
+        claims = _list_claims(s3_client, table)
+        if claims:
+            combined_manifest_file = _get_stale_claim(s3_client, claims[0])
+            if combined_manifest_file is not None:
+                Config.logger.warning(
+                    f"Retrying {combined_manifest_file}, claimed by {claims[0]} and not completed"
+                )
+                combined_manifest_files.append(combined_manifest_file)
+            continue
+        pending = _list_pending(s3_client, table)
+        if pending and _is_due(pending, check_size=False):
+            combined_manifest_file = _combine(s3_client, table, pending)
+            if combined_manifest_file is not None:
+                combined_manifest_files.append(combined_manifest_file)
+    return combined_manifest_files
+
+
+def complete(s3_client: Any, redshift_manifest_file: str):
+    """
+    Release the manifests combined into `redshift_manifest_file`, once it has been applied,
+    then its claim on the table, so the next combined manifest of the table can be built.
+    """
+    if not redshift_manifest_file.endswith(_COMBINED_MANIFEST):
+        return
+    combined_manifest = s3_utils.read_json_from_s3(
+        s3_client, Config.S3_BUCKET, redshift_manifest_file
+    )
+    for pending_path in combined_manifest["accumulated"]:
+        s3_client.delete_object(Bucket=Config.S3_BUCKET, Key=pending_path)
+    s3_client.delete_object(Bucket=Config.S3_BUCKET, Key=combined_manifest["claim"])
+
+
+def _get_accumulating_dir(table: str = None) -> str:
+    accumulating_dir = f"{Config.S3_BUCKET_PREFIX}dynamodb-export/upsert-accumulating"
+    return f"{accumulating_dir}/{table}" if table else accumulating_dir
+
+
+def _get_claims_dir(table: str) -> str:
+    return f"{_get_accumulating_dir()}-claims/{table}"
+
+
+def _list_claims(s3_client: Any, table: str) -> List[str]:
+    """Get the claims on a table, see `_claim`, oldest first."""
+    paginator = s3_client.get_paginator("list_objects_v2")
+    return sorted(
+        obj["Key"]
+        for page in paginator.paginate(
+            Bucket=Config.S3_BUCKET, Prefix=f"{_get_claims_dir(table)}/"
+        )
+        for obj in page.get("Contents", [])
+    )
+
+
+def _claim(s3_client: Any, table: str) -> Union[str, None]:
+    """
+    Claim a table for one combined manifest, until `complete` releases it, so combined
+    manifests of a table are built and applied one at a time. Otherwise two combines could
+    share held manifests, and the one with fewer, older changes could be applied last.
+
+    A combine that finds a claim on the table holds its manifests instead. If two combines
+    claim the table at the same time, they both see two claims and back off, and the next
+    manifest held or `flush_due` tries again.
+
+    Returns:
+        str: s3 path to the claim, or None if the table is claimed by another combine
+    """
+    if _list_claims(s3_client, table):
+        return None
+    claim_path = (
+        f"{_get_claims_dir(table)}/"
+        f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S%fZ')}_{uuid.uuid4().hex}.json"
+    )
+    _write_claim(s3_client, claim_path, None)
+    if len(_list_claims(s3_client, table)) > 1:
+        s3_client.delete_object(Bucket=Config.S3_BUCKET, Key=claim_path)
+        return None
+    return claim_path
+
+
+def _write_claim(
+    s3_client: Any, claim_path: str, combined_manifest_file: Union[str, None]
+):
+    s3_client.put_object(
+        Bucket=Config.S3_BUCKET,
+        Key=claim_path,
+        Body=json.dumps(
+            {
+                "combined_manifest": combined_manifest_file,
+                "claimed_at": datetime.utcnow().strftime(_DATETIME_FORMAT),
+            }
+        ),
+    )
+
+
+def _get_stale_claim(s3_client: Any, claim_path: str) -> Union[str, None]:
+    """
+    Get the combined manifest of a claim that has not been completed within
+    `Config.ACCUMULATE_MAX_AGE_SECONDS`, claiming it again for the retry, or None.
+    """
+    claim = s3_utils.read_json_from_s3(s3_client, Config.S3_BUCKET, claim_path)
+    claimed_at = datetime.strptime(claim["claimed_at"], _DATETIME_FORMAT)
+    if (
+        claim["combined_manifest"] is None
+        or (datetime.utcnow() - claimed_at).total_seconds()
+        < Config.ACCUMULATE_MAX_AGE_SECONDS
+    ):
+        return None
+    _write_claim(s3_client, claim_path, claim["combined_manifest"])
+    return claim["combined_manifest"]
+
+
+def _list_pending(s3_client: Any, table: str) -> List[Tuple[str, dict]]:
+    """
+    Get the manifests held for a table, as (pending path, details), oldest first.
+
+    A manifest held twice, e.g. by a retry or a duplicate s3 event, keeps its first position,
+    so its changes aren't taken as later than those of the manifests held after it.
+    """
+    paginator = s3_client.get_paginator("list_objects_v2")
+    pending_paths = sorted(
+        obj["Key"]
+        for page in paginator.paginate(
+            Bucket=Config.S3_BUCKET, Prefix=f"{_get_accumulating_dir(table)}/"
+        )
+        for obj in page.get("Contents", [])
+    )
+    pending = []
+    redshift_manifest_files = set()
+    for path in pending_paths:
+        details = s3_utils.read_json_from_s3(s3_client, Config.S3_BUCKET, path)
+        if details["redshift_manifest"] in redshift_manifest_files:
+            s3_client.delete_object(Bucket=Config.S3_BUCKET, Key=path)
+            continue
+        redshift_manifest_files.add(details["redshift_manifest"])
+        pending.append((path, details))
+    return pending
+
+
+def _is_due(pending: List[Tuple[str, dict]], check_size: bool) -> bool:
+    oldest = datetime.strptime(pending[0][1]["queued_at"], _DATETIME_FORMAT)
+    if (
+        datetime.utcnow() - oldest
+    ).total_seconds() >= Config.ACCUMULATE_MAX_AGE_SECONDS:
+        return True
+    if not check_size:
+        return False
+    return (
+        sum(p["item_count"] for _, p in pending) >= Config.ACCUMULATE_MIN_ITEMS
+        or sum(p["content_length"] for _, p in pending) >= Config.ACCUMULATE_MIN_BYTES
+    )
+
+
+def _combine(
+    s3_client: Any,
+    table: str,
+    pending: List[Tuple[str, dict]],
+) -> Union[str, None]:
+    """
+    Combine the manifests held for a table into one, keeping only the latest change per key,
+    once the table is claimed for it, see `_claim`.
+
+    A later manifest's change to a key replaces an earlier one's. Within a manifest, an upsert
+    wins over a delete of the same key, as the upsert applies a manifest's deletes first.
+    Only keys and positions are held in memory, the rows are read twice.
+
+    Returns:
+        str: s3 path to the combined manifest, or None if the table is claimed by another
+    """
+    claim_path = _claim(s3_client, table)
+    if claim_path is None:
+        Config.logger.info(
+            f"Holding {len(pending)} manifests of {table}, another combined manifest is being applied"
+        )
+        return None
+    try:
+        combined_manifest_file = _write_combined_manifest(
+            s3_client, table, pending, claim_path
+        )
+    except:
+        s3_client.delete_object(Bucket=Config.S3_BUCKET, Key=claim_path)
+        raise
+    _write_claim(s3_client, claim_path, combined_manifest_file)
+    return combined_manifest_file
+
+
+def _write_combined_manifest(
+    s3_client: Any,
+    table: str,
+    pending: List[Tuple[str, dict]],
+    claim_path: str,
+) -> str:
+    """Write the combined manifest of `_combine`. Returns its s3 path."""
+    redshift_manifests = [
+        s3_utils.read_json_from_s3(s3_client, Config.S3_BUCKET, p["redshift_manifest"])
+        for _, p in pending
+    ]
+    last_manifest = redshift_manifests[-1]
+    key_attributes = [
+        k for k in (last_manifest["partition_key"], last_manifest.get("sort_key")) if k
+    ]
+    split_deletes = bool(last_manifest.get("split_deletes"))
+    sources = _get_sources(s3_client, redshift_manifests)
+
+    def iter_rows():
+        for source_index, (manifest_index, is_deletes, file) in enumerate(sources):
+            lines = s3_utils.iter_lines_from_s3(s3_client, Config.S3_BUCKET, file)
+            for line_index, line in enumerate(lines):
+                item = json.loads(line)["Item"]
+                is_active = (
+                    not is_deletes
+                    if split_deletes
+                    else item.get("is_active", {}).get("BOOL", True)
+                )
+                key = json.dumps(
+                    {k: item.get(k) for k in key_attributes},
+                    sort_keys=True,
+                    separators=(",", ":"),
+                )
+                position = (manifest_index, is_active, source_index, line_index)
+                yield key, position, is_active, item
+
+    latest_changes: Dict[str, tuple] = {}
+    for key, position, _, _ in iter_rows():
+        if key not in latest_changes or position > latest_changes[key]:
+            latest_changes[key] = position
+
+    combined_dir = (
+        f"{_get_accumulating_dir()}-combined/{table}/"
+        f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S%fZ')}"
+    )
+    writers = {
+        True: output_formats.JsonItemWriter(
+            s3_client, Config.S3_BUCKET, f"{combined_dir}/upserts.json.gz"
+        ),
+        False: output_formats.JsonItemWriter(
+            s3_client, Config.S3_BUCKET, f"{combined_dir}/deletes/deletes.json.gz"
+        ),
+    }
+    if not split_deletes:
+        writers[False] = writers[True]  # deletes are rows with is_active false
+    try:
+        for key, position, is_active, item in iter_rows():
+            if latest_changes[key] == position:
+                writers[is_active].write_item(item)
+        for writer in set(writers.values()):
+            writer.close()
+    except:
+        for writer in set(writers.values()):
+            writer.abort()
+        raise
+
+    combined_manifest_file = f"{combined_dir}/{_COMBINED_MANIFEST}"
+    combined_manifest = dict(last_manifest)
+    combined_manifest.update(
+        {
+            "entries": _get_entries(writers[True].files),
+            "export_arns": [
+                a for m in redshift_manifests for a in m.get("export_arns") or []
+            ],
+            "item_count": len(latest_changes),
+            "deletes_manifest": None,
+            "accumulated": [path for path, _ in pending],
+            "claim": claim_path,
+        }
+    )
+    if split_deletes and writers[False].files:
+        deletes_manifest = s3_utils.read_json_from_s3(
+            s3_client, Config.S3_BUCKET, _get_deletes_manifest_file(redshift_manifests)
+        )
+        deletes_manifest["entries"] = _get_entries(writers[False].files)
+        combined_manifest[
+            "deletes_manifest"
+        ] = f"{combined_dir}/{_COMBINED_DELETES_MANIFEST}"
+        s3_client.put_object(
+            Bucket=Config.S3_BUCKET,
+            Key=combined_manifest["deletes_manifest"],
+            Body=json.dumps(deletes_manifest, indent=4),
+        )
+
+    Config.logger.info(
+        f"Combined {len(pending)} manifests of {table} into {combined_manifest_file}"
+    )
+    s3_client.put_object(
+        Bucket=Config.S3_BUCKET,
+        Key=combined_manifest_file,
+        Body=json.dumps(combined_manifest, indent=4),
+    )
+    return combined_manifest_file
+
+
+def _get_sources(
+    s3_client: Any,
+    redshift_manifests: List[dict],
+) -> List[Tuple[int, bool, str]]:
+    """Get the files of the manifests, as (manifest index, is deletes file, s3 path), in order."""
+    sources = []
+    for manifest_index, redshift_manifest in enumerate(redshift_manifests):
+        deletes_entries = []
+        if redshift_manifest.get("deletes_manifest"):
+            deletes_entries = s3_utils.read_json_from_s3(
+                s3_client, Config.S3_BUCKET, redshift_manifest["deletes_manifest"]
+            )["entries"]
+        for is_deletes, entries in (
+            (True, deletes_entries),
+            (False, redshift_manifest["entries"]),
+        ):
+            for entry in entries:
+                file = entry["url"].split(f"s3://{Config.S3_BUCKET}/", 1)[1]
+                sources.append((manifest_index, is_deletes, file))
+    return sources
+
+
+def _get_deletes_manifest_file(redshift_manifests: List[dict]) -> str:
+    return next(
+        m["deletes_manifest"]
+        for m in reversed(redshift_manifests)
+        if m.get("deletes_manifest")
+    )
+
+
+def _get_entries(files: List[str]) -> List[dict]:
+    return [{"url": f"s3://{Config.S3_BUCKET}/{p}", "mandatory": True} for p in files]
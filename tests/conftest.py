@@ -0,0 +1,95 @@
+import gzip
+import json
+import os
+import boto3
+import pytest
+from moto import mock_s3
+from src.runtime.chalicelib import (
+    dynamodb_export_handler,
+    metrics,
+    redshift_upsert_handler,
+)
+from src.runtime.chalicelib.config import Config
+
+Config.S3_BUCKET = "my-test-bucket"
+Config.S3_BUCKET_PREFIX = "test/"
+Config.REDSHIFT_TARGET_SCHEMA = "test_schema"
+Config.TABLE_ARN_PREFIX = "arn:aws:dynamodb:us-east-1:123456789012:table/"
+
+
+@pytest.fixture(scope="function")
+def s3_client():
+    """boto3 s3 client backed by moto, with the test bucket created."""
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_SECURITY_TOKEN"] = "testing"
+    os.environ["AWS_SESSION_TOKEN"] = "testing"
+    os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+    with mock_s3():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=Config.S3_BUCKET)
+        yield client
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    """Caches outlive invocations, so clear them between tests."""
+    yield
+    dynamodb_export_handler._WATERMARK_CACHE.invalidate()
+    redshift_upsert_handler._LEDGER_TABLES.invalidate()
+    for caches in metrics._STAGE_CACHES.values():
+        for cache in caches.values():
+            cache.take_counts()  # so they aren't published by the next test
+
+
+def put_gzipped_lines(s3_client, key, rows):
+    """Write rows to s3 as a gzipped json-lines file, like a dynamodb export data file."""
+    body = "\n".join(json.dumps(r) for r in rows)
+    s3_client.put_object(
+        Bucket=Config.S3_BUCKET, Key=key, Body=gzip.compress(body.encode("utf-8"))
+    )
+
+
+def read_gzipped_lines(s3_client, key):
+    obj = s3_client.get_object(Bucket=Config.S3_BUCKET, Key=key)
+    contents = gzip.decompress(obj["Body"].read()).decode("utf-8")
+    return [json.loads(line) for line in contents.splitlines() if line]
+
+
+def put_export(s3_client, table_s3_prefix, export_id, files, incremental=True):
+    """
+    Write a minimal dynamodb export to s3: data files, manifest-files.json and manifest-summary.json.
+
+    Args:
+        files: list of data files, each a list of rows
+
+    Returns:
+        s3 path to the manifest-summary.json
+    """
+    export_dir = f"{table_s3_prefix}/AWSDynamoDB/{export_id}"
+    manifest_files = []
+    for i, rows in enumerate(files):
+        key = f"{export_dir}/data/file-{i}.json.gz"
+        put_gzipped_lines(s3_client, key, rows)
+        manifest_files.append({"itemCount": len(rows), "dataFileS3Key": key})
+
+    manifest_files_key = f"{export_dir}/manifest-files.json"
+    s3_client.put_object(
+        Bucket=Config.S3_BUCKET,
+        Key=manifest_files_key,
+        Body="\n".join(json.dumps(m) for m in manifest_files),
+    )
+    manifest_summary_key = f"{export_dir}/manifest-summary.json"
+    manifest_summary = {
+        "exportArn": f"arn:aws:dynamodb:us-east-1:123456789012:table/t/export/{export_id}",
+        "s3Prefix": table_s3_prefix,
+        "manifestFilesS3Key": manifest_files_key,
+        "itemCount": sum(len(rows) for rows in files),
+        "exportType": "INCREMENTAL_EXPORT" if incremental else "FULL_EXPORT",
+    }
+    s3_client.put_object(
+        Bucket=Config.S3_BUCKET,
+        Key=manifest_summary_key,
+        Body=json.dumps(manifest_summary),
+    )
+    return manifest_summary_key
@@ -7,12 +7,14 @@ import boto3
 from moto import mock_s3
 from src.runtime.chalicelib import dynamodb_export_handler
 from datetime import datetime, timedelta
-from src.runtime.chalicelib.config import Config, s3_utils
+from src.runtime.chalicelib.config import Config
+from src.runtime.chalicelib import s3_utils
 from src.runtime import app
 
 Config.AWS_STAGE_ENV = "test"
 Config.S3_BUCKET = "my-test-bucket"
 Config.S3_BUCKET_PREFIX = "test/"
+Config.REDSHIFT_CLUSTER = "test_cluster_identifier"
 
 
 TEST_REDSHIFT_CREDENTIALS = {
@@ -53,7 +55,7 @@ def s3_mock(aws_credentials):
     with mock_s3():
         conn = boto3.resource("s3", region_name="us-east-1")
         # We need to create the bucket since this is all in Moto's 'virtual' AWS account
-        conn.create_bucket(Bucket=Config.s3_bucket)
+        conn.create_bucket(Bucket=Config.S3_BUCKET)
         yield conn
 
 
@@ -110,7 +112,7 @@ def test_run_incremental_export_manual():
     assert response is not None
 
 
-@pytest.mark.ignore("manual test only, it uses a real redshift cluster")
+@pytest.mark.skip(reason="manual test only, it uses a real redshift cluster")
 def test_upsert_handle_manual(test_client):
     """
     This manual test runs stages 2 and 3.
@@ -139,7 +141,7 @@ def test_upsert_handle_manual(test_client):
 def test_load_data_captured_in_full_export():
     # First, run the export and ensure the export has completed before running this test (wait 15 mins or so)
     s3_client = app.get_s3_client()
-    s3_bucket = Config.s3_bucket
+    s3_bucket = Config.S3_BUCKET
     table_s3_prefix = "dev/backup/dev-financial-orchestration-layer-devfinorchlayertable3811453F-1659MMDFU9LOO"
 
     # read exported data from s3
@@ -180,7 +182,7 @@ def test_load_data_captured_in_incremental_export():
     # Ensure the export has completed before running this test.
     # For example, delete a row, update a row, add a row, run export, wait 15 mins, run this test.
     s3_client = app.get_s3_client()
-    s3_bucket = Config.s3_bucket
+    s3_bucket = Config.S3_BUCKET
     table_s3_prefix = "dev/incremental-export/dev-financial-orchestration-layer-devfinorchlayertable3811453F-1659MMDFU9LOO"
 
     # read exported data from s3
@@ -200,7 +202,7 @@ def test_load_data_captured_in_incremental_export():
         latest_manifest_file["Key"],
     )
     files = [x["dataFileS3Key"] for x in data_files]
-    data = [s3_utils.read_json_from_s3(s3_client, Config.s3_bucket, f) for f in files]
+    data = [s3_utils.read_json_from_s3(s3_client, Config.S3_BUCKET, f) for f in files]
     data = [item for sublist in data for item in sublist]  # flatten list of lists
 
     assert len(data) > 0
@@ -276,3 +278,70 @@ def test_redshift_psycopg2_mock(secretsmanager_stub, redshift_connection_mock):
     assert data == expected
 
     secretsmanager_stub.assert_no_pending_responses()
+
+
+def test_redshift_connection_reused_until_unusable(redshift_connection_mock, mocker):
+    mocker.patch.object(Config, "REDSHIFT_REUSE_CONNECTION", True)
+    mocker.patch.object(Config, "REDSHIFT_CONNECTION_MAX_AGE_SECONDS", 60)
+    mocker.patch.object(app, "_REDSHIFT_CONNECTION", None)
+    first, second, third = mocker.MagicMock(), mocker.MagicMock(), mocker.MagicMock()
+    for conn in (first, second, third):
+        conn.closed = 0
+    redshift_connection_mock.side_effect = [first, second, third]
+    clock = mocker.patch.object(app.time, "monotonic", return_value=0)
+
+    with app.get_redshift_connection(TEST_REDSHIFT_CREDENTIALS) as conn:
+        assert conn is first
+    with app.get_redshift_connection(TEST_REDSHIFT_CREDENTIALS) as conn:
+        assert conn is first  # warm reuse, transaction reset and checked alive
+    first.cursor.return_value.execute.assert_called_with("SELECT 1;")
+    first.close.assert_not_called()
+
+    # broken connections are replaced
+    first.cursor.return_value.execute.side_effect = Exception("server closed")
+    with app.get_redshift_connection(TEST_REDSHIFT_CREDENTIALS) as conn:
+        assert conn is second
+    first.close.assert_called_once()
+
+    # and so are old connections
+    clock.return_value = 61
+    with app.get_redshift_connection(TEST_REDSHIFT_CREDENTIALS) as conn:
+        assert conn is third
+    second.close.assert_called_once()
+    assert redshift_connection_mock.call_count == 3
+
+
+def test_credentials_cached_and_refreshed_on_auth_failure(
+    secretsmanager_stub, redshift_connection_mock, mocker
+):
+    mocker.patch.object(app, "_CREDENTIALS_CACHE", app.TTLCache(ttl_seconds=60))
+    rotated = dict(TEST_REDSHIFT_CREDENTIALS, password="rotated_password")
+    for credentials in (TEST_REDSHIFT_CREDENTIALS, rotated):
+        secretsmanager_stub.add_response(
+            "get_secret_value", {"SecretString": json.dumps(credentials)}
+        )
+    redshift_connection_mock.side_effect = [
+        app.psycopg2.OperationalError("password authentication failed"),
+        mocker.MagicMock(),
+    ]
+
+    assert app.get_credentials() == TEST_REDSHIFT_CREDENTIALS
+    with app.get_redshift_connection(app.get_credentials()):
+        pass
+
+    assert redshift_connection_mock.call_args.kwargs["password"] == "rotated_password"
+    assert app.get_credentials() == rotated
+    secretsmanager_stub.assert_no_pending_responses()
+
+
+def test_upsert_schedules_off_by_default(mocker):
+    scheduled = [
+        e.name for e in app.app.event_sources if hasattr(e, "schedule_expression")
+    ]
+    assert "redshift_upsert_batch" not in scheduled
+    assert "redshift_upsert_status" not in scheduled
+    get_s3_client = mocker.patch.object(app, "get_s3_client")
+
+    assert app.redshift_upsert_batch() == []
+    assert app.redshift_upsert_status() == []
+    get_s3_client.assert_not_called()
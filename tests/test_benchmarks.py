@@ -0,0 +1,49 @@
+from benchmarks import run
+from benchmarks.synthetic_exports import generate_export
+from src.runtime.chalicelib import redshift_manifest_handler, s3_utils
+from src.runtime.chalicelib.config import Config
+from tests.conftest import read_gzipped_lines
+
+TABLE_S3_PREFIX = "test/dynamodb-export/incremental-export/AnotherDynamoDbTable"
+
+
+def test_synthetic_incremental_export_is_compacted_to_one_row_per_key(
+    s3_client, monkeypatch
+):
+    monkeypatch.setattr(Config, "COMPACT_INCREMENTAL_CHANGES", True)
+    export = generate_export(
+        s3_client,
+        Config.S3_BUCKET,
+        TABLE_S3_PREFIX,
+        "export-1",
+        is_incremental=True,
+        rows=500,
+        files=3,
+        item_width=256,
+    )
+    assert export["keys"] < export["rows"] == 500
+
+    redshift_manifest_file = redshift_manifest_handler.handle(
+        s3_client, export["manifest_summary_file"]
+    )
+
+    redshift_manifest = s3_utils.read_json_from_s3(
+        s3_client, Config.S3_BUCKET, redshift_manifest_file
+    )
+    rows = [
+        row["Item"]
+        for entry in redshift_manifest["entries"]
+        for row in read_gzipped_lines(
+            s3_client, entry["url"].split(f"s3://{Config.S3_BUCKET}/")[1]
+        )
+    ]
+    assert len(rows) == export["keys"]
+    assert {r["is_active"]["BOOL"] for r in rows} == {True, False}
+    assert not any("not_loaded" in r for r in rows)
+
+
+def test_compare_flags_slower_stages():
+    baseline = {"stages": {"a": {"seconds": 1.0}, "b": {"seconds": 1.0}}}
+    results = {"stages": {"a": {"seconds": 1.1}, "b": {"seconds": 1.5}}}
+
+    assert run.compare(results, baseline, threshold=0.2) == ["b"]
@@ -0,0 +1,315 @@
+from datetime import datetime, timedelta
+import boto3
+import pytest
+from botocore.stub import Stubber
+from src.runtime.chalicelib import (
+    dynamodb_export_handler,
+    export_groups,
+    export_ledger,
+    export_schedule,
+)
+from src.runtime.chalicelib.config import Config
+
+TABLE = "AnotherDynamoDbTable"
+TABLE_S3_PREFIX = f"test/dynamodb-export/incremental-export/{TABLE}"
+
+
+def _export_response(export_id):
+    return {
+        "ExportDescription": {
+            "ExportArn": f"arn:aws:dynamodb:us-east-1:123456789012:table/{TABLE}/export/{export_id}"
+        }
+    }
+
+
+def test_incremental_backlog_is_grouped_for_coalescing(s3_client, monkeypatch):
+    monkeypatch.setattr(Config, "COALESCE_BACKLOG_EXPORTS", True)
+    dynamodb_client = boto3.client("dynamodb", region_name="us-east-1")
+    now = datetime(2024, 1, 3, 12)
+    with Stubber(dynamodb_client) as stub:
+        for export_id in ("export-1", "export-2", "export-3"):
+            stub.add_response(
+                "export_table_to_point_in_time", _export_response(export_id)
+            )
+
+        responses = dynamodb_export_handler.handle(
+            dynamodb_client=dynamodb_client,
+            s3_client=s3_client,
+            tables=[TABLE],
+            is_incremental=True,
+            s3_bucket=Config.S3_BUCKET,
+            export_time=now,
+            export_from_datetime=now - timedelta(days=2, hours=12),
+        )
+        stub.assert_no_pending_responses()
+
+    assert len(responses) == 3
+    for export_id in ("export-1", "export-2", "export-3"):
+        assert export_groups.read_group(
+            s3_client, Config.S3_BUCKET, TABLE_S3_PREFIX, export_id
+        ) == ["export-1", "export-2", "export-3"]
+
+
+class _FakeDynamoDbClient:
+    """Records exports, and fails them for `failing_tables`."""
+
+    def __init__(self, failing_tables=()):
+        self.failing_tables = failing_tables
+        self.exports = []
+        self.failed_exports = set()
+
+    def describe_export(self, ExportArn):
+        status = "FAILED" if ExportArn in self.failed_exports else "COMPLETED"
+        return {"ExportDescription": {"ExportArn": ExportArn, "ExportStatus": status}}
+
+    def export_table_to_point_in_time(self, **kwargs):
+        table = kwargs["TableArn"].split("/")[-1]
+        if table in self.failing_tables:
+            raise ValueError(f"export failed for {table}")
+        self.exports.append(kwargs)
+        return _export_response(f"{table}-{len(self.exports)}")
+
+
+def test_tables_exported_concurrently_with_errors_aggregated(s3_client, monkeypatch):
+    monkeypatch.setattr(Config, "EXPORT_SUBMISSION_INTERVAL_SECONDS", 0)
+    now = datetime(2024, 1, 3, 12)
+    behind = "test/dynamodb-export/incremental-export/BehindTable/last-export-time.txt"
+    for table, last_export_time in [
+        ("BehindTable", now - timedelta(days=1, hours=6)),
+        ("FailingTable", now - timedelta(minutes=15)),
+        ("UpToDateTable", now - timedelta(minutes=15)),
+    ]:
+        s3_client.put_object(
+            Bucket=Config.S3_BUCKET,
+            Key=f"test/dynamodb-export/incremental-export/{table}/last-export-time.txt",
+            Body=last_export_time.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+        )
+    dynamodb_client = _FakeDynamoDbClient(failing_tables=["FailingTable"])
+
+    with pytest.raises(Exception, match="1 of 3 tables failed") as ex:
+        dynamodb_export_handler.handle(
+            dynamodb_client=dynamodb_client,
+            s3_client=s3_client,
+            tables=["BehindTable", "FailingTable", "UpToDateTable"],
+            is_incremental=True,
+            export_time=now,
+        )
+    assert "FailingTable" in str(ex.value.__cause__)
+
+    exported = [
+        (
+            e["TableArn"].split("/")[-1],
+            e["IncrementalExportSpecification"]["ExportToTime"],
+        )
+        for e in dynamodb_client.exports
+    ]
+    # both periods of the backlog are exported, in order
+    assert [e for e in exported if e[0] == "BehindTable"] == [
+        ("BehindTable", now - timedelta(hours=6)),
+        ("BehindTable", now),
+    ]
+    assert ("UpToDateTable", now) in exported
+    assert s3_client.get_object(Bucket=Config.S3_BUCKET, Key=behind)[
+        "Body"
+    ].read().decode() == now.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def test_failed_backlog_exports_resubmitted_and_timed_out(s3_client, monkeypatch):
+    monkeypatch.setattr(Config, "COALESCE_BACKLOG_EXPORTS", True)
+    monkeypatch.setattr(Config, "COALESCE_GROUP_TIMEOUT_MINUTES", 60)
+    now = datetime(2024, 1, 3, 12)
+    dynamodb_client = _FakeDynamoDbClient()
+    dynamodb_export_handler.handle(
+        dynamodb_client=dynamodb_client,
+        s3_client=s3_client,
+        tables=[TABLE],
+        is_incremental=True,
+        export_time=now,
+        export_from_datetime=now - timedelta(days=1, hours=12),
+    )
+    dynamodb_client.failed_exports.add(
+        _export_response(f"{TABLE}-1")["ExportDescription"]["ExportArn"]
+    )
+
+    # the failed export of the backlog is submitted again, and the backlog waits for it
+    dynamodb_export_handler.handle(
+        dynamodb_client=dynamodb_client,
+        s3_client=s3_client,
+        tables=[TABLE],
+        is_incremental=True,
+        export_time=now + timedelta(minutes=15),
+    )
+    resubmitted = dynamodb_client.exports[2]["IncrementalExportSpecification"]
+    assert resubmitted["ExportFromTime"] == now - timedelta(days=1, hours=12)
+    assert resubmitted["ExportToTime"] == now - timedelta(hours=12)
+    for export_id in (f"{TABLE}-3", f"{TABLE}-2"):
+        assert export_groups.read_group(
+            s3_client, Config.S3_BUCKET, TABLE_S3_PREFIX, export_id
+        ) == [f"{TABLE}-3", f"{TABLE}-2"]
+
+    # and fails once it has waited too long
+    with pytest.raises(Exception, match="1 of 1 tables failed") as ex:
+        dynamodb_export_handler.handle(
+            dynamodb_client=dynamodb_client,
+            s3_client=s3_client,
+            tables=[TABLE],
+            is_incremental=True,
+            export_time=now + timedelta(hours=2),
+        )
+    assert "still waiting for exports" in str(ex.value.__cause__)
+
+
+def test_incremental_exports_recorded_in_ledger(s3_client, monkeypatch):
+    monkeypatch.setattr(Config, "ORDERED_APPLY", True)
+    monkeypatch.setattr(Config, "EXPORT_SUBMISSION_INTERVAL_SECONDS", 60)
+    monkeypatch.setattr(
+        dynamodb_export_handler.time, "sleep", pytest.fail
+    )  # submitted back to back
+    now = datetime(2024, 1, 3, 12)
+    dynamodb_client = _FakeDynamoDbClient()
+
+    dynamodb_export_handler.handle(
+        dynamodb_client=dynamodb_client,
+        s3_client=s3_client,
+        tables=[TABLE],
+        is_incremental=True,
+        export_time=now,
+        export_from_datetime=now - timedelta(days=1, hours=12),
+    )
+
+    entries = export_ledger.list_entries(s3_client, Config.S3_BUCKET, TABLE_S3_PREFIX)
+    assert [(e["ExportArn"], e["Status"]) for e in entries] == [
+        (_export_response(f"{TABLE}-1")["ExportDescription"]["ExportArn"], "SUBMITTED"),
+        (_export_response(f"{TABLE}-2")["ExportDescription"]["ExportArn"], "SUBMITTED"),
+    ]
+    assert export_ledger.parse_datetime(entries[1]["ExportToTime"]) == now
+
+
+def test_failed_incremental_exports_resubmitted(s3_client, monkeypatch):
+    monkeypatch.setattr(Config, "ORDERED_APPLY", True)
+    now = datetime(2024, 1, 3, 12)
+    dynamodb_client = _FakeDynamoDbClient()
+    dynamodb_export_handler.handle(
+        dynamodb_client=dynamodb_client,
+        s3_client=s3_client,
+        tables=[TABLE],
+        is_incremental=True,
+        export_time=now,
+        export_from_datetime=now - timedelta(minutes=15),
+    )
+    failed_arn = _export_response(f"{TABLE}-1")["ExportDescription"]["ExportArn"]
+    dynamodb_client.failed_exports.add(failed_arn)
+
+    dynamodb_export_handler.handle(
+        dynamodb_client=dynamodb_client,
+        s3_client=s3_client,
+        tables=[TABLE],
+        is_incremental=True,
+        export_time=now + timedelta(minutes=15),
+    )
+
+    resubmitted = dynamodb_client.exports[1]["IncrementalExportSpecification"]
+    assert resubmitted["ExportFromTime"] == now - timedelta(minutes=15)
+    assert resubmitted["ExportToTime"] == now
+    entries = export_ledger.list_entries(s3_client, Config.S3_BUCKET, TABLE_S3_PREFIX)
+    assert [e["ExportArn"] for e in entries] == [
+        _export_response(f"{TABLE}-2")["ExportDescription"]["ExportArn"],
+        _export_response(f"{TABLE}-3")["ExportDescription"]["ExportArn"],
+    ]
+
+
+def test_last_export_time_cached_until_changed_in_s3(s3_client, monkeypatch):
+    monkeypatch.setattr(dynamodb_export_handler._WATERMARK_CACHE, "ttl_seconds", 3600)
+    now = datetime(2024, 1, 3, 12)
+    last_export_s3_path = f"{TABLE_S3_PREFIX}/last-export-time.txt"
+
+    def put_last_export_time(last_export_time):
+        s3_client.put_object(
+            Bucket=Config.S3_BUCKET,
+            Key=last_export_s3_path,
+            Body=last_export_time.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+        )
+
+    put_last_export_time(now - timedelta(minutes=15))
+    dynamodb_client = _FakeDynamoDbClient()
+
+    def export(export_time):
+        dynamodb_export_handler.handle(
+            dynamodb_client=dynamodb_client,
+            s3_client=s3_client,
+            tables=TABLE,
+            is_incremental=True,
+            export_time=export_time,
+        )
+
+    export(now)
+    # the second run uses the last export time the first one wrote, without reading it
+    read_contents_from_s3 = dynamodb_export_handler.s3_utils.read_contents_from_s3
+    monkeypatch.setattr(
+        dynamodb_export_handler.s3_utils, "read_contents_from_s3", pytest.fail
+    )
+    export(now + timedelta(minutes=15))
+    monkeypatch.setattr(
+        dynamodb_export_handler.s3_utils,
+        "read_contents_from_s3",
+        read_contents_from_s3,
+    )
+    # another container advanced it since, so it is read again
+    put_last_export_time(now + timedelta(minutes=45))
+    export(now + timedelta(minutes=60))
+
+    assert [
+        e["IncrementalExportSpecification"]["ExportFromTime"]
+        for e in dynamodb_client.exports
+    ] == [
+        now - timedelta(minutes=15),
+        now,
+        now + timedelta(minutes=45),
+    ]
+
+
+def test_adaptive_schedule_exports_tables_once_due(s3_client, monkeypatch):
+    monkeypatch.setattr(Config, "ADAPTIVE_EXPORT_SCHEDULE", True)
+    monkeypatch.setattr(Config, "EXPORT_MIN_INTERVAL_MINUTES", 15)
+    monkeypatch.setattr(Config, "EXPORT_MAX_INTERVAL_MINUTES", 240)
+    monkeypatch.setattr(Config, "EXPORT_TARGET_ITEMS", 3600)
+    now = datetime(2024, 1, 3, 12)
+    quiet_prefix = "test/dynamodb-export/incremental-export/QuietTable"
+    for table_s3_prefix in (TABLE_S3_PREFIX, quiet_prefix):
+        s3_client.put_object(
+            Bucket=Config.S3_BUCKET,
+            Key=f"{table_s3_prefix}/last-export-time.txt",
+            Body=(now - timedelta(minutes=30)).strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+        )
+
+    def record_export(table_s3_prefix, item_count, export_to_time="11:30"):
+        return export_schedule.record_export(
+            s3_client,
+            Config.S3_BUCKET,
+            table_s3_prefix,
+            {
+                "exportFromTime": "2024-01-03T11:00:00.000Z",
+                "exportToTime": f"2024-01-03T{export_to_time}:00.000Z",
+                "itemCount": item_count,
+                "billedSizeBytes": item_count * 100,
+            },
+        )
+
+    # 1 item a second reaches the target in an hour, smoothed with the previous rate
+    assert record_export(quiet_prefix, 1800)["interval_seconds"] == 3600
+    # an export is only recorded once
+    assert record_export(quiet_prefix, 0) is None
+    assert record_export(quiet_prefix, 0, "12:00")["interval_seconds"] == 7200
+    # a hot table is held to the minimum, the shortest incremental export window
+    assert record_export(TABLE_S3_PREFIX, 180000)["interval_seconds"] == 15 * 60
+    dynamodb_client = _FakeDynamoDbClient()
+
+    dynamodb_export_handler.handle(
+        dynamodb_client=dynamodb_client,
+        s3_client=s3_client,
+        tables=[TABLE, "QuietTable"],
+        is_incremental=True,
+        export_time=now,
+    )
+
+    assert [e["TableArn"].split("/")[-1] for e in dynamodb_client.exports] == [TABLE]
@@ -0,0 +1,39 @@
+import pytest
+from src.runtime.chalicelib import jsonpaths
+
+
+def test_parse_jsonpath():
+    assert jsonpaths.parse_jsonpath("$['Item']['PK']['S']") == ("Item", "PK", "S")
+    assert jsonpaths.parse_jsonpath("$.Item.PK.S") == ("Item", "PK", "S")
+    assert jsonpaths.parse_jsonpath("$['Item']['tags']['L'][0]['S']") == (
+        "Item",
+        "tags",
+        "L",
+        0,
+        "S",
+    )
+    with pytest.raises(ValueError):
+        jsonpaths.parse_jsonpath("$['Item'")
+
+
+def test_compile_and_project():
+    projection = jsonpaths.compile_projection(
+        [
+            "$['Item']['PK']['S']",
+            "$['Item']['info']['M']['a']['N']",
+            "$['Item']['tags']['L'][1]['S']",
+        ]
+    )
+    item = {
+        "PK": {"S": "pk"},
+        "other": {"S": "dropped"},
+        "info": {"M": {"a": {"N": "1"}, "b": {"N": "2"}}},
+        "tags": {"L": [{"S": "x"}, {"S": "y"}]},
+    }
+
+    assert jsonpaths.project_item(item, projection) == {
+        "PK": {"S": "pk"},
+        "info": {"M": {"a": {"N": "1"}}},
+        "tags": {"L": [{"S": "x"}, {"S": "y"}]},
+    }
+    assert jsonpaths.project_item({"PK": {"NULL": True}}, projection) == {}
@@ -0,0 +1,166 @@
+import csv
+import os
+import pytest
+from benchmarks import local_pipeline
+from src.runtime.chalicelib import (
+    redshift_manifest_handler,
+    redshift_upsert_handler,
+    s3_utils,
+)
+from src.runtime.chalicelib.config import Config
+from tests.conftest import put_export
+
+TABLE_S3_PREFIX = "test/dynamodb-export/incremental-export/AnotherDynamoDbTable"
+
+
+class _FakeCursor:
+    """Records the sql executed, and the rows bulk loaded with `copy_expert`."""
+
+    def __init__(self, rows=()):
+        self.executed = []
+        self.copied = []
+        self._rows = list(rows)
+
+    def execute(self, sql, params=None):
+        self.executed.append(sql)
+
+    def fetchall(self):
+        return self._rows
+
+    def copy_expert(self, sql, file):
+        self.copied.append((sql, list(csv.reader(file))))
+
+
+def test_translate_redshift_sql():
+    sql = local_pipeline.translate(
+        """
+        DROP TABLE IF EXISTS #t_staging;
+        CREATE TABLE #t_staging (LIKE s.t);
+        SELECT * INTO #t_staging_active FROM #t_staging;
+        ALTER TABLE s.t APPEND FROM s.t_staging;
+        applied_at TIMESTAMP DEFAULT GETDATE()
+        """
+    )
+
+    assert "#" not in sql
+    assert "CREATE TABLE pg_temp.t_staging (LIKE s.t);" in sql
+    assert "SELECT * INTO pg_temp.t_staging_active FROM pg_temp.t_staging;" in sql
+    assert "INSERT INTO s.t SELECT * FROM s.t_staging;" in sql
+    assert "DEFAULT now()" in sql
+
+
+def test_merge_remove_duplicates_is_expanded():
+    cursor = _FakeCursor(rows=[("pk",), ("sk",), ("some_text",)])
+
+    local_pipeline.LocalRedshiftCursor(cursor, s3_client=None).execute(
+        """
+        MERGE INTO s.t USING #t_staging_active AS source
+        ON s.t.PK = source.PK AND s.t.SK = source.SK
+        REMOVE DUPLICATES;
+        """
+    )
+
+    merge = cursor.executed[-1]
+    assert "MERGE INTO s.t USING pg_temp.t_staging_active AS source" in merge
+    assert "ON s.t.PK = source.PK AND s.t.SK = source.SK" in merge
+    assert (
+        "WHEN MATCHED THEN UPDATE SET pk = source.pk, sk = source.sk, some_text = source.some_text"
+        in merge
+    )
+    assert "WHEN NOT MATCHED THEN INSERT (pk, sk, some_text)" in merge
+    assert "REMOVE DUPLICATES" not in merge
+
+
+def test_copy_manifest_is_bulk_loaded(s3_client):
+    item = {"PK": {"S": "a"}, "SK": {"S": "1"}, "order_confirmed": {"BOOL": True}}
+    rows = [
+        {
+            "Metadata": {"WriteTimestampMicros": {"N": "1"}},
+            "Keys": {"PK": {"S": "a"}, "SK": {"S": "1"}},
+            "NewImage": item,
+        },
+        {
+            "Metadata": {"WriteTimestampMicros": {"N": "2"}},
+            "Keys": {"PK": {"S": "b"}, "SK": {"S": "1"}},
+            "OldImage": {"PK": {"S": "b"}, "SK": {"S": "1"}},
+        },
+    ]
+    redshift_manifest_file = redshift_manifest_handler.handle(
+        s3_client,
+        put_export(s3_client, TABLE_S3_PREFIX, "01700000000000-abcdefgh", [rows]),
+    )
+    redshift_manifest = s3_utils.read_json_from_s3(
+        s3_client, Config.S3_BUCKET, redshift_manifest_file
+    )
+    cursor = _FakeCursor()
+
+    local_pipeline.LocalRedshiftCursor(cursor, s3_client).execute(
+        redshift_upsert_handler._get_copy_command(
+            "#t_staging",
+            local_pipeline.CREDENTIALS,
+            redshift_manifest_file,
+            redshift_manifest,
+        )
+    )
+
+    assert cursor.executed == []
+    ((sql, copied),) = cursor.copied
+    assert sql == "COPY pg_temp.t_staging FROM STDIN WITH (FORMAT csv)"
+    # in jsonpaths order, missing attributes are null
+    assert sorted(copied) == [
+        ["a", "1", "", "", "True", "", "True"],
+        ["b", "1", "", "", "", "", "False"],
+    ]
+
+
+@pytest.mark.skipif(
+    not os.environ.get("LOCAL_POSTGRES_DSN"),
+    reason="needs a PostgreSQL 15+ database, set LOCAL_POSTGRES_DSN",
+)
+def test_run_pipeline_against_postgres(monkeypatch):
+    for name in (
+        "S3_BUCKET",
+        "S3_BUCKET_PREFIX",
+        "TABLE_ARN_PREFIX",
+        "EXPORT_SUBMISSION_INTERVAL_SECONDS",
+    ):
+        monkeypatch.setattr(Config, name, getattr(Config, name))
+    monkeypatch.setattr(Config, "REDSHIFT_TARGET_SCHEMA", "local_pipeline_test")
+
+    results = local_pipeline.run(
+        os.environ["LOCAL_POSTGRES_DSN"], rows=200, files=2, incremental_runs=2
+    )
+
+    assert set(results["seconds"]) == {
+        "dynamodb_export",
+        "redshift_manifest_creation",
+        "redshift_upsert",
+    }
+    assert all(rows > 0 for rows in results["target_rows"].values())
+
+
+def test_shards_are_processed_and_fanned_in(s3_client, monkeypatch):
+    monkeypatch.setattr(Config, "MANIFEST_SHARD_FILES", 1)
+    rows = [
+        [
+            {
+                "Metadata": {"WriteTimestampMicros": {"N": str(i)}},
+                "Keys": {"PK": {"S": f"k{i}"}, "SK": {"S": "1"}},
+                "NewImage": {"PK": {"S": f"k{i}"}, "SK": {"S": "1"}},
+            }
+        ]
+        for i in range(3)
+    ]
+    manifest_summary_file = put_export(
+        s3_client, TABLE_S3_PREFIX, "01700000000000-abcdefgh", rows
+    )
+    assert redshift_manifest_handler.handle(s3_client, manifest_summary_file) is None
+
+    redshift_manifest_file = local_pipeline._process_shards(
+        s3_client, manifest_summary_file, max_workers=2
+    )
+
+    redshift_manifest = s3_utils.read_json_from_s3(
+        s3_client, Config.S3_BUCKET, redshift_manifest_file
+    )
+    assert len(redshift_manifest["entries"]) == 3
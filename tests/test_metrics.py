@@ -0,0 +1,148 @@
+import json
+import pytest
+from src.runtime.chalicelib import metrics, redshift_manifest_handler
+from src.runtime.chalicelib.ttl_cache import TTLCache
+from src.runtime.chalicelib.config import Config
+from tests.conftest import put_export
+
+TABLE_S3_PREFIX = "test/dynamodb-export/incremental-export/AnotherDynamoDbTable"
+
+
+def _get_emf_records(capsys):
+    """The CloudWatch embedded metric format records printed to stdout."""
+    records = []
+    for line in capsys.readouterr().out.splitlines():
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if "_aws" in record:
+            records.append(record)
+    return records
+
+
+def _get_value(record, name):
+    """The value of a metric added once, which powertools writes as a list."""
+    (value,) = record[name]
+    return value
+
+
+def _get_metric_names(record):
+    return {
+        m["Name"] for d in record["_aws"]["CloudWatchMetrics"] for m in d["Metrics"]
+    }
+
+
+class _FakeCursor:
+    rowcount = 3
+
+    def __init__(self):
+        self.executed = []
+
+    def execute(self, sql, params=None):
+        self.executed.append(sql)
+
+
+@pytest.mark.parametrize(
+    "sql,expected",
+    [
+        ("COPY t FROM 's3://b/k'", "Copy"),
+        ("\n  -- remove deleted rows\n  delete from t using s;", "Delete"),
+        ("MERGE INTO t USING s ON t.id = s.id REMOVE DUPLICATES;", "Merge"),
+        ("", "Statement"),
+    ],
+)
+def test_get_statement_name(sql, expected):
+    assert metrics.get_statement_name(sql) == expected
+
+
+def test_timed_cursor_publishes_statement_times(capsys, monkeypatch):
+    monkeypatch.setattr(Config, "METRICS_ENABLED", True)
+    cursor = _FakeCursor()
+
+    with metrics.StageMetrics("redshift_upsert", "schema.table") as stage_metrics:
+        timed_cursor = metrics.TimedCursor(cursor, stage_metrics)
+        timed_cursor.execute("COPY t FROM 's3://b/k';")
+        timed_cursor.execute("MERGE INTO t USING s ON t.id = s.id;")
+
+    assert cursor.executed == [
+        "COPY t FROM 's3://b/k';",
+        "MERGE INTO t USING s ON t.id = s.id;",
+    ]
+    assert timed_cursor.rowcount == 3
+    (record,) = _get_emf_records(capsys)
+    assert _get_metric_names(record) == {"CopyTime", "MergeTime", "MergeRows"}
+    assert record["stage"] == "redshift_upsert"
+    assert record["table"] == "schema.table"
+    assert _get_value(record, "MergeRows") == 3
+
+
+def test_registered_caches_published_with_their_stage_once_used(capsys, monkeypatch):
+    monkeypatch.setattr(Config, "METRICS_ENABLED", True)
+    monkeypatch.setattr(metrics, "_STAGE_CACHES", {})
+    cache = TTLCache(ttl_seconds=60)
+    metrics.register_cache("redshift_upsert", "Credentials", cache)
+    cache.get_or_load("secret", dict)
+    cache.get_or_load("secret", dict)
+
+    with metrics.StageMetrics("redshift_manifest_creation") as stage_metrics:
+        stage_metrics.add("Rows", 1)
+    with metrics.StageMetrics("redshift_upsert", "schema.table") as stage_metrics:
+        stage_metrics.add("Rows", 1)
+    with metrics.StageMetrics("redshift_upsert", "schema.table") as stage_metrics:
+        stage_metrics.add("Rows", 1)
+
+    other, used, unused = _get_emf_records(capsys)
+    assert _get_metric_names(other) == {"Rows"}
+    assert _get_value(used, "CredentialsCacheHits") == 1
+    assert _get_value(used, "CredentialsCacheMisses") == 1
+    assert _get_metric_names(unused) == {"Rows"}
+
+
+def test_metrics_disabled_publishes_nothing(capsys, monkeypatch):
+    monkeypatch.setattr(Config, "METRICS_ENABLED", False)
+
+    with metrics.StageMetrics("redshift_upsert", "schema.table") as stage_metrics:
+        with stage_metrics.timed("Copy"):
+            pass
+
+    assert _get_emf_records(capsys) == []
+
+
+def test_manifest_creation_publishes_processing_metrics(s3_client, capsys, monkeypatch):
+    monkeypatch.setattr(Config, "METRICS_ENABLED", True)
+    item = {"PK": {"S": "a"}, "SK": {"S": "1"}, "some_text": {"S": "x" * 100}}
+    rows = [
+        {
+            "Metadata": {"WriteTimestampMicros": {"N": str(i)}},
+            "Keys": {"PK": {"S": f"k{i}"}, "SK": {"S": "1"}},
+            "NewImage" if i % 4 else "OldImage": item,
+        }
+        for i in range(20)
+    ]
+    manifest_summary_file = put_export(
+        s3_client, TABLE_S3_PREFIX, "01700000000000-abcdefgh", [rows[:10], rows[10:]]
+    )
+    capsys.readouterr()
+
+    redshift_manifest_handler.handle(s3_client, manifest_summary_file)
+
+    (record,) = _get_emf_records(capsys)
+    assert record["stage"] == "redshift_manifest_creation"
+    assert record["table"] == "AnotherDynamoDbTable"
+    assert {
+        "S3ReadTime",
+        "TransformTime",
+        "EncodeTime",
+        "S3WriteTime",
+        "S3ReadBytes",
+        "S3WriteBytes",
+        "CompressionPercent",
+        "ProcessDataFilesTime",
+    } <= _get_metric_names(record)
+    assert _get_value(record, "RowsRead") == 20
+    assert _get_value(record, "RowsWritten") == 20
+    assert _get_value(record, "Upserts") == 15
+    assert _get_value(record, "Deletes") == 5
+    assert _get_value(record, "DataFiles") == 2
+    assert 0 < _get_value(record, "CompressionPercent") < 100
@@ -0,0 +1,63 @@
+import sys
+from datetime import datetime
+from decimal import Decimal
+import pytest
+from src.runtime.chalicelib import output_formats
+
+
+def test_compile_columns():
+    columns = output_formats.compile_columns(
+        [
+            "$['Item']['PK']['S']",
+            "$['Item']['info']['M']['amount']['N']",
+            "$['Item']['created']['S']",
+            "$['Item']['is_active']['BOOL']",
+        ],
+        {
+            "$['Item']['info']['M']['amount']['N']": "decimal(12, 2)",
+            "$['Item']['created']['S']": "timestamp",
+        },
+    )
+
+    assert [(c.name, c.type) for c in columns] == [
+        ("pk", "string"),
+        ("info_amount", "decimal(12, 2)"),
+        ("created", "timestamp"),
+        ("is_active", "bool"),
+    ]
+    item = {
+        "PK": {"S": "a"},
+        "info": {"M": {"amount": {"N": "10.25"}}},
+        "created": {"S": "2024-01-01T10:00:00Z"},
+    }
+    assert [output_formats._get_value(item, c) for c in columns] == [
+        "a",
+        Decimal("10.25"),
+        datetime(2024, 1, 1, 10),
+        None,
+    ]
+
+    with pytest.raises(ValueError):
+        output_formats.compile_columns(
+            ["$['Item']['PK']['S']"], {"$['Item']['PK']['S']": "text"}
+        )
+
+
+def test_parquet_writer_requires_a_type_for_numbers(s3_client):
+    [column] = output_formats.compile_columns(["$['Item']['amount']['N']"])
+    assert column.type is None
+
+    with pytest.raises(ValueError, match="parquet_types"):
+        output_formats.ParquetItemWriter(
+            s3_client, "bucket", "part-0.parquet", [column]
+        )
+
+
+def test_parquet_writer_says_how_to_install_pyarrow(s3_client, monkeypatch):
+    monkeypatch.setitem(sys.modules, "pyarrow", None)
+    [column] = output_formats.compile_columns(["$['Item']['PK']['S']"])
+
+    with pytest.raises(ImportError, match="layers/pyarrow"):
+        output_formats.ParquetItemWriter(
+            s3_client, "bucket", "part-0.parquet", [column]
+        )
@@ -0,0 +1,719 @@
+import io
+import json
+import os
+from decimal import Decimal
+import pytest
+from src.runtime.chalicelib import (
+    digest_index,
+    export_groups,
+    manifest_shards,
+    redshift_manifest_handler,
+    s3_utils,
+)
+from src.runtime.chalicelib.config import Config
+from tests.conftest import put_export, put_gzipped_lines, read_gzipped_lines
+
+TABLE_S3_PREFIX = "test/dynamodb-export/incremental-export/AnotherDynamoDbTable"
+TABLE = "AnotherDynamoDbTable"
+PROCESSED_DIR = f"{TABLE_S3_PREFIX}/AWSDynamoDB/processed"
+
+
+def _change(pk, sk, new_image=None, old_image=None, write_timestamp=0):
+    row = {
+        "Metadata": {"WriteTimestampMicros": {"N": str(write_timestamp)}},
+        "Keys": {"PK": {"S": pk}, "SK": {"S": sk}},
+    }
+    if new_image is not None:
+        row["NewImage"] = new_image
+    if old_image is not None:
+        row["OldImage"] = old_image
+    return row
+
+
+def test_process_data_file_streams_rows(s3_client):
+    data_file = f"{TABLE_S3_PREFIX}/AWSDynamoDB/data/file-1.json.gz"
+    item = {"PK": {"S": "a"}, "SK": {"S": "1"}}
+    put_gzipped_lines(
+        s3_client,
+        data_file,
+        [
+            _change("a", "1", new_image=item),
+            _change("a", "1", new_image=item, old_image=item),
+            _change("a", "1", old_image=item),
+        ],
+    )
+
+    processed = redshift_manifest_handler._process_data_file(
+        s3_client, TABLE, PROCESSED_DIR, data_file
+    )
+
+    assert processed == [f"{TABLE_S3_PREFIX}/AWSDynamoDB/processed/file-1.json.gz"]
+    rows = read_gzipped_lines(s3_client, processed[0])
+    assert [r["Item"]["is_active"]["BOOL"] for r in rows] == [True, True, False]
+    assert all("OldImage" not in r and "NewImage" not in r for r in rows)
+
+
+def test_process_data_file_empty(s3_client):
+    data_file = f"{TABLE_S3_PREFIX}/AWSDynamoDB/data/empty.json.gz"
+    put_gzipped_lines(s3_client, data_file, [])
+
+    processed = redshift_manifest_handler._process_data_file(
+        s3_client, TABLE, PROCESSED_DIR, data_file
+    )
+
+    assert processed == []
+    assert not s3_utils.exists(
+        s3_client,
+        Config.S3_BUCKET,
+        f"{TABLE_S3_PREFIX}/AWSDynamoDB/processed/empty.json.gz",
+    )
+
+
+def test_s3_gzip_writer_multipart(s3_client):
+    key = "test/multipart.json.gz"
+    lines = [f'{{"n": {i}, "pad": "{os.urandom(32).hex()}"}}' for i in range(150_000)]
+
+    with s3_utils.S3GzipWriter(
+        s3_client, Config.S3_BUCKET, key, part_size=s3_utils.MIN_MULTIPART_PART_SIZE
+    ) as writer:
+        for line in lines:
+            writer.write_line(line)
+
+    assert len(writer._parts) > 1
+    assert list(s3_utils.iter_lines_from_s3(s3_client, Config.S3_BUCKET, key)) == lines
+
+
+def test_process_data_files_keeps_order_and_collects_errors(s3_client):
+    item = {"PK": {"S": "a"}, "SK": {"S": "1"}}
+    data_files = [
+        f"{TABLE_S3_PREFIX}/AWSDynamoDB/data/file-{i}.json.gz" for i in range(6)
+    ]
+    for file in data_files:
+        if not file.endswith("file-3.json.gz"):  # file-3 is missing, so fails
+            put_gzipped_lines(s3_client, file, [_change("a", "1", new_image=item)])
+
+    with pytest.raises(Exception, match="1 of 6 data files failed"):
+        redshift_manifest_handler._process_data_files(
+            s3_client, TABLE, PROCESSED_DIR, data_files
+        )
+
+    # every other file was still attempted
+    for i in (0, 1, 2, 4, 5):
+        assert s3_utils.exists(
+            s3_client,
+            Config.S3_BUCKET,
+            f"{TABLE_S3_PREFIX}/AWSDynamoDB/processed/file-{i}.json.gz",
+        )
+
+    processed = redshift_manifest_handler._process_data_files(
+        s3_client,
+        TABLE,
+        PROCESSED_DIR,
+        [f for f in data_files if "file-3" not in f],
+    )
+    assert [p.split("/")[-1] for files in processed for p in files] == [
+        f"file-{i}.json.gz" for i in (0, 1, 2, 4, 5)
+    ]
+
+
+def test_process_data_files_resumes_from_checkpoints(s3_client, monkeypatch):
+    monkeypatch.setattr(Config, "CHECKPOINT_PROCESSED_FILES", True)
+    item = {"PK": {"S": "a"}, "SK": {"S": "1"}}
+    data_files = [
+        f"{TABLE_S3_PREFIX}/AWSDynamoDB/data/file-{i}.json.gz" for i in range(4)
+    ]
+    for file in data_files[:3]:  # file-3 is missing, so the first attempt fails
+        put_gzipped_lines(s3_client, file, [_change("a", "1", new_image=item)])
+    with pytest.raises(Exception, match="1 of 4 data files failed"):
+        redshift_manifest_handler._process_data_files(
+            s3_client, TABLE, PROCESSED_DIR, data_files
+        )
+    put_gzipped_lines(s3_client, data_files[3], [_change("a", "1", new_image=item)])
+    # file-1 changed since, and the processed file-2 was removed
+    put_gzipped_lines(s3_client, data_files[1], [_change("b", "1", new_image=item)])
+    s3_client.delete_object(
+        Bucket=Config.S3_BUCKET,
+        Key=f"{TABLE_S3_PREFIX}/AWSDynamoDB/processed/file-2.json.gz",
+    )
+    processed_data_files = []
+    process_data_file = redshift_manifest_handler._process_data_file
+    monkeypatch.setattr(
+        redshift_manifest_handler,
+        "_process_data_file",
+        lambda s3_client, table, processed_dir, file, **kwargs: (
+            processed_data_files.append(file)
+            or process_data_file(s3_client, table, processed_dir, file, **kwargs)
+        ),
+    )
+
+    processed = redshift_manifest_handler._process_data_files(
+        s3_client, TABLE, PROCESSED_DIR, data_files
+    )
+
+    assert sorted(processed_data_files) == data_files[1:]
+    assert [p.split("/")[-1] for files in processed for p in files] == [
+        f"file-{i}.json.gz" for i in range(4)
+    ]
+
+    # a change of settings invalidates every checkpoint
+    processed_data_files.clear()
+    monkeypatch.setattr(Config, "DROP_NOOP_UPDATES", True)
+    redshift_manifest_handler._process_data_files(
+        s3_client, TABLE, PROCESSED_DIR, data_files
+    )
+    assert sorted(processed_data_files) == data_files
+
+
+def test_handle_incremental_writes_projected_rows(s3_client):
+    new_image = {
+        "PK": {"S": "a"},
+        "SK": {"S": "1"},
+        "another_id": {"S": "x"},
+        "not_loaded": {"S": "a very wide attribute"},
+        "some_nested_info": {
+            "M": {"another_decimal": {"N": "1.5"}, "not_loaded": {"N": "2"}}
+        },
+    }
+    manifest_summary_file = put_export(
+        s3_client,
+        TABLE_S3_PREFIX,
+        "export-1",
+        [[_change("a", "1", new_image=new_image)]],
+    )
+
+    redshift_manifest_file = redshift_manifest_handler.handle(
+        s3_client, manifest_summary_file
+    )
+
+    redshift_manifest = s3_utils.read_json_from_s3(
+        s3_client, Config.S3_BUCKET, redshift_manifest_file
+    )
+    assert (
+        redshift_manifest["redshift_table"] == "test_schema.AnotherTargetRedshiftTable"
+    )
+    assert len(redshift_manifest["entries"]) == 1
+    processed_file = redshift_manifest["entries"][0]["url"].split(
+        f"s3://{Config.S3_BUCKET}/"
+    )[1]
+    assert read_gzipped_lines(s3_client, processed_file) == [
+        {
+            "Item": {
+                "PK": {"S": "a"},
+                "SK": {"S": "1"},
+                "another_id": {"S": "x"},
+                "some_nested_info": {"M": {"another_decimal": {"N": "1.5"}}},
+                "is_active": {"BOOL": True},
+            }
+        }
+    ]
+
+
+def test_handle_incremental_keeps_latest_change_per_key(s3_client, monkeypatch):
+    monkeypatch.setattr(Config, "COMPACT_INCREMENTAL_CHANGES", True)
+
+    def item(pk, text):
+        return {"PK": {"S": pk}, "SK": {"S": "1"}, "some_more_text": {"S": text}}
+
+    manifest_summary_file = put_export(
+        s3_client,
+        TABLE_S3_PREFIX,
+        "export-1",
+        [
+            [
+                _change("a", "1", new_image=item("a", "v1"), write_timestamp=1),
+                _change("b", "1", new_image=item("b", "v3"), write_timestamp=5),
+                _change("c", "1", new_image=item("c", "v1"), write_timestamp=1),
+            ],
+            [
+                _change("a", "1", new_image=item("a", "v2"), write_timestamp=3),
+                _change("b", "1", old_image=item("b", "v2"), write_timestamp=2),
+                _change("a", "1", old_image=item("a", "v2"), write_timestamp=3),
+            ],
+        ],
+    )
+
+    redshift_manifest_file = redshift_manifest_handler.handle(
+        s3_client, manifest_summary_file
+    )
+
+    redshift_manifest = s3_utils.read_json_from_s3(
+        s3_client, Config.S3_BUCKET, redshift_manifest_file
+    )
+    rows = [
+        row["Item"]
+        for entry in redshift_manifest["entries"]
+        for row in read_gzipped_lines(
+            s3_client, entry["url"].split(f"s3://{Config.S3_BUCKET}/")[1]
+        )
+    ]
+    assert [
+        (r["PK"]["S"], r["some_more_text"]["S"], r["is_active"]["BOOL"]) for r in rows
+    ] == [("b", "v3", True), ("c", "v1", True), ("a", "v2", False)]
+
+
+@pytest.mark.parametrize("compact", [True, False])
+def test_handle_incremental_drops_noop_updates(s3_client, monkeypatch, compact):
+    monkeypatch.setattr(Config, "DROP_NOOP_UPDATES", True)
+    monkeypatch.setattr(Config, "COMPACT_INCREMENTAL_CHANGES", compact)
+
+    def item(pk, text, ttl):
+        # ttl is not in the jsonpaths, so is never loaded
+        return {
+            "PK": {"S": pk},
+            "SK": {"S": "1"},
+            "some_more_text": {"S": text},
+            "ttl": {"N": str(ttl)},
+        }
+
+    manifest_summary_file = put_export(
+        s3_client,
+        TABLE_S3_PREFIX,
+        "export-1",
+        [
+            [
+                _change("a", "1", item("a", "v1", 1), item("a", "v1", 0), 1),
+                _change("b", "1", item("b", "v2", 0), item("b", "v1", 0), 1),
+                _change("b", "1", item("b", "v2", 1), item("b", "v2", 0), 2),
+                _change("c", "1", item("c", "v1", 0), write_timestamp=1),
+            ]
+        ],
+    )
+
+    redshift_manifest_file = redshift_manifest_handler.handle(
+        s3_client, manifest_summary_file
+    )
+
+    # the ttl bumps are dropped, but not the earlier change to b they follow
+    rows = _read_manifest_rows(s3_client, redshift_manifest_file)
+    assert [(r["PK"]["S"], r["some_more_text"]["S"]) for r in rows] == [
+        ("b", "v2"),
+        ("c", "v1"),
+    ]
+
+
+def _read_manifest_rows(s3_client, redshift_manifest_file):
+    redshift_manifest = s3_utils.read_json_from_s3(
+        s3_client, Config.S3_BUCKET, redshift_manifest_file
+    )
+    return [
+        row["Item"]
+        for entry in redshift_manifest["entries"]
+        for row in read_gzipped_lines(
+            s3_client, entry["url"].split(f"s3://{Config.S3_BUCKET}/")[1]
+        )
+    ]
+
+
+def test_handle_fans_out_shards_and_fans_in(s3_client, monkeypatch):
+    monkeypatch.setattr(Config, "MANIFEST_SHARD_FILES", 2)
+    monkeypatch.setattr(Config, "COMPACT_INCREMENTAL_CHANGES", True)
+
+    def item(pk, text):
+        return {"PK": {"S": pk}, "SK": {"S": "1"}, "some_more_text": {"S": text}}
+
+    manifest_summary_file = put_export(
+        s3_client,
+        TABLE_S3_PREFIX,
+        "export-1",
+        [
+            [_change("a", "1", new_image=item("a", "v1"), write_timestamp=1)],
+            [_change("b", "1", new_image=item("b", "v1"), write_timestamp=1)],
+            [_change("a", "1", new_image=item("a", "v2"), write_timestamp=2)],
+            [_change("b", "1", old_image=item("b", "v1"), write_timestamp=2)],
+            [_change("c", "1", new_image=item("c", "v1"), write_timestamp=1)],
+        ],
+    )
+
+    indexed_files = []
+    get_latest_changes = redshift_manifest_handler._get_latest_changes
+    monkeypatch.setattr(
+        redshift_manifest_handler,
+        "_get_latest_changes",
+        lambda s3_client, data_files, *args: (
+            indexed_files.append(len(data_files))
+            or get_latest_changes(s3_client, data_files, *args)
+        ),
+    )
+
+    assert redshift_manifest_handler.handle(s3_client, manifest_summary_file) is None
+
+    # the shards index their own files, then the fan in writes the shards to process
+    export_dir = os.path.dirname(manifest_summary_file)
+    index_shards_dir = manifest_shards.get_shards_dir(
+        export_dir, manifest_shards.INDEX_PHASE
+    )
+    assert _run_shards(s3_client, index_shards_dir) == [None, None, None]
+    assert indexed_files == [2, 2, 1]
+    fanned_in = _run_shards(s3_client, manifest_shards.get_shards_dir(export_dir))
+
+    # only once all shards are done, and only once
+    assert fanned_in[:2] == [None, None]
+    done_file = manifest_shards.get_shards_dir(export_dir) + "/00002.shard-done.json"
+    assert redshift_manifest_handler.handle_fan_in(s3_client, done_file) is None
+    rows = _read_manifest_rows(s3_client, fanned_in[2])
+    assert sorted(
+        (r["PK"]["S"], r["some_more_text"]["S"], r["is_active"]["BOOL"]) for r in rows
+    ) == [("a", "v2", True), ("b", "v1", False), ("c", "v1", True)]
+
+
+def _run_shards(s3_client, shards_dir):
+    """Process the shards in `shards_dir` one after another, fanning in after each."""
+    shard_files = sorted(
+        obj["Key"]
+        for obj in s3_client.list_objects_v2(
+            Bucket=Config.S3_BUCKET, Prefix=f"{shards_dir}/"
+        )["Contents"]
+        if obj["Key"].endswith(manifest_shards.SHARD_SUFFIX)
+    )
+    assert len(shard_files) == 3
+    fanned_in = []
+    for shard_file in shard_files:
+        done_file = redshift_manifest_handler.handle_shard(s3_client, shard_file)
+        fanned_in.append(redshift_manifest_handler.handle_fan_in(s3_client, done_file))
+    return fanned_in
+
+
+def test_handle_diffs_full_exports(s3_client, monkeypatch):
+    monkeypatch.setattr(Config, "DIFF_FULL_EXPORTS", True)
+    full_export_prefix = "test/dynamodb-export/full-export/AnotherDynamoDbTable"
+
+    def export(export_id, texts):
+        rows = [
+            {"Item": {"PK": {"S": pk}, "SK": {"S": "1"}, "some_more_text": {"S": t}}}
+            for pk, t in texts.items()
+        ]
+        return redshift_manifest_handler.handle(
+            s3_client,
+            put_export(
+                s3_client, full_export_prefix, export_id, [rows], incremental=False
+            ),
+        )
+
+    # the first full export is loaded in full
+    redshift_manifest_file = export("export-1", {"a": "v1", "b": "v1", "c": "v1"})
+    redshift_manifest = s3_utils.read_json_from_s3(
+        s3_client, Config.S3_BUCKET, redshift_manifest_file
+    )
+    assert not redshift_manifest["is_incremental"]
+    assert len(_read_manifest_rows(s3_client, redshift_manifest_file)) == 3
+
+    # not diffed against until applied
+    digest_index.complete(s3_client, Config.S3_BUCKET, redshift_manifest_file)
+    redshift_manifest_file = export("export-2", {"a": "v1", "b": "v2", "d": "v1"})
+
+    redshift_manifest = s3_utils.read_json_from_s3(
+        s3_client, Config.S3_BUCKET, redshift_manifest_file
+    )
+    assert redshift_manifest["is_incremental"]
+    rows = _read_manifest_rows(s3_client, redshift_manifest_file)
+    assert sorted(
+        (r["PK"]["S"], r.get("some_more_text", {}).get("S"), r["is_active"]["BOOL"])
+        for r in rows
+    ) == [("b", "v2", True), ("c", None, False), ("d", "v1", True)]
+
+    # nothing changed, so there is nothing to apply
+    digest_index.complete(s3_client, Config.S3_BUCKET, redshift_manifest_file)
+    assert export("export-3", {"a": "v1", "b": "v2", "d": "v1"}) is None
+    index_path = digest_index.read_current(
+        s3_client, Config.S3_BUCKET, full_export_prefix
+    )
+    assert {
+        key
+        for key, _ in digest_index.iter_index(s3_client, Config.S3_BUCKET, index_path)
+    } == {
+        '{"PK":{"S":"a"},"SK":{"S":"1"}}',
+        '{"PK":{"S":"b"},"SK":{"S":"1"}}',
+        '{"PK":{"S":"d"},"SK":{"S":"1"}}',
+    }
+
+
+def test_digest_index_merges_sorted_runs_and_finds_deletes(s3_client, monkeypatch):
+    monkeypatch.setattr(digest_index, "MERGE_FAN_IN", 2)
+    export_dir = f"{TABLE_S3_PREFIX}/AWSDynamoDB"
+
+    def write_index(export_id, keys, previous_index_path=None):
+        run_paths = []
+        for i in range(0, len(keys), 2):  # two keys a run
+            run_path = f"{export_dir}/{export_id}/digest-runs/{i}.gz"
+            lines = [digest_index.format_line(k, "0" * 16) for k in keys[i : i + 2]]
+            digest_index.write_run(s3_client, Config.S3_BUCKET, run_path, lines)
+            run_paths.append(run_path)
+        deleted = []
+        index = digest_index.write_index(
+            s3_client,
+            Config.S3_BUCKET,
+            TABLE_S3_PREFIX,
+            f"{export_dir}/{export_id}",
+            run_paths,
+            previous_index_path,
+            deleted.append,
+        )
+        return index["index"], deleted
+
+    keys = [f'{{"PK":{{"S":"{i}"}}}}' for i in range(7)]
+    previous_index_path, _ = write_index("export-1", keys)
+    index_path, deleted = write_index(
+        "export-2", keys[2:] + ['{"PK":{"S":"new"}}'], previous_index_path
+    )
+
+    assert sorted(deleted) == keys[:2]
+    lookup = digest_index.DigestLookup(s3_client, Config.S3_BUCKET, index_path)
+    assert len(lookup) == 6
+    assert lookup.contains('{"PK":{"S":"new"}}', "0" * 16)
+    assert not lookup.contains(keys[0], "0" * 16)
+    assert not lookup.contains(keys[2], "1" * 16)
+
+
+def test_handle_records_each_export_once_processed(s3_client, monkeypatch):
+    monkeypatch.setattr(Config, "ADAPTIVE_EXPORT_SCHEDULE", True)
+    item = {"PK": {"S": "a"}, "SK": {"S": "1"}}
+    manifest_summary_file = put_export(
+        s3_client, TABLE_S3_PREFIX, "export-1", [[_change("a", "1", new_image=item)]]
+    )
+    manifest_summary = s3_utils.read_json_from_s3(
+        s3_client, Config.S3_BUCKET, manifest_summary_file
+    )
+    manifest_summary["exportFromTime"] = "2024-01-03T11:00:00.000Z"
+    manifest_summary["exportToTime"] = "2024-01-03T11:30:00.000Z"
+    s3_client.put_object(
+        Bucket=Config.S3_BUCKET,
+        Key=manifest_summary_file,
+        Body=json.dumps(manifest_summary),
+    )
+    recorded = []
+    monkeypatch.setattr(
+        redshift_manifest_handler.export_schedule,
+        "record_export",
+        lambda *args: recorded.append(args) or {"interval_seconds": 900},
+    )
+    process = redshift_manifest_handler._process
+
+    def fail(*args):
+        raise ValueError("processing failed")
+
+    # not recorded when processing fails, only once it succeeds
+    monkeypatch.setattr(redshift_manifest_handler, "_process", fail)
+    with pytest.raises(ValueError):
+        redshift_manifest_handler.handle(s3_client, manifest_summary_file)
+    assert recorded == []
+
+    monkeypatch.setattr(redshift_manifest_handler, "_process", process)
+    redshift_manifest_handler.handle(s3_client, manifest_summary_file)
+    assert [args[3]["exportToTime"] for args in recorded] == [
+        "2024-01-03T11:30:00.000Z"
+    ]
+
+
+def test_handle_coalesces_backlog_exports(s3_client, monkeypatch):
+    monkeypatch.setattr(Config, "COALESCE_BACKLOG_EXPORTS", True)
+    monkeypatch.setattr(Config, "COMPACT_INCREMENTAL_CHANGES", True)
+    export_groups.write_group(
+        s3_client, Config.S3_BUCKET, TABLE_S3_PREFIX, ["export-1", "export-2"]
+    )
+
+    def item(text):
+        return {"PK": {"S": "a"}, "SK": {"S": "1"}, "some_more_text": {"S": text}}
+
+    # the newer export completes first, and waits for the older one
+    newer = put_export(
+        s3_client,
+        TABLE_S3_PREFIX,
+        "export-2",
+        [[_change("a", "1", new_image=item("new"), write_timestamp=2)]],
+    )
+    assert redshift_manifest_handler.handle(s3_client, newer) is None
+
+    older = put_export(
+        s3_client,
+        TABLE_S3_PREFIX,
+        "export-1",
+        [[_change("a", "1", new_image=item("old"), write_timestamp=1)]],
+    )
+    redshift_manifest_file = redshift_manifest_handler.handle(s3_client, older)
+
+    assert redshift_manifest_file == (
+        f"{TABLE_S3_PREFIX}/AWSDynamoDB/export-2/redshift.manifest"
+    )
+    rows = _read_manifest_rows(s3_client, redshift_manifest_file)
+    assert [r["some_more_text"]["S"] for r in rows] == ["new"]
+    assert (
+        export_groups.list_pending_groups(s3_client, Config.S3_BUCKET, TABLE_S3_PREFIX)
+        == []
+    )
+
+
+def test_handle_rechunks_into_slice_aligned_files(s3_client, monkeypatch):
+    monkeypatch.setattr(Config, "REDSHIFT_SLICE_COUNT", 4)
+    monkeypatch.setattr(Config, "PROCESSED_FILE_TARGET_BYTES", 2000)
+
+    def item(pk):
+        return {"PK": {"S": pk}, "SK": {"S": "1"}, "some_more_text": {"S": "x" * 20}}
+
+    files = [
+        [_change(f"{f}-{i}", "1", new_image=item(f"{f}-{i}")) for i in range(n)]
+        for f, n in enumerate([3, 70, 5, 30])
+    ]
+    manifest_summary_file = put_export(s3_client, TABLE_S3_PREFIX, "export-1", files)
+
+    redshift_manifest_file = redshift_manifest_handler.handle(
+        s3_client, manifest_summary_file
+    )
+
+    redshift_manifest = s3_utils.read_json_from_s3(
+        s3_client, Config.S3_BUCKET, redshift_manifest_file
+    )
+    urls = [entry["url"] for entry in redshift_manifest["entries"]]
+    assert len(urls) % 4 == 0
+    assert all("/AWSDynamoDB/processed/export-1/part-" in url for url in urls)
+    rows = _read_manifest_rows(s3_client, redshift_manifest_file)
+    assert sorted(r["PK"]["S"] for r in rows) == sorted(
+        f"{f}-{i}" for f, n in enumerate([3, 70, 5, 30]) for i in range(n)
+    )
+
+
+def test_handle_parquet_output(s3_client, monkeypatch):
+    pq = pytest.importorskip("pyarrow.parquet")
+    monkeypatch.setattr(Config, "OUTPUT_FORMAT", "parquet")
+    new_image = {
+        "PK": {"S": "a"},
+        "SK": {"S": "1"},
+        "order_confirmed": {"BOOL": True},
+        "some_nested_info": {"M": {"another_decimal": {"N": "1.5"}}},
+    }
+    manifest_summary_file = put_export(
+        s3_client,
+        TABLE_S3_PREFIX,
+        "export-1",
+        [[_change("a", "1", new_image=new_image)]],
+    )
+
+    redshift_manifest_file = redshift_manifest_handler.handle(
+        s3_client, manifest_summary_file
+    )
+
+    redshift_manifest = s3_utils.read_json_from_s3(
+        s3_client, Config.S3_BUCKET, redshift_manifest_file
+    )
+    assert redshift_manifest["output_format"] == "parquet"
+    [entry] = redshift_manifest["entries"]
+    key = entry["url"].split(f"s3://{Config.S3_BUCKET}/")[1]
+    assert key.endswith(".parquet")
+    body = s3_client.get_object(Bucket=Config.S3_BUCKET, Key=key)["Body"].read()
+    assert entry["meta"]["content_length"] == len(body)
+    assert pq.read_table(io.BytesIO(body)).to_pylist() == [
+        {
+            "pk": "a",
+            "sk": "1",
+            "some_more_text": None,
+            "another_id": None,
+            "order_confirmed": True,
+            "some_nested_info_another_decimal": Decimal("1.50"),
+            "is_active": True,
+        }
+    ]
+
+
+def test_handle_shapes_full_exports_like_the_target_to_replace_it(
+    s3_client, monkeypatch
+):
+    monkeypatch.setattr(Config, "FULL_REFRESH_STRATEGY", "swap")
+    monkeypatch.setattr(Config, "DIFF_FULL_EXPORTS", True)  # so the export is processed
+    item = {"PK": {"S": "a"}, "SK": {"S": "1"}, "some_more_text": {"S": "v1"}}
+    manifest_summary_file = put_export(
+        s3_client,
+        "test/dynamodb-export/full-export/AnotherDynamoDbTable",
+        "export-1",
+        [[{"Item": item}]],
+        incremental=False,
+    )
+
+    redshift_manifest_file = redshift_manifest_handler.handle(
+        s3_client, manifest_summary_file
+    )
+
+    redshift_manifest = s3_utils.read_json_from_s3(
+        s3_client, Config.S3_BUCKET, redshift_manifest_file
+    )
+    assert not redshift_manifest["is_incremental"]
+    assert not any("is_active" in p for p in redshift_manifest["jsonpaths"])
+    assert _read_manifest_rows(s3_client, redshift_manifest_file) == [item]
+    assert redshift_manifest["deletes_manifest"] is None
+
+
+@pytest.mark.parametrize("slice_count", [0, 2])
+def test_handle_splits_deletes_from_upserts(s3_client, monkeypatch, slice_count):
+    monkeypatch.setattr(Config, "SPLIT_INCREMENTAL_DELETES", True)
+    monkeypatch.setattr(Config, "REDSHIFT_SLICE_COUNT", slice_count)
+
+    def item(pk, text):
+        return {"PK": {"S": pk}, "SK": {"S": "1"}, "some_more_text": {"S": text}}
+
+    manifest_summary_file = put_export(
+        s3_client,
+        TABLE_S3_PREFIX,
+        "export-1",
+        [
+            [
+                _change("a", "1", new_image=item("a", "new")),
+                _change("b", "1", old_image=item("b", "deleted")),
+            ]
+        ],
+    )
+
+    redshift_manifest_file = redshift_manifest_handler.handle(
+        s3_client, manifest_summary_file
+    )
+
+    redshift_manifest = s3_utils.read_json_from_s3(
+        s3_client, Config.S3_BUCKET, redshift_manifest_file
+    )
+    assert redshift_manifest["split_deletes"]
+    assert not any("is_active" in p for p in redshift_manifest["jsonpaths"])
+    assert _read_manifest_rows(s3_client, redshift_manifest_file) == [item("a", "new")]
+
+    deletes_manifest_file = redshift_manifest["deletes_manifest"]
+    deletes_manifest = s3_utils.read_json_from_s3(
+        s3_client, Config.S3_BUCKET, deletes_manifest_file
+    )
+    assert deletes_manifest["jsonpaths"] == [
+        "$['Item']['PK']['S']",
+        "$['Item']['SK']['S']",
+    ]
+    assert _read_manifest_rows(s3_client, deletes_manifest_file) == [
+        {"PK": {"S": "b"}, "SK": {"S": "1"}}
+    ]
+
+
+def test_ranged_reads_reassemble_the_object(s3_client):
+    key = "test/ranged.json.gz"
+    rows = [{"n": i, "pad": os.urandom(16).hex()} for i in range(2_000)]
+    put_gzipped_lines(s3_client, key, rows)
+    size = s3_client.head_object(Bucket=Config.S3_BUCKET, Key=key)["ContentLength"]
+    stats = {"bytes_read": 0}
+
+    read = list(
+        s3_utils.iter_lines_from_s3(
+            s3_client,
+            Config.S3_BUCKET,
+            key,
+            stats,
+            part_size=1024,
+            max_concurrency=4,
+        )
+    )
+
+    assert size > 4 * 1024  # more parts than are read at once
+    assert [json.loads(line) for line in read] == rows
+    assert stats["bytes_read"] == size
+
+
+@pytest.mark.parametrize("body", [b"", b'{"a": 1}'])
+def test_ranged_reads_of_small_objects(s3_client, body):
+    key = "test/small.json"
+    s3_client.put_object(Bucket=Config.S3_BUCKET, Key=key, Body=body)
+
+    contents = s3_utils.read_contents_from_s3(
+        s3_client, Config.S3_BUCKET, key, part_size=1024, max_concurrency=4
+    )
+
+    assert contents == body.decode("utf-8")
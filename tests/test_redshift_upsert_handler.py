@@ -0,0 +1,570 @@
+import boto3
+import json
+import pytest
+from botocore.stub import ANY, Stubber
+from datetime import datetime, timedelta
+from src.runtime.chalicelib import (
+    digest_index,
+    export_ledger,
+    redshift_upsert_handler,
+    s3_utils,
+)
+from src.runtime.chalicelib.config import Config
+from src.runtime.chalicelib.exceptions import RedshiftQueryException
+
+TABLE = "AnotherDynamoDbTable"
+TABLE_S3_PREFIX = f"test/dynamodb-export/incremental-export/{TABLE}"
+CREDENTIALS = {"aws_access_key_id": "key", "aws_secret_access_key": "secret"}
+
+
+class _FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self._rows = []
+
+    def execute(self, sql, params=None):
+        self.conn.executed.append(
+            sql if not self.conn.autocommit else f"AUTOCOMMIT {sql}"
+        )
+        if sql.startswith("SELECT export_arn"):
+            self._rows = [(arn,) for arn in self.conn.ledger]
+        elif "FROM pg_depend" in sql:
+            self._rows = [(view,) for view in self.conn.views]
+        elif sql in self.conn.failing:
+            raise RedshiftQueryException(f"failed: {sql}")
+        elif "INSERT INTO test_schema.dynamodb_export_ledger" in sql:
+            self.conn.pending.append(params[1])
+
+    def fetchall(self):
+        return self._rows
+
+
+class _FakeConnection:
+    """Records the sql executed, and keeps the redshift ledger table, committed or not."""
+
+    def __init__(self):
+        self.executed = []
+        self.ledger = []
+        self.pending = []
+        self.commits = 0
+        self.autocommit = False
+        self.views = []
+        self.failing = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def cursor(self):
+        return _FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+        self.ledger += self.pending
+        self.pending = []
+
+    def rollback(self):
+        self.pending = []
+
+    def copied_manifests(self):
+        return [
+            sql.split("FROM 's3://my-test-bucket/")[1].split("'")[0]
+            for sql in self.executed
+            if sql.strip().startswith("COPY")
+        ]
+
+
+def _export_arn(export_id):
+    return f"arn:aws:dynamodb:us-east-1:123456789012:table/{TABLE}/export/{export_id}"
+
+
+def _put_ready_export(s3_client, export_id):
+    redshift_manifest_file = _put_incremental_manifest(s3_client, export_id)
+    assert export_ledger.record_ready(
+        s3_client,
+        Config.S3_BUCKET,
+        TABLE_S3_PREFIX,
+        _export_arn(export_id),
+        redshift_manifest_file,
+    )
+    return redshift_manifest_file
+
+
+def _put_incremental_manifest(s3_client, export_id):
+    redshift_manifest_file = (
+        f"{TABLE_S3_PREFIX}/AWSDynamoDB/{export_id}/redshift.manifest"
+    )
+    redshift_manifest = {
+        "entries": [{"url": "s3://my-test-bucket/data.json.gz", "mandatory": True}],
+        "dynamodb_table_name": TABLE,
+        "is_incremental": True,
+        "redshift_table": "test_schema.another_table",
+        "partition_key": "pk",
+        "sort_key": "sk",
+        "format_time": "timeformat 'auto'",
+        "export_arns": [_export_arn(export_id)],
+    }
+    s3_client.put_object(
+        Bucket=Config.S3_BUCKET,
+        Key=redshift_manifest_file,
+        Body=json.dumps(redshift_manifest),
+    )
+    return redshift_manifest_file
+
+
+def test_ordered_apply_holds_later_exports(s3_client, monkeypatch):
+    monkeypatch.setattr(Config, "ORDERED_APPLY", True)
+    start = datetime(2024, 1, 1)
+    for i, export_id in enumerate(["export-1", "export-2"]):
+        export_ledger.record_submitted(
+            s3_client,
+            Config.S3_BUCKET,
+            TABLE_S3_PREFIX,
+            _export_arn(export_id),
+            start + timedelta(days=i),
+            start + timedelta(days=i + 1),
+        )
+    conn = _FakeConnection()
+
+    def handle(redshift_manifest_file):
+        redshift_upsert_handler.handle(
+            s3_client, CREDENTIALS, lambda _: conn, redshift_manifest_file
+        )
+
+    # the later export lands first, and is held
+    manifest_2 = _put_ready_export(s3_client, "export-2")
+    handle(manifest_2)
+    assert conn.copied_manifests() == []
+    assert conn.ledger == []
+
+    # the earlier export lands, and both are applied in order
+    manifest_1 = _put_ready_export(s3_client, "export-1")
+    handle(manifest_1)
+    assert conn.copied_manifests() == [manifest_1, manifest_2]
+    assert conn.ledger == [_export_arn("export-1"), _export_arn("export-2")]
+
+    # replaying a manifest applies nothing, and clears the applied exports from s3
+    handle(manifest_2)
+    assert conn.copied_manifests() == [manifest_1, manifest_2]
+    assert (
+        export_ledger.list_entries(s3_client, Config.S3_BUCKET, TABLE_S3_PREFIX) == []
+    )
+
+
+def test_exports_not_in_ledger_are_applied_directly(s3_client, monkeypatch):
+    monkeypatch.setattr(Config, "ORDERED_APPLY", True)
+    redshift_manifest_file = f"{TABLE_S3_PREFIX}/AWSDynamoDB/export-0/redshift.manifest"
+    s3_client.put_object(
+        Bucket=Config.S3_BUCKET,
+        Key=redshift_manifest_file,
+        Body=json.dumps(
+            {
+                "entries": [{"url": "s3://my-test-bucket/data.json.gz"}],
+                "dynamodb_table_name": TABLE,
+                "is_incremental": True,
+                "redshift_table": "test_schema.another_table",
+                "partition_key": "pk",
+                "format_time": "timeformat 'auto'",
+                "export_arns": [_export_arn("export-0")],
+            }
+        ),
+    )
+    conn = _FakeConnection()
+
+    redshift_upsert_handler.handle(
+        s3_client, CREDENTIALS, lambda _: conn, redshift_manifest_file
+    )
+
+    assert conn.copied_manifests() == [redshift_manifest_file]
+    # the temp table can't be schema qualified
+    assert any("CREATE TABLE #another_table_staging" in sql for sql in conn.executed)
+
+
+def _put_full_export_manifest(s3_client):
+    redshift_manifest_file = "test/dynamodb-export/full-export/SomeDynamoDbTable/AWSDynamoDB/export-0/redshift.manifest"
+    s3_client.put_object(
+        Bucket=Config.S3_BUCKET,
+        Key=redshift_manifest_file,
+        Body=json.dumps(
+            {
+                "entries": [{"url": "s3://my-test-bucket/data.json.gz"}],
+                "dynamodb_table_name": "SomeDynamoDbTable",
+                "is_incremental": False,
+                "redshift_table": "test_schema.some_table",
+                "partition_key": "pk",
+                "format_time": "timeformat 'auto'",
+            }
+        ),
+    )
+    return redshift_manifest_file
+
+
+def _statements(conn):
+    return [" ".join(sql.split()) for sql in conn.executed]
+
+
+def test_full_refresh_swap(s3_client, monkeypatch):
+    monkeypatch.setattr(Config, "FULL_REFRESH_STRATEGY", "swap")
+    redshift_manifest_file = _put_full_export_manifest(s3_client)
+    conn = _FakeConnection()
+
+    redshift_upsert_handler.handle(
+        s3_client, CREDENTIALS, lambda _: conn, redshift_manifest_file
+    )
+
+    statements = _statements(conn)
+    assert conn.copied_manifests() == [redshift_manifest_file]
+    assert statements[1] == (
+        "DROP TABLE IF EXISTS test_schema.some_table_staging; "
+        "CREATE TABLE test_schema.some_table_staging (LIKE test_schema.some_table);"
+    )
+    assert statements[2].startswith("COPY test_schema.some_table_staging FROM")
+    assert (
+        "ALTER TABLE test_schema.some_table RENAME TO some_table_previous; "
+        "ALTER TABLE test_schema.some_table_staging RENAME TO some_table; "
+        "DROP TABLE test_schema.some_table_previous;"
+    ) in statements[-1]
+    assert not any("TRUNCATE" in sql or "INSERT" in sql for sql in statements)
+
+
+def test_full_refresh_swap_fails_before_loading_with_bound_views(
+    s3_client, monkeypatch
+):
+    monkeypatch.setattr(Config, "FULL_REFRESH_STRATEGY", "swap")
+    redshift_manifest_file = _put_full_export_manifest(s3_client)
+    conn = _FakeConnection()
+    conn.views = ["some_view"]
+
+    with pytest.raises(ValueError, match="some_view"):
+        redshift_upsert_handler.handle(
+            s3_client, CREDENTIALS, lambda _: conn, redshift_manifest_file
+        )
+    assert conn.copied_manifests() == []
+
+
+def test_full_refresh_append(s3_client, monkeypatch):
+    monkeypatch.setattr(Config, "FULL_REFRESH_STRATEGY", "append")
+    redshift_manifest_file = _put_full_export_manifest(s3_client)
+    conn = _FakeConnection()
+
+    redshift_upsert_handler.handle(
+        s3_client, CREDENTIALS, lambda _: conn, redshift_manifest_file
+    )
+
+    # ALTER TABLE APPEND can't run in a transaction
+    assert _statements(conn)[-4:] == [
+        "AUTOCOMMIT ALTER TABLE test_schema.some_table_previous APPEND FROM test_schema.some_table;",
+        "AUTOCOMMIT ALTER TABLE test_schema.some_table APPEND FROM test_schema.some_table_staging;",
+        "AUTOCOMMIT DROP TABLE test_schema.some_table_previous;",
+        "AUTOCOMMIT DROP TABLE test_schema.some_table_staging;",
+    ]
+    assert not any("TRUNCATE" in sql or "is_active" in sql for sql in conn.executed)
+    assert not conn.autocommit
+
+
+def test_full_refresh_append_restores_rows_when_it_fails(s3_client, monkeypatch):
+    monkeypatch.setattr(Config, "FULL_REFRESH_STRATEGY", "append")
+    redshift_manifest_file = _put_full_export_manifest(s3_client)
+    conn = _FakeConnection()
+    conn.failing = [
+        "ALTER TABLE test_schema.some_table APPEND FROM test_schema.some_table_staging;"
+    ]
+
+    with pytest.raises(RedshiftQueryException):
+        redshift_upsert_handler.handle(
+            s3_client, CREDENTIALS, lambda _: conn, redshift_manifest_file
+        )
+    assert _statements(conn)[-1] == (
+        "AUTOCOMMIT ALTER TABLE test_schema.some_table APPEND FROM test_schema.some_table_previous;"
+    )
+    assert not conn.autocommit
+
+
+def test_full_refresh_append_logs_where_the_rows_are_when_restoring_fails(
+    s3_client, monkeypatch
+):
+    monkeypatch.setattr(Config, "FULL_REFRESH_STRATEGY", "append")
+    errors = []
+    monkeypatch.setattr(Config.logger, "error", errors.append)
+    redshift_manifest_file = _put_full_export_manifest(s3_client)
+    conn = _FakeConnection()
+    conn.failing = [
+        "ALTER TABLE test_schema.some_table APPEND FROM test_schema.some_table_staging;",
+        "ALTER TABLE test_schema.some_table APPEND FROM test_schema.some_table_previous;",
+    ]
+
+    with pytest.raises(RedshiftQueryException, match="some_table_staging"):
+        redshift_upsert_handler.handle(
+            s3_client, CREDENTIALS, lambda _: conn, redshift_manifest_file
+        )
+    assert "its rows are in test_schema.some_table_previous" in errors[-1]
+    assert not any(
+        "DROP TABLE test_schema.some_table_previous" in s for s in conn.executed
+    )
+    assert not conn.autocommit
+
+
+def test_digest_index_is_promoted_once_applied(s3_client):
+    redshift_manifest_file = _put_incremental_manifest(s3_client, "export-1")
+    redshift_manifest = json.loads(
+        s3_client.get_object(Bucket=Config.S3_BUCKET, Key=redshift_manifest_file)[
+            "Body"
+        ].read()
+    )
+    run_path = f"{TABLE_S3_PREFIX}/AWSDynamoDB/export-1/digest-runs/file-0.json.gz"
+    digest_index.write_run(
+        s3_client,
+        Config.S3_BUCKET,
+        run_path,
+        [digest_index.format_line('{"PK":{"S":"a"}}', "0123456789abcdef")],
+    )
+    index = digest_index.write_index(
+        s3_client,
+        Config.S3_BUCKET,
+        TABLE_S3_PREFIX,
+        f"{TABLE_S3_PREFIX}/AWSDynamoDB/export-1",
+        [run_path],
+    )
+    s3_client.put_object(
+        Bucket=Config.S3_BUCKET,
+        Key=redshift_manifest_file,
+        Body=json.dumps({**redshift_manifest, "digest_index": index}),
+    )
+    failing_conn = _FakeConnection()
+    failing_conn.commit = lambda: 1 / 0
+
+    with pytest.raises(ZeroDivisionError):
+        redshift_upsert_handler.handle(
+            s3_client, CREDENTIALS, lambda _: failing_conn, redshift_manifest_file
+        )
+    assert (
+        digest_index.read_current(s3_client, Config.S3_BUCKET, TABLE_S3_PREFIX) is None
+    )
+
+    redshift_upsert_handler.handle(
+        s3_client, CREDENTIALS, lambda _: _FakeConnection(), redshift_manifest_file
+    )
+    index_path = digest_index.read_current(s3_client, Config.S3_BUCKET, TABLE_S3_PREFIX)
+    assert list(digest_index.iter_index(s3_client, Config.S3_BUCKET, index_path)) == [
+        ('{"PK":{"S":"a"}}', "0123456789abcdef")
+    ]
+
+
+def test_split_manifest_deletes_and_merges_without_copying(s3_client):
+    redshift_manifest_file = f"{TABLE_S3_PREFIX}/AWSDynamoDB/export-0/redshift.manifest"
+    deletes_manifest_file = (
+        f"{TABLE_S3_PREFIX}/AWSDynamoDB/export-0/redshift-deletes.manifest"
+    )
+    s3_client.put_object(
+        Bucket=Config.S3_BUCKET,
+        Key=redshift_manifest_file,
+        Body=json.dumps(
+            {
+                "entries": [{"url": "s3://my-test-bucket/data.json.gz"}],
+                "dynamodb_table_name": TABLE,
+                "is_incremental": True,
+                "redshift_table": "test_schema.another_table",
+                "partition_key": "pk",
+                "sort_key": "sk",
+                "format_time": "timeformat 'auto'",
+                "split_deletes": True,
+                "deletes_manifest": deletes_manifest_file,
+            }
+        ),
+    )
+    conn = _FakeConnection()
+
+    redshift_upsert_handler.handle(
+        s3_client, CREDENTIALS, lambda _: conn, redshift_manifest_file
+    )
+
+    statements = _statements(conn)
+    assert conn.copied_manifests() == [deletes_manifest_file, redshift_manifest_file]
+    assert statements[1] == (
+        "CREATE TABLE #another_table_deletes AS SELECT pk, sk FROM test_schema.another_table LIMIT 0;"
+    )
+    assert statements[2].startswith("COPY #another_table_deletes FROM")
+    assert statements[3] == (
+        "DELETE FROM test_schema.another_table USING #another_table_deletes "
+        "WHERE test_schema.another_table.pk = #another_table_deletes.pk "
+        "AND test_schema.another_table.sk = #another_table_deletes.sk;"
+    )
+    assert statements[7].startswith("COPY #another_table_staging FROM")
+    assert statements[8].startswith(
+        "MERGE INTO test_schema.another_table USING #another_table_staging"
+    )
+    assert not any("is_active" in sql or "SELECT *" in sql for sql in statements)
+    assert conn.commits == 1
+
+
+def test_batch_applies_pending_upserts_in_one_session(s3_client):
+    manifests = [
+        _put_full_export_manifest(s3_client),
+        f"{TABLE_S3_PREFIX}/AWSDynamoDB/missing/redshift.manifest",
+        _put_incremental_manifest(s3_client, "export-1"),
+    ]
+    for redshift_manifest_file in manifests + manifests[:1]:
+        redshift_upsert_handler.enqueue(s3_client, redshift_manifest_file)
+    sessions = []
+
+    def get_connection(_):
+        sessions.append(_FakeConnection())
+        return sessions[-1]
+
+    with pytest.raises(Exception, match="1 of 3 pending upserts failed"):
+        redshift_upsert_handler.handle_batch(s3_client, CREDENTIALS, get_connection)
+
+    assert len(sessions) == 1
+    assert sessions[0].copied_manifests() == [manifests[0], manifests[2]]
+    assert sessions[0].commits == 2
+    # the failed manifest is still pending
+    assert [f for _, f in redshift_upsert_handler._list_pending(s3_client)] == [
+        manifests[1]
+    ]
+
+
+def test_batch_holds_later_upserts_to_a_table_that_failed(s3_client):
+    failing_manifest_file = _put_incremental_manifest(s3_client, "export-1")
+    redshift_manifest = json.loads(
+        s3_client.get_object(Bucket=Config.S3_BUCKET, Key=failing_manifest_file)[
+            "Body"
+        ].read()
+    )
+    del redshift_manifest["partition_key"]  # fails to build the upsert
+    s3_client.put_object(
+        Bucket=Config.S3_BUCKET,
+        Key=failing_manifest_file,
+        Body=json.dumps(redshift_manifest),
+    )
+    manifests = [
+        failing_manifest_file,
+        _put_incremental_manifest(s3_client, "export-2"),
+        _put_full_export_manifest(s3_client),
+    ]
+    for redshift_manifest_file in manifests:
+        redshift_upsert_handler.enqueue(s3_client, redshift_manifest_file)
+    conn = _FakeConnection()
+
+    with pytest.raises(Exception, match="1 of 3 pending upserts failed"):
+        redshift_upsert_handler.handle_batch(s3_client, CREDENTIALS, lambda _: conn)
+
+    # other tables are still applied, but not the later upsert to the same table
+    assert conn.copied_manifests() == [manifests[2]]
+    assert [f for _, f in redshift_upsert_handler._list_pending(s3_client)] == [
+        manifests[0],
+        manifests[1],
+    ]
+
+
+def test_batch_group_commit_is_all_or_nothing(s3_client, monkeypatch):
+    monkeypatch.setattr(Config, "UPSERT_BATCH_COMMIT", "group")
+    manifests = [
+        _put_full_export_manifest(s3_client),
+        f"{TABLE_S3_PREFIX}/AWSDynamoDB/missing/redshift.manifest",
+    ]
+    for redshift_manifest_file in manifests:
+        redshift_upsert_handler.enqueue(s3_client, redshift_manifest_file)
+    conn = _FakeConnection()
+
+    with pytest.raises(Exception):
+        redshift_upsert_handler.handle_batch(s3_client, CREDENTIALS, lambda _: conn)
+    assert conn.commits == 0
+    assert len(redshift_upsert_handler._list_pending(s3_client)) == 2
+
+    redshift_upsert_handler._remove_pending(
+        s3_client, [redshift_upsert_handler._list_pending(s3_client)[1][0]]
+    )
+    assert redshift_upsert_handler.handle_batch(
+        s3_client, CREDENTIALS, lambda _: conn
+    ) == ["test_schema.some_table"]
+    assert conn.commits == 1
+    assert redshift_upsert_handler._list_pending(s3_client) == []
+
+
+def test_data_api_submits_the_same_statements_and_tracks_them(s3_client, monkeypatch):
+    monkeypatch.setattr(Config, "REDSHIFT_CLUSTER", "test-cluster")
+    monkeypatch.setattr(Config, "REDSHIFT_DATABASE", "test-database")
+    monkeypatch.setattr(Config, "REDSHIFT_IAM_ROLE", "arn:aws:iam::123:role/copy")
+    redshift_manifest_file = _put_incremental_manifest(s3_client, "export-1")
+    failing_manifest_file = _put_incremental_manifest(s3_client, "export-2")
+    conn = _FakeConnection()
+    redshift_upsert_handler.handle(
+        s3_client, CREDENTIALS, lambda _: conn, redshift_manifest_file
+    )
+    redshift_data_client = boto3.client("redshift-data", region_name="us-east-1")
+
+    with Stubber(redshift_data_client) as stub:
+        stub.add_response(
+            "batch_execute_statement",
+            {"Id": "statement-1"},
+            {
+                "ClusterIdentifier": ANY,
+                "Database": ANY,
+                "SecretArn": ANY,
+                "Sqls": conn.executed,
+                "StatementName": "redshift_upsert test_schema.another_table",
+                "WithEvent": True,
+            },
+        )
+        stub.add_response("batch_execute_statement", {"Id": "statement-2"})
+        for manifest_file in (redshift_manifest_file, failing_manifest_file):
+            redshift_upsert_handler.handle_async(
+                s3_client,
+                redshift_data_client,
+                CREDENTIALS,
+                lambda _: pytest.fail("should not connect"),
+                manifest_file,
+            )
+
+        stub.add_response(
+            "describe_statement", {"Id": "statement-1", "Status": "STARTED"}
+        )
+        stub.add_response(
+            "describe_statement", {"Id": "statement-2", "Status": "STARTED"}
+        )
+        assert (
+            redshift_upsert_handler.check_statements(s3_client, redshift_data_client)
+            == []
+        )
+
+        stub.add_response(
+            "describe_statement", {"Id": "statement-1", "Status": "FINISHED"}
+        )
+        stub.add_response(
+            "describe_statement",
+            {"Id": "statement-2", "Status": "FAILED", "Error": "column does not exist"},
+        )
+        with pytest.raises(RedshiftQueryException, match="1 of 2 submitted upserts"):
+            redshift_upsert_handler.check_statements(s3_client, redshift_data_client)
+        stub.assert_no_pending_responses()
+
+    # both are no longer tracked
+    assert (
+        redshift_upsert_handler.check_statements(s3_client, redshift_data_client) == []
+    )
+    # the failed one is queued for retry, and kept
+    assert [f for _, f in redshift_upsert_handler._list_pending(s3_client)] == [
+        failing_manifest_file
+    ]
+    failed = s3_utils.read_json_from_s3(
+        s3_client,
+        Config.S3_BUCKET,
+        f"{redshift_upsert_handler._get_statements_dir()}-failed/statement-2.json",
+    )
+    assert failed["redshift_manifest"] == failing_manifest_file
+    assert failed["error"] == "column does not exist"
+
+
+def test_data_api_refuses_access_keys_in_the_copy(s3_client):
+    redshift_manifest_file = _put_incremental_manifest(s3_client, "export-1")
+
+    with pytest.raises(ValueError, match="REDSHIFT_IAM_ROLE"):
+        redshift_upsert_handler.handle_async(
+            s3_client,
+            None,  # nothing is submitted
+            CREDENTIALS,
+            lambda _: pytest.fail("should not connect"),
+            redshift_manifest_file,
+        )
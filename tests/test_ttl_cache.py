@@ -0,0 +1,48 @@
+from src.runtime.chalicelib import ttl_cache
+from src.runtime.chalicelib.ttl_cache import TTLCache
+
+
+def test_entries_expire_and_count_hits_and_misses(monkeypatch):
+    now = [0]
+    monkeypatch.setattr(ttl_cache.time, "monotonic", lambda: now[0])
+    cache = TTLCache(ttl_seconds=10)
+    loads = []
+
+    def load():
+        loads.append(now[0])
+        return f"value-{len(loads)}"
+
+    assert cache.get_or_load("key", load) == "value-1"
+    now[0] = 9
+    assert cache.get_or_load("key", load) == "value-1"
+    now[0] = 10
+    assert cache.get_or_load("key", load) == "value-2"
+
+    # per entry TTL
+    cache.set("short", "value", ttl_seconds=1)
+    now[0] = 11
+    assert cache.get("short") is None
+
+    assert loads == [0, 10]
+    assert (cache.hits, cache.misses) == (1, 3)
+    # counted once each, when published per invocation
+    assert cache.take_counts() == (1, 3)
+    cache.get("key")
+    assert cache.take_counts() == (1, 0)
+
+
+def test_invalidate():
+    cache = TTLCache(ttl_seconds=10)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.invalidate("a")
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+    cache.invalidate()
+    assert cache.stats()["size"] == 0
+
+
+def test_zero_ttl_disables_cache():
+    cache = TTLCache(ttl_seconds=0)
+    cache.set("a", 1)
+    assert cache.get("a") is None
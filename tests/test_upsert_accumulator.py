@@ -0,0 +1,205 @@
+import json
+import pytest
+from src.runtime.chalicelib import s3_utils, upsert_accumulator
+from src.runtime.chalicelib.config import Config
+from tests.conftest import put_gzipped_lines, read_gzipped_lines
+
+TABLE = "AnotherDynamoDbTable"
+TABLE_S3_PREFIX = f"test/dynamodb-export/incremental-export/{TABLE}"
+
+
+def _item(pk, value=None, is_active=True):
+    item = {"pk": {"S": pk}, "is_active": {"BOOL": is_active}}
+    if value is not None:
+        item["value"] = {"S": value}
+    return item
+
+
+def _put_manifest(s3_client, export_id, items, deletes=None):
+    """Write a processed incremental export and its redshift manifest, split if `deletes` is given."""
+    export_dir = f"{TABLE_S3_PREFIX}/AWSDynamoDB/{export_id}"
+    put_gzipped_lines(
+        s3_client, f"{export_dir}/processed/data.json.gz", [{"Item": i} for i in items]
+    )
+    redshift_manifest = {
+        "entries": [
+            {"url": f"s3://my-test-bucket/{export_dir}/processed/data.json.gz"}
+        ],
+        "dynamodb_table_name": TABLE,
+        "is_incremental": True,
+        "redshift_table": "test_schema.another_table",
+        "partition_key": "pk",
+        "format_time": "timeformat 'auto'",
+        "export_arns": [export_id],
+        "item_count": len(items) + len(deletes or []),
+        "content_length": 100,
+    }
+    if deletes is not None:
+        deletes_file = f"{export_dir}/processed/deletes/data.json.gz"
+        put_gzipped_lines(s3_client, deletes_file, [{"Item": d} for d in deletes])
+        redshift_manifest["split_deletes"] = True
+        redshift_manifest[
+            "deletes_manifest"
+        ] = f"{export_dir}/redshift-deletes.manifest"
+        s3_client.put_object(
+            Bucket=Config.S3_BUCKET,
+            Key=redshift_manifest["deletes_manifest"],
+            Body=json.dumps(
+                {"entries": [{"url": f"s3://my-test-bucket/{deletes_file}"}]}
+            ),
+        )
+    redshift_manifest_file = f"{export_dir}/redshift.manifest"
+    s3_client.put_object(
+        Bucket=Config.S3_BUCKET,
+        Key=redshift_manifest_file,
+        Body=json.dumps(redshift_manifest),
+    )
+    return redshift_manifest_file
+
+
+def _read_entries(s3_client, redshift_manifest):
+    return [
+        row["Item"]
+        for entry in redshift_manifest["entries"]
+        for row in read_gzipped_lines(
+            s3_client, entry["url"].split("s3://my-test-bucket/")[1]
+        )
+    ]
+
+
+@pytest.fixture
+def accumulating(monkeypatch):
+    monkeypatch.setattr(Config, "ACCUMULATE_MIN_ITEMS", 5)
+    monkeypatch.setattr(Config, "ACCUMULATE_MIN_BYTES", 1024)
+    monkeypatch.setattr(Config, "ACCUMULATE_MAX_AGE_SECONDS", 900)
+
+
+def test_manifests_held_then_combined_latest_change_wins(s3_client, accumulating):
+    first = _put_manifest(s3_client, "export-1", [_item("a", "1"), _item("b", "1")])
+    assert upsert_accumulator.accumulate(s3_client, first) is None
+
+    second = _put_manifest(
+        s3_client,
+        "export-2",
+        [_item("a", "2"), _item("b", is_active=False), _item("c", "2")],
+    )
+    combined_manifest_file = upsert_accumulator.accumulate(s3_client, second)
+
+    assert combined_manifest_file.endswith("/combined.manifest")
+    combined_manifest = s3_utils.read_json_from_s3(
+        s3_client, Config.S3_BUCKET, combined_manifest_file
+    )
+    assert combined_manifest["export_arns"] == ["export-1", "export-2"]
+    assert combined_manifest["item_count"] == 3
+    assert _read_entries(s3_client, combined_manifest) == [
+        _item("a", "2"),
+        _item("b", is_active=False),  # a plain concatenation would resurrect b
+        _item("c", "2"),
+    ]
+
+    # the held manifests are released once the combined manifest has been applied
+    assert len(upsert_accumulator._list_pending(s3_client, TABLE)) == 2
+    upsert_accumulator.complete(s3_client, combined_manifest_file)
+    assert upsert_accumulator._list_pending(s3_client, TABLE) == []
+
+
+def test_manifest_held_twice_keeps_its_first_position(s3_client, accumulating):
+    first = _put_manifest(s3_client, "export-1", [_item("a", "1")])
+    second = _put_manifest(s3_client, "export-2", [_item("a", "2")])
+    assert upsert_accumulator.accumulate(s3_client, first) is None
+    assert upsert_accumulator.accumulate(s3_client, second) is None
+
+    # e.g. a retry of the first, once the second is held
+    assert upsert_accumulator.accumulate(s3_client, first) is None
+    pending = upsert_accumulator._list_pending(s3_client, TABLE)
+    combined_manifest_file = upsert_accumulator._combine(s3_client, TABLE, pending)
+
+    combined_manifest = s3_utils.read_json_from_s3(
+        s3_client, Config.S3_BUCKET, combined_manifest_file
+    )
+    assert combined_manifest["export_arns"] == ["export-1", "export-2"]
+    assert _read_entries(s3_client, combined_manifest) == [_item("a", "2")]
+
+
+def _key(pk):
+    return {"pk": {"S": pk}}
+
+
+def test_split_manifests_combined_into_upserts_and_deletes(
+    s3_client, accumulating, monkeypatch
+):
+    monkeypatch.setattr(Config, "ACCUMULATE_MIN_ITEMS", 6)
+    manifests = [
+        _put_manifest(s3_client, "export-1", [_key("a"), _key("b")], []),
+        # within a manifest, deletes are applied before upserts
+        _put_manifest(s3_client, "export-2", [_key("c")], [_key("b"), _key("c")]),
+        _put_manifest(s3_client, "export-3", [_key("a")], []),
+    ]
+    assert upsert_accumulator.accumulate(s3_client, manifests[0]) is None
+    assert upsert_accumulator.accumulate(s3_client, manifests[1]) is None
+    combined_manifest_file = upsert_accumulator.accumulate(s3_client, manifests[2])
+
+    combined_manifest = s3_utils.read_json_from_s3(
+        s3_client, Config.S3_BUCKET, combined_manifest_file
+    )
+    assert _read_entries(s3_client, combined_manifest) == [_key("c"), _key("a")]
+    deletes_manifest = s3_utils.read_json_from_s3(
+        s3_client, Config.S3_BUCKET, combined_manifest["deletes_manifest"]
+    )
+    assert _read_entries(s3_client, deletes_manifest) == [_key("b")]
+    assert combined_manifest["split_deletes"]
+
+
+def test_non_combinable_manifests_are_not_held(s3_client, accumulating, monkeypatch):
+    redshift_manifest_file = _put_manifest(s3_client, "export-1", [_item("a")])
+
+    monkeypatch.setattr(Config, "ORDERED_APPLY", True)
+    assert (
+        upsert_accumulator.accumulate(s3_client, redshift_manifest_file)
+        == redshift_manifest_file
+    )
+    assert upsert_accumulator._list_pending(s3_client, TABLE) == []
+
+
+def test_flush_due_combines_old_manifests(s3_client, accumulating, monkeypatch):
+    redshift_manifest_file = _put_manifest(s3_client, "export-1", [_item("a", "1")])
+    assert upsert_accumulator.accumulate(s3_client, redshift_manifest_file) is None
+    assert upsert_accumulator.flush_due(s3_client) == []
+
+    monkeypatch.setattr(Config, "ACCUMULATE_MAX_AGE_SECONDS", 0)
+    combined_manifest_files = upsert_accumulator.flush_due(s3_client)
+
+    assert len(combined_manifest_files) == 1
+    assert f"upsert-accumulating-combined/{TABLE}/" in combined_manifest_files[0]
+
+
+def test_combined_manifests_of_a_table_are_applied_one_at_a_time(
+    s3_client, accumulating, monkeypatch
+):
+    monkeypatch.setattr(Config, "ACCUMULATE_MIN_ITEMS", 2)
+    manifests = [
+        _put_manifest(s3_client, f"export-{i}", [_item("a", str(i))])
+        for i in range(1, 4)
+    ]
+    assert upsert_accumulator.accumulate(s3_client, manifests[0]) is None
+    first = upsert_accumulator.accumulate(s3_client, manifests[1])
+    assert first is not None
+
+    # while the first is applied, a combine of [export-1, export-2, export-3] could be
+    # applied before it, and the first would then overwrite export-3's changes
+    assert upsert_accumulator.accumulate(s3_client, manifests[2]) is None
+    assert upsert_accumulator.flush_due(s3_client) == []
+
+    # a first that isn't completed in time is retried, not combined again
+    monkeypatch.setattr(Config, "ACCUMULATE_MAX_AGE_SECONDS", 0)
+    assert upsert_accumulator.flush_due(s3_client) == [first]
+
+    upsert_accumulator.complete(s3_client, first)
+    [second] = upsert_accumulator.flush_due(s3_client)
+    combined_manifest = s3_utils.read_json_from_s3(s3_client, Config.S3_BUCKET, second)
+    assert combined_manifest["export_arns"] == ["export-3"]
+    assert _read_entries(s3_client, combined_manifest) == [_item("a", "3")]
+
+    upsert_accumulator.complete(s3_client, second)
+    assert upsert_accumulator._list_pending(s3_client, TABLE) == []
+    assert upsert_accumulator._list_claims(s3_client, TABLE) == []